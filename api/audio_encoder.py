@@ -0,0 +1,111 @@
+import struct
+import subprocess
+from typing import Iterator, Optional, Dict, List, Tuple
+
+import numpy as np
+
+# 支持的音频格式及其MIME类型，第一个为响应的Content-Type
+AUDIO_MEDIA_TYPES: Dict[str, List[str]] = {
+    'wav': ['audio/wav', 'audio/x-wav', 'audio/wave', 'audio/vnd.wave'],
+    'flac': ['audio/flac', 'audio/x-flac'],
+    'opus': ['audio/ogg', 'audio/opus'],
+}
+
+# 使用ffmpeg编码的格式参数
+FFMPEG_FLAGS: Dict[str, List[str]] = {
+    'flac': ['-f', 'flac', '-c:a', 'flac', '-sample_fmt', 's16'],
+    # Opus只支持48kHz等固定采样率，需要重采样
+    'opus': ['-f', 'ogg', '-c:a', 'libopus', '-b:a', '128k', '-ar', '48000'],
+}
+
+DEFAULT_AUDIO_FORMAT = 'wav'
+
+
+def negotiate_audio_format(accept: Optional[str]) -> Optional[str]:
+    """根据Accept请求头选择音频格式
+
+    Args:
+        accept (Optional[str]): Accept请求头，如"audio/flac, audio/wav;q=0.5"
+
+    Returns:
+        Optional[str]: 'wav'、'flac'或'opus'，没有可接受的格式时返回None
+    """
+    if not accept:
+        return DEFAULT_AUDIO_FORMAT
+    candidates: List[Tuple[float, int, str]] = []
+    for index, item in enumerate(accept.split(',')):
+        parts = [part.strip() for part in item.split(';')]
+        media_type = parts[0].lower()
+        quality = 1.0
+        for param in parts[1:]:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if quality <= 0:
+            continue
+        if media_type in ('*/*', 'audio/*'):
+            candidates.append((quality, index, DEFAULT_AUDIO_FORMAT))
+            continue
+        for audio_format, media_types in AUDIO_MEDIA_TYPES.items():
+            if media_type in media_types:
+                candidates.append((quality, index, audio_format))
+    if not candidates:
+        return None
+    # 优先级相同时按请求头中的顺序选择
+    candidates.sort(key=lambda candidate: (-candidate[0], candidate[1]))
+    return candidates[0][2]
+
+
+def get_media_type(audio_format: str) -> str:
+    """获取音频格式对应的Content-Type"""
+    return AUDIO_MEDIA_TYPES[audio_format][0]
+
+
+def _to_pcm16(audio: np.ndarray) -> np.ndarray:
+    """将(samples,)或(channels, samples)的浮点音频转换为交错排列的16位PCM数据(samples, channels)"""
+    if audio.ndim == 1:
+        audio = audio[:, None]
+    else:
+        audio = audio.T
+    return np.ascontiguousarray((audio * 32767).clip(-32768, 32767).astype('<i2'))
+
+
+def iter_wav_bytes(audio: np.ndarray, sampling_rate: int, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+    """先返回WAV文件头，再分块返回16位PCM数据"""
+    pcm = _to_pcm16(audio)
+    channels = pcm.shape[1]
+    data_size = pcm.nbytes
+    block_align = channels * 2
+    yield struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_size, b'WAVE',
+        b'fmt ', 16, 1, channels, sampling_rate, sampling_rate * block_align, block_align, 16,
+        b'data', data_size
+    )
+    data = pcm.tobytes()
+    for start in range(0, len(data), chunk_size):
+        yield data[start:start + chunk_size]
+
+
+def encode_with_ffmpeg(audio: np.ndarray, sampling_rate: int, audio_format: str) -> bytes:
+    """使用ffmpeg将音频编码为FLAC或Ogg Opus格式"""
+    pcm = _to_pcm16(audio)
+    command = [
+        'ffmpeg', '-loglevel', 'error',
+        '-f', 's16le', '-ar', str(sampling_rate), '-ac', str(pcm.shape[1]), '-i', '-'
+    ] + FFMPEG_FLAGS[audio_format] + ['-']
+    process = subprocess.run(command, input=pcm.tobytes(), capture_output=True, check=True)
+    return process.stdout
+
+
+def iter_audio_bytes(audio: np.ndarray, sampling_rate: int, audio_format: str,
+                     chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+    """把音频编码为指定格式并分块返回，用于分块传输的流式响应"""
+    if audio_format == 'wav':
+        yield from iter_wav_bytes(audio, sampling_rate, chunk_size)
+        return
+    data = encode_with_ffmpeg(audio, sampling_rate, audio_format)
+    for start in range(0, len(data), chunk_size):
+        yield data[start:start + chunk_size]
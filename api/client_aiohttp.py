@@ -1,6 +1,5 @@
 import asyncio
 import json
-import base64
 import os
 import uuid
 import time
@@ -21,25 +20,29 @@ class MusicGenClient:
         self.server_url = server_url
         self.client_id = str(uuid.uuid4())  # 使用UUID作为客户端ID
         
-    def save_audio(self, audio_base64: str, output_path: str = "output"):
-        """保存音频文件
+    async def save_audio(self, session: aiohttp.ClientSession, audio_url: str, output_path: str = "output",
+                         accept: str = "audio/wav"):
+        """下载并保存音频文件
         
         Args:
-            audio_base64 (str): Base64编码的WAV音频数据
+            session (aiohttp.ClientSession): HTTP会话
+            audio_url (str): completed事件中返回的音频地址
             output_path (str): 输出目录路径
+            accept (str): 音频格式，audio/wav、audio/flac或audio/ogg(Opus)
         """
         # 创建输出目录
         os.makedirs(output_path, exist_ok=True)
         
-        # 解码Base64数据
-        audio_data = base64.b64decode(audio_base64)
-        
         # 生成输出文件路径
-        output_file = os.path.join(output_path, f"music_{self.client_id}.wav")
+        extension = {"audio/flac": "flac", "audio/ogg": "ogg"}.get(accept, "wav")
+        output_file = os.path.join(output_path, f"music_{self.client_id}.{extension}")
         
-        # 将音频数据写入文件
-        with open(output_file, "wb") as f:
-            f.write(audio_data)
+        # 分块下载音频数据并写入文件
+        async with session.get(f"{self.server_url}{audio_url}", headers={"Accept": accept}) as response:
+            response.raise_for_status()
+            with open(output_file, "wb") as f:
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    f.write(chunk)
             
         print(f"音频已保存到: {output_file}")
     
@@ -70,13 +73,12 @@ class MusicGenClient:
                 # "X-Request-Id": self.client_id
             }
             
-            # 设置较大的读取缓冲区以处理大型响应块
+            # 事件流中不再包含音频数据，使用默认的读取缓冲区即可
             tcp_connector = aiohttp.TCPConnector(limit=5)
             client_timeout = aiohttp.ClientTimeout(total=3600)  # 1小时超时
             
             # 发送请求并获取SSE流
-            async with aiohttp.ClientSession(connector=tcp_connector, timeout=client_timeout, 
-                                            read_bufsize=1024*1024*10) as session:  # 10MB读取缓冲区
+            async with aiohttp.ClientSession(connector=tcp_connector, timeout=client_timeout) as session:
                 print("正在发送生成请求...")
                 async with session.post(
                     f"{self.server_url}/api/v1/generate_music", 
@@ -91,7 +93,7 @@ class MusicGenClient:
                         
                     # 处理SSE流
                     buffer = ""
-                    async for line_bytes in response.content.iter_chunked(1024*1024):  # 以1MB为单位读取块
+                    async for line_bytes in response.content.iter_any():
                         line = line_bytes.decode('utf-8')
                         buffer += line
                         
@@ -111,8 +113,8 @@ class MusicGenClient:
                                                 elapsed_time = end_time - start_time  # 计算经过的时间
                                                 print("\n音乐生成完成！")
                                                 print(f"总生成时间: {elapsed_time:.2f} 秒")
-                                                if "audio" in data:
-                                                    self.save_audio(data["audio"])
+                                                if "audio_url" in data:
+                                                    await self.save_audio(session, data["audio_url"])
                                                 else:
                                                     print("警告: 返回的数据中没有音频内容")
                                                 return
@@ -1,6 +1,5 @@
 import requests
 import json
-import base64
 import os
 import uuid
 import time
@@ -21,25 +20,27 @@ class MusicGenClient:
         self.server_url = server_url
         self.client_id = str(uuid.uuid4())  # 使用UUID作为客户端ID
         
-    def save_audio(self, audio_base64: str, output_path: str = "output"):
-        """保存音频文件
+    def save_audio(self, audio_url: str, output_path: str = "output", accept: str = "audio/wav"):
+        """下载并保存音频文件
         
         Args:
-            audio_base64 (str): Base64编码的WAV音频数据
+            audio_url (str): completed事件中返回的音频地址
             output_path (str): 输出目录路径
+            accept (str): 音频格式，audio/wav、audio/flac或audio/ogg(Opus)
         """
         # 创建输出目录
         os.makedirs(output_path, exist_ok=True)
         
-        # 解码Base64数据
-        audio_data = base64.b64decode(audio_base64)
-        
         # 生成输出文件路径
-        output_file = os.path.join(output_path, f"music_{self.client_id}.wav")
+        extension = {"audio/flac": "flac", "audio/ogg": "ogg"}.get(accept, "wav")
+        output_file = os.path.join(output_path, f"music_{self.client_id}.{extension}")
         
-        # 将音频数据写入文件
-        with open(output_file, "wb") as f:
-            f.write(audio_data)
+        # 分块下载音频数据并写入文件
+        with requests.get(f"{self.server_url}{audio_url}", headers={"Accept": accept}, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            with open(output_file, "wb") as f:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    f.write(chunk)
             
         print(f"音频已保存到: {output_file}")
     
@@ -103,8 +104,8 @@ class MusicGenClient:
                                     elapsed_time = end_time - start_time  # 计算经过的时间
                                     print("\n音乐生成完成！")
                                     print(f"总生成时间: {elapsed_time:.2f} 秒")
-                                    if "audio" in data:
-                                        self.save_audio(data["audio"])
+                                    if "audio_url" in data:
+                                        self.save_audio(data["audio_url"])
                                     else:
                                         print("警告: 返回的数据中没有音频内容")
                                 elif data["event"] == "error":
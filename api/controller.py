@@ -1,21 +1,28 @@
 from service import MusicGenService
+from result_store import ResultStore
+from audio_encoder import iter_audio_bytes
 
 import io
 import scipy
 from loguru import logger
 import numpy as np
 import base64
-from typing import Dict, Any, Optional, Callable
+from typing import Dict, Any, Optional, Callable, List, Iterator
 
 class MusicController:
     def __init__(self):
         self.musicgen_service = MusicGenService()
+        self.result_store = ResultStore()
 
     def init_music_model(self, model_name: str = 'facebook/musicgen-large') -> None:
         self.musicgen_service.init_music_model(model_name)
 
-    def generate_music_with_progress(self, params: Dict[str, Any], progress_callback: Optional[Callable[[float], None]] = None) -> str:
-        """处理音乐生成请求
+    def get_max_duration(self) -> float:
+        """模型单次解码支持的最大时长(秒)"""
+        return self.musicgen_service.max_duration
+
+    def validate_params(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        """校验音乐生成参数并补全默认值
 
         Args:
             params (Dict[str, Any]): 包含生成参数的字典
@@ -26,51 +33,137 @@ class MusicController:
                 - top_p: top-p采样参数（可选，默认0.0）
                 - temperature: 温度参数（可选，默认1.0）
                 - cfg_coef: 无分类器指导系数（可选，默认3.0）
-            progress_callback: 进度回调函数
+                - stream_audio: 是否在生成过程中增量返回音频片段（可选，默认False）
+                - seed: 随机种子，指定后生成结果可复现（可选，默认None）
 
         Returns:
-            str: Base64编码的WAV音频数据
+            Dict[str, Any]: 补全默认值后的参数字典
+
+        Raises:
+            AssertionError: 参数不合法
         """
+        # 参数验证
+        assert params and isinstance(params, dict) and 'description' in params
 
-        try:
-            # 参数验证
-            assert params and isinstance(params, dict) and 'description' in params
+        mbd = params.get('mbd', False)
+        assert isinstance(mbd, bool)
 
-            mbd = params.get('mbd', False)
-            assert isinstance(mbd, bool)
+        duration = params.get('duration', 30)
+        assert isinstance(duration, int) and 1 <= duration <= 60
 
-            duration = params.get('duration', 30)
-            assert isinstance(duration, int) and 1 <= duration <= 60
+        top_k = params.get('top_k', 250)
+        assert isinstance(top_k, int) and top_k > 0
 
-            top_k = params.get('top_k', 250)
-            assert isinstance(top_k, int) and top_k > 0
+        top_p = params.get('top_p', 0.0)
+        assert isinstance(top_p, (int, float)) and 0 <= top_p <= 1
 
-            top_p = params.get('top_p', 0.0)
-            assert isinstance(top_p, (int, float)) and 0 <= top_p <= 1
+        temperature = params.get('temperature', 3.0)
+        assert isinstance(temperature, (int, float)) and temperature >= 0
 
-            temperature = params.get('temperature', 3.0)
-            assert isinstance(temperature, (int, float)) and temperature >= 0
+        cfg_coef = params.get('cfg_coef', 3.0)
+        assert isinstance(cfg_coef, (int, float))
 
-            cfg_coef = params.get('cfg_coef', 3.0)
-            assert isinstance(cfg_coef, (int, float))
-        except AssertionError as e:
-            raise AssertionError(e)
+        stream_audio = params.get('stream_audio', False)
+        assert isinstance(stream_audio, bool)
+
+        seed = params.get('seed')
+        assert seed is None or (isinstance(seed, int) and not isinstance(seed, bool) and 0 <= seed < 2 ** 63)
+
+        return {
+            'description': params['description'],
+            'mbd': mbd,
+            'duration': duration,
+            'top_k': top_k,
+            'top_p': top_p,
+            'temperature': temperature,
+            'cfg_coef': cfg_coef,
+            'stream_audio': stream_audio,
+            'seed': seed,
+        }
+
+    def generate_music_with_progress(self, params: Dict[str, Any], progress_callback: Optional[Callable[[float], None]] = None) -> str:
+        """处理音乐生成请求
+
+        Args:
+            params (Dict[str, Any]): 包含生成参数的字典，字段见validate_params
+            progress_callback: 进度回调函数
+
+        Returns:
+            str: Base64编码的WAV音频数据
+        """
+        params = self.validate_params(params)
 
-        # 创建内存缓冲区存储音频
-        audio_buffer = io.BytesIO()
-        
         # 生成音频
         audio_tensor, sampling_rate = self.musicgen_service.generate_music(
             params['description'], 
-            mbd=mbd,
-            duration=duration, 
-            top_k=top_k, 
-            top_p=top_p, 
-            temperature=temperature,
-            cfg_coef=cfg_coef, 
+            mbd=params['mbd'],
+            duration=params['duration'], 
+            top_k=params['top_k'], 
+            top_p=params['top_p'], 
+            temperature=params['temperature'],
+            cfg_coef=params['cfg_coef'], 
+            seed=params['seed'],
             progress_callback=progress_callback 
         )
-        
+        return self._encode_wav_base64(audio_tensor, sampling_rate)
+
+    def generate_music_batch_with_progress(
+        self,
+        params_list: List[Dict[str, Any]],
+        progress_callback: Optional[Callable[[float], None]] = None,
+        audio_chunk_callback: Optional[Callable[[int, str, int], None]] = None
+        ) -> List[str]:
+        """批量处理音乐生成请求，所有请求共享一次LM解码
+
+        Args:
+            params_list (List[Dict[str, Any]]): 已通过validate_params校验的参数字典列表
+            progress_callback: 整个批次共享的进度回调函数
+            audio_chunk_callback: 音频片段回调函数，参数为请求在批次中的序号、Base64编码的PCM数据和采样率
+
+        Returns:
+            List[str]: 与params_list一一对应的结果ID，通过get_audio_stream获取音频
+        """
+        sampling_rate = self.musicgen_service.sample_rate
+
+        def _chunk_handler(idx: int, audio_chunk: np.ndarray):
+            assert audio_chunk_callback is not None
+            audio_chunk_callback(idx, self._encode_pcm_base64(audio_chunk), sampling_rate)
+
+        results = self.musicgen_service.generate_music_batch(
+            params_list,
+            progress_callback=progress_callback,
+            audio_chunk_callback=_chunk_handler if audio_chunk_callback is not None else None
+        )
+        return [self.result_store.put(audio_tensor, sampling_rate) for audio_tensor, sampling_rate in results]
+
+    def get_audio_stream(self, result_id: str, audio_format: str) -> Optional[Iterator[bytes]]:
+        """获取生成结果的音频数据流
+
+        Args:
+            result_id (str): generate_music_batch_with_progress返回的结果ID
+            audio_format (str): 音频格式，'wav'、'flac'或'opus'
+
+        Returns:
+            Optional[Iterator[bytes]]: 分块的音频文件数据，结果不存在或已过期时返回None
+        """
+        result = self.result_store.get(result_id)
+        if result is None:
+            return None
+        audio_tensor, sampling_rate = result
+        return iter_audio_bytes(audio_tensor, sampling_rate, audio_format)
+
+    def _encode_pcm_base64(self, audio_chunk: np.ndarray) -> str:
+        """将音频片段编码为Base64的PCM数据（16位有符号整数，小端序，多声道交错排列）"""
+        if audio_chunk.ndim == 2:
+            audio_chunk = audio_chunk.T  # (channels, samples) -> (samples, channels)
+        audio_numpy = (audio_chunk * 32767).clip(-32768, 32767).astype('<i2')
+        return base64.b64encode(np.ascontiguousarray(audio_numpy).tobytes()).decode('utf-8')
+
+    def _encode_wav_base64(self, audio_tensor: np.ndarray, sampling_rate: int) -> str:
+        """将音频数组编码为Base64的WAV数据"""
+        # 创建内存缓冲区存储音频
+        audio_buffer = io.BytesIO()
+
         # 确保音频数组维度正确
         if audio_tensor.ndim > 2:
             audio_tensor = audio_tensor[0]  # 移除批次维度
@@ -89,4 +182,4 @@ class MusicController:
         audio_buffer.seek(0)
         audio_base64 = base64.b64encode(audio_buffer.read()).decode('utf-8')
         
-        return audio_base64
\ No newline at end of file
+        return audio_base64
@@ -0,0 +1,282 @@
+from loguru import logger
+from result_store import ResultStore
+from scheduler import GenerationScheduler
+
+import os
+import time
+import uuid
+import base64
+import asyncio
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional, List, Dict, Any, Tuple, AsyncIterator
+
+# 任务状态
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+
+
+@dataclass
+class JobRecord:
+    ''' 异步生成任务的状态和事件记录
+
+    事件按顺序编号，编号即SSE的事件ID，客户端断线重连时通过Last-Event-ID从下一个事件继续接收。
+    音频片段追加写入chunk_path文件，事件中只记录片段在文件中的位置，发送时再读取，避免任务记录占用内存。
+    '''
+    job_id: str
+    chunk_path: Optional[str] = None
+    finished_at: Optional[float] = None
+    status: str = JOB_QUEUED
+    result_id: Optional[str] = None
+    events: List[Dict[str, Any]] = field(default_factory=list)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+    _waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = field(default_factory=list)
+    _last_progress: int = -1
+    _last_queue_position: int = -1
+    _chunk_count: int = 0
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (JOB_COMPLETED, JOB_FAILED)
+
+    def append_event(self, event: Dict[str, Any], status: Optional[str] = None) -> None:
+        """追加一个事件并唤醒等待中的事件流，可以在任意线程中调用"""
+        with self._lock:
+            if status is not None:
+                self.status = status
+            self.events.append(event)
+            waiters, self._waiters = self._waiters, []
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(waiter.set)
+
+    def on_progress(self, percentage: float) -> None:
+        # 只记录整数百分比的变化，避免事件记录随解码步数增长
+        progress = int(percentage)
+        if progress == self._last_progress:
+            return
+        self._last_progress = progress
+        self.append_event({"event": "progress", "progress": float(progress)}, status=JOB_RUNNING)
+
+    def on_queued(self, position: int, estimated_wait: float) -> None:
+        # 只在排队位置变化时记录
+        if position == self._last_queue_position:
+            return
+        self._last_queue_position = position
+        self.append_event({
+            "event": "queued",
+            "queue_position": position + 1,
+            "estimated_wait": round(estimated_wait, 1),
+            "estimated_start_time": round(time.time() + estimated_wait, 1)
+        })
+
+    def on_audio_chunk(self, audio_chunk: str, sampling_rate: int) -> None:
+        assert self.chunk_path is not None
+        chunk_index = self._chunk_count
+        self._chunk_count += 1
+        data = base64.b64decode(audio_chunk)
+        # 片段由生成线程依次写入，事件在写入完成后才追加，读取时文件中一定有完整的片段
+        with open(self.chunk_path, "ab") as f:
+            offset = f.tell()
+            f.write(data)
+        self.append_event({"event": "audio_chunk", "chunk_offset": offset, "chunk_length": len(data),
+                           "chunk_index": chunk_index, "sample_rate": sampling_rate})
+
+    def load_event(self, event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """读取事件引用的音频片段，返回可以直接发送的事件，会读取磁盘，不应在事件循环中直接调用
+
+        Returns:
+            Optional[Dict[str, Any]]: 音频片段事件中offset和length替换为Base64编码的audio，片段文件已被清理时返回None
+        """
+        if event["event"] != "audio_chunk":
+            return event
+        assert self.chunk_path is not None
+        event = dict(event)
+        offset, length = event.pop("chunk_offset"), event.pop("chunk_length")
+        try:
+            with open(self.chunk_path, "rb") as f:
+                f.seek(offset)
+                data = f.read(length)
+        except FileNotFoundError:
+            logger.warning(f"Audio chunks of job {self.job_id} are missing")
+            return None
+        event["audio"] = base64.b64encode(data).decode('utf-8')
+        return event
+
+    def remove_chunks(self) -> None:
+        if self.chunk_path is None:
+            return
+        try:
+            os.remove(self.chunk_path)
+        except FileNotFoundError:
+            pass
+
+    def get_events(self, start: int) -> Tuple[List[Tuple[int, Dict[str, Any]]], Optional[asyncio.Event]]:
+        """获取编号从start开始的事件
+
+        Returns:
+            (事件列表, 等待新事件的asyncio.Event)，没有新事件且任务未结束时返回的Event会在下一个事件到达时被设置
+        """
+        with self._lock:
+            if start < len(self.events) or self.finished:
+                return list(enumerate(self.events))[start:], None
+            waiter = asyncio.Event()
+            self._waiters.append((asyncio.get_running_loop(), waiter))
+            return [], waiter
+
+
+class JobManager:
+    ''' 异步生成任务管理
+
+    任务提交给批处理调度器后立即返回任务ID，生成过程不依赖客户端连接，客户端断开连接不会中断生成。
+    任务记录最多保留max_jobs条，结束超过ttl秒的任务会被清理，音频结果固定在ResultStore中，
+    流式返回的音频片段保存在directory目录中，两者都随任务记录一起清理，任务记录存在时结果一定可以取回。
+    '''
+
+    _instance: Optional['JobManager'] = None
+
+    def __new__(cls):
+        ''' 单例模式 '''
+        if cls._instance is None:
+            cls._instance = super(JobManager, cls).__new__(cls)
+            cls._instance._initialized = False
+        return cls._instance
+
+    def __init__(self):
+        if self._initialized:
+            return
+        self._initialized = True
+        self.generation_scheduler = GenerationScheduler()
+        self.result_store = ResultStore()
+        self.max_jobs: int = 256
+        self.ttl: float = 600.0
+        self.directory: str = os.path.join("output", "jobs")
+        self._jobs: 'OrderedDict[str, JobRecord]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, max_jobs: int = 256, ttl: float = 600.0, directory: Optional[str] = None) -> None:
+        """设置任务记录的容量和保留时间，并清理目录中遗留的音频片段
+
+        Args:
+            max_jobs (int): 最多保留的任务数
+            ttl (float): 任务记录的保留时间（秒）
+            directory (Optional[str]): 音频片段保存目录，默认为output/jobs
+        """
+        assert max_jobs >= 1 and ttl > 0
+        with self._lock:
+            self.max_jobs = max_jobs
+            self.ttl = ttl
+            if directory is not None:
+                self.directory = directory
+            os.makedirs(self.directory, exist_ok=True)
+            for filename in os.listdir(self.directory):
+                if filename.endswith(".pcm"):
+                    os.remove(os.path.join(self.directory, filename))
+
+    def submit(self, params: Dict[str, Any], client_id: str = "", priority: int = 0) -> JobRecord:
+        """提交一个异步生成任务
+
+        Args:
+            params (Dict[str, Any]): 音乐生成参数，见MusicController.validate_params
+            client_id (str): 客户端标识，用于在客户端之间公平排队
+            priority (int): 排队优先级，数值越小越优先
+
+        Returns:
+            JobRecord: 任务记录
+
+        Raises:
+            AssertionError: 参数不合法
+            QueueFullError: 调度器的等待队列已满
+            RuntimeError: 未结束的任务数达到上限
+        """
+        job_id = uuid.uuid4().hex
+        os.makedirs(self.directory, exist_ok=True)
+        record = JobRecord(job_id=job_id, chunk_path=os.path.join(self.directory, f"{job_id}.pcm"))
+        record.append_event({"event": "start"})
+        with self._lock:
+            self._evict()
+            while len(self._jobs) >= self.max_jobs:
+                # 记录已满时丢弃最早结束的任务，全部未结束时拒绝新任务
+                finished_id = next((job_id for job_id, job in self._jobs.items() if job.finished), None)
+                if finished_id is None:
+                    raise RuntimeError("Too many unfinished jobs")
+                self._drop(finished_id)
+            job = self.generation_scheduler.submit(
+                params,
+                progress_callback=record.on_progress,
+                audio_chunk_callback=record.on_audio_chunk,
+                queue_callback=record.on_queued,
+                client_id=client_id,
+                priority=priority
+            )
+            self._jobs[record.job_id] = record
+
+        def on_done(future):
+            record.finished_at = time.monotonic()
+            if future.cancelled():
+                record.append_event({"event": "error", "message": "音乐生成被取消"}, status=JOB_FAILED)
+            elif future.exception() is not None:
+                record.append_event({"event": "error", "message": "音乐生成失败"}, status=JOB_FAILED)
+            elif not self.result_store.pin(future.result()):
+                record.append_event({"event": "error", "message": "音乐生成结果已被清理"}, status=JOB_FAILED)
+            else:
+                record.result_id = future.result()
+                record.append_event({
+                    "event": "completed",
+                    "result_id": record.result_id,
+                    "audio_url": f"/api/v1/jobs/{record.job_id}/audio"
+                }, status=JOB_COMPLETED)
+            logger.info(f"Job {record.job_id} finished with status {record.status}")
+
+        job.future.add_done_callback(on_done)
+        logger.info(f"Job {record.job_id} submitted")
+        return record
+
+    def get(self, job_id: str) -> Optional[JobRecord]:
+        """获取任务记录，任务不存在或已过期时返回None"""
+        with self._lock:
+            self._evict()
+            return self._jobs.get(job_id)
+
+    async def iter_events(self, record: JobRecord, last_event_id: Optional[int] = None,
+                          keepalive: float = 15.0) -> AsyncIterator[Optional[Tuple[int, Dict[str, Any]]]]:
+        """按顺序返回任务事件直到任务结束
+
+        Args:
+            record (JobRecord): 任务记录
+            last_event_id (Optional[int]): 客户端已收到的最后一个事件ID，从下一个事件开始返回
+            keepalive (float): 没有新事件时，每隔keepalive秒返回一次None，用于发送心跳
+
+        Yields:
+            (事件ID, 事件)或None
+        """
+        start = 0 if last_event_id is None else last_event_id + 1
+        while True:
+            events, waiter = record.get_events(start)
+            for event_id, event in events:
+                yield event_id, event
+            start += len(events)
+            if waiter is None:
+                if record.finished and start >= len(record.events):
+                    return
+                continue
+            try:
+                await asyncio.wait_for(waiter.wait(), timeout=keepalive)
+            except asyncio.TimeoutError:
+                yield None
+
+    def _evict(self) -> None:
+        """清理结束后超过保留时间的任务，调用时需要持有锁"""
+        deadline = time.monotonic() - self.ttl
+        for job_id in [job_id for job_id, record in self._jobs.items()
+                       if record.finished_at is not None and record.finished_at <= deadline]:
+            self._drop(job_id)
+
+    def _drop(self, job_id: str) -> None:
+        """删除任务记录及其音频片段和结果，调用时需要持有锁"""
+        record = self._jobs.pop(job_id)
+        record.remove_chunks()
+        if record.result_id is not None:
+            self.result_store.release(record.result_id)
@@ -1,19 +1,28 @@
 from loguru_settings import TraceID, logger, setup_logging
 from controller import MusicController
+from scheduler import GenerationScheduler, QueueFullError
+from result_store import ResultStore
+from token_cache import TokenCache
+from job_manager import JobManager, JobRecord
+
+from audio_encoder import negotiate_audio_format, get_media_type, AUDIO_MEDIA_TYPES
 
 from fastapi import FastAPI, Request, Header
 from fastapi.responses import Response, StreamingResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
-from typing import AsyncGenerator, Optional, Dict, Any, Literal, Union
+from typing import AsyncGenerator, Optional, Dict, Any, Literal, Union, List, Tuple, Deque
+from collections import deque
 import asyncio
 import json
+import time
 import argparse
 import uuid
 
 # 全局变量
-global_semaphore = asyncio.Semaphore(1)
 music_controller = MusicController()
+generation_scheduler = GenerationScheduler()
+job_manager = JobManager()
 app = FastAPI(
     title="音乐生成服务", 
     description="使用Streamable HTTP方案实现的音乐生成服务API",
@@ -62,6 +71,9 @@ class MusicGenerationRequest(BaseModel):
     top_p: Optional[float] = Field(default=0.0, description="采样时考虑的累积概率阈值", ge=0, le=1)
     temperature: Optional[float] = Field(default=3.0, description="采样温度，控制随机性", ge=0)
     cfg_coef: Optional[float] = Field(default=3.0, description="无分类器指导系数")
+    stream_audio: Optional[bool] = Field(default=False, description="是否在生成过程中通过audio_chunk事件增量返回音频片段")
+    priority: Optional[int] = Field(default=0, description="排队优先级，数值越小越优先", ge=0, le=9)
+    seed: Optional[int] = Field(default=None, description="随机种子，指定后相同参数的请求生成相同的音乐，并复用缓存的生成结果", ge=0, lt=2 ** 63)
 
 # 定义响应体
 # 定义API响应示例
@@ -71,7 +83,8 @@ SUCCESS_RESPONSE_EXAMPLE = {
         "text/event-stream": {
             "example": 'data: {"event": "start"}\n\n'
                       'data: {"event": "progress", "progress": 50.0}\n\n'
-                      'data: {"event": "completed", "audio": "base64_audio_data..."}'
+                      'data: {"event": "audio_chunk", "chunk_index": 0, "sample_rate": 32000, "audio": "base64_pcm_data..."}\n\n'
+                      'data: {"event": "completed", "result_id": "2f6c...", "audio_url": "/api/v1/results/2f6c..."}'
         }
     }
 }
@@ -85,11 +98,11 @@ VALIDATION_ERROR_RESPONSE_EXAMPLE = {
     }
 }
 
-SERVER_BUSY_RESPONSE_EXAMPLE = {
-    "description": "服务器忙",
+QUEUE_FULL_RESPONSE_EXAMPLE = {
+    "description": "等待队列已满，Retry-After响应头给出建议的重试等待时间(秒)",
     "content": {
         "application/json": {
-            "example": {"error": "服务器正忙，当前正在处理任务，请稍后重试"}
+            "example": {"detail": "等待队列已满，请稍后重试"}
         }
     }
 }
@@ -98,82 +111,183 @@ SERVER_BUSY_RESPONSE_EXAMPLE = {
 API_RESPONSES_EXAMPLE: Dict[Union[int, str], Dict[str, Any]] = {
     200: SUCCESS_RESPONSE_EXAMPLE,
     422: VALIDATION_ERROR_RESPONSE_EXAMPLE,
-    503: SERVER_BUSY_RESPONSE_EXAMPLE
+    429: QUEUE_FULL_RESPONSE_EXAMPLE
 }
 
 class EventStreamResponse(BaseModel):
-    event: Literal["start", "progress", "completed", "error"] = Field(..., description="事件类型")
+    event: Literal["start", "queued", "progress", "audio_chunk", "completed", "error"] = Field(..., description="事件类型")
+    queue_position: Optional[int] = Field(default=None, description="在等待队列中的位置，从1开始", ge=1)
+    estimated_wait: Optional[float] = Field(default=None, description="预计开始生成前的等待时间(秒)", ge=0)
+    estimated_start_time: Optional[float] = Field(default=None, description="预计开始生成的时间(Unix时间戳，秒)")
     progress: Optional[float] = Field(default=None, description="生成进度百分比", ge=0, le=100)
-    audio: Optional[str] = Field(default=None, description="Base64编码的音频数据")
+    audio: Optional[str] = Field(default=None, description="audio_chunk事件中Base64编码的16位小端序交错PCM数据")
+    chunk_index: Optional[int] = Field(default=None, description="音频片段序号，从0开始", ge=0)
+    sample_rate: Optional[int] = Field(default=None, description="音频片段的采样率")
+    result_id: Optional[str] = Field(default=None, description="生成结果ID")
+    audio_url: Optional[str] = Field(default=None, description="获取音频文件的地址，根据Accept返回WAV、FLAC或Opus格式")
     message: Optional[str] = Field(default=None, description="错误信息")
 
-class ServerBusyResponse(BaseModel):
-    """服务器忙响应模型"""
-    error: str = Field(..., description="错误信息")
+def queue_full_response(retry_after: int) -> Response:
+    """等待队列已满时返回429，并通过Retry-After告知客户端重试时间"""
+    return JSONResponse(
+        content={"detail": "等待队列已满，请稍后重试"},
+        status_code=429,
+        headers={"Retry-After": str(retry_after)}
+    )
+
+
+def get_client_id(request: Request) -> str:
+    """客户端标识，优先使用X-Client-Id请求头，否则使用客户端地址，用于在客户端之间公平排队"""
+    client_id = request.headers.get("X-Client-Id")
+    if client_id:
+        return client_id
+    return request.client.host if request.client is not None else ""
+
+
+def queued_event_data(position: int, estimated_start_time: float) -> EventStreamResponse:
+    return EventStreamResponse(
+        event="queued",
+        queue_position=position + 1,
+        estimated_wait=round(max(0.0, estimated_start_time - time.time()), 1),
+        estimated_start_time=round(estimated_start_time, 1)
+    )
 
 
 async def generate_progress_stream(data: Dict[str, Any], request: Request) -> AsyncGenerator[str, None]:
     """生成进度流"""
-    generation_task = None  # 初始化为None，防止在异常时未定义
+    job = None  # 初始化为None，防止在异常时未定义
     try:
-        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
         progress_event = asyncio.Event()
         progress_value: float = 0.0
-        
-        # 创建一个进度回调函数
-        def progress_callback(percentage: float):
-            if stop_event.is_set():
-                logger.info("Stop progress callback")
-                raise InterruptedError("Stop event is set, stop progress callback")
-            nonlocal progress_value
+        progress_started = False
+
+        def set_progress(percentage: float):
+            nonlocal progress_value, progress_started
             progress_value = percentage
+            progress_started = True
             progress_event.set()
 
+        # 排队位置只保留最新的一次
+        queue_event = asyncio.Event()
+        queue_status: Optional[Tuple[int, float]] = None
+
+        def set_queue_status(position: int, estimated_wait: float):
+            nonlocal queue_status
+            queue_status = (position, time.time() + estimated_wait)
+            queue_event.set()
+
+        # 创建一个排队位置回调函数，在提交请求和调度线程中被调用
+        def queue_callback(position: int, estimated_wait: float):
+            loop.call_soon_threadsafe(set_queue_status, position, estimated_wait)
+
+        # 创建一个进度回调函数，在调度线程中被调用
+        def progress_callback(percentage: float):
+            loop.call_soon_threadsafe(set_progress, percentage)
+
+        # 音频片段按生成顺序放入队列，不能像进度一样合并
+        audio_chunks: Deque[Tuple[str, int]] = deque()
+        audio_chunk_event = asyncio.Event()
+        chunk_index = 0
+
+        def push_audio_chunk(audio_chunk: str, sampling_rate: int):
+            audio_chunks.append((audio_chunk, sampling_rate))
+            audio_chunk_event.set()
+
+        # 创建一个音频片段回调函数，在调度线程中被调用
+        def audio_chunk_callback(audio_chunk: str, sampling_rate: int):
+            loop.call_soon_threadsafe(push_audio_chunk, audio_chunk, sampling_rate)
+
+        def pop_audio_chunk_events() -> List[str]:
+            nonlocal chunk_index
+            events = []
+            while audio_chunks:
+                audio_chunk, sampling_rate = audio_chunks.popleft()
+                chunk_event = EventStreamResponse(
+                    event="audio_chunk", audio=audio_chunk, chunk_index=chunk_index, sample_rate=sampling_rate)
+                events.append(f"data: {json.dumps(chunk_event.model_dump(exclude_none=True))}\n\n")
+                chunk_index += 1
+            audio_chunk_event.clear()
+            return events
+
         # 发送开始事件
         logger.info("Sending start event")
         start_event = EventStreamResponse(event="start")
         yield f"data: {json.dumps(start_event.model_dump(exclude_none=True))}\n\n"
 
-        # 启动音乐生成任务
-        logger.info("Start music generation task")
-
-        generation_task = asyncio.create_task(asyncio.to_thread(
-            music_controller.generate_music_with_progress,
-            params=data,
-            progress_callback=progress_callback
-        ))
+        # 提交到批处理调度器，与其他请求合并解码
+        logger.info("Submit music generation job")
+        priority = data.pop("priority", 0) or 0
+        job = generation_scheduler.submit(
+            data,
+            progress_callback=progress_callback,
+            audio_chunk_callback=audio_chunk_callback,
+            queue_callback=queue_callback,
+            client_id=get_client_id(request),
+            priority=priority
+        )
+        result_future = asyncio.wrap_future(job.future)
     
-        # 处理进度消息直到生成完成
-        while not generation_task.done() and not generation_task.cancelled() and progress_value < 100:
+        # 处理排队位置、进度消息和音频片段直到生成完成
+        while not result_future.done():
+            progress_task = asyncio.ensure_future(progress_event.wait())
+            chunk_task = asyncio.ensure_future(audio_chunk_event.wait())
+            queue_task = asyncio.ensure_future(queue_event.wait())
             await asyncio.wait(
-                [progress_event.wait(), generation_task],  # 等待进度事件或任务完成
+                [progress_task, chunk_task, queue_task, result_future],  # 等待排队位置、进度事件、音频片段或任务完成
                 return_when=asyncio.FIRST_COMPLETED,
                 timeout=1
             )
+            progress_task.cancel()
+            chunk_task.cancel()
+            queue_task.cancel()
+            received_queue_status = queue_event.is_set()
+            queue_event.clear()
+            if queue_status is not None and not progress_started and not result_future.done():
+                # 排队期间用排队事件代替进度事件作为心跳
+                yield f"data: {json.dumps(queued_event_data(*queue_status).model_dump(exclude_none=True))}\n\n"
+                continue
+            received_chunks = audio_chunk_event.is_set()
+            for chunk_event in pop_audio_chunk_events():
+                yield chunk_event
+            if result_future.done():
+                break
+            if (received_chunks or received_queue_status) and not progress_event.is_set():
+                continue
             progress_event.clear()
             logger.info("Send progress message")
             progress_event_data = EventStreamResponse(event="progress", progress=progress_value)
             yield f"data: {json.dumps(progress_event_data.model_dump(exclude_none=True))}\n\n"
 
         # 如果任务没有被取消，获取生成结果并发送
-        if not generation_task.cancelled():
-            audio_data = await generation_task
-            completed_event = EventStreamResponse(event="completed", audio=audio_data)
+        if not result_future.cancelled():
+            result_id = await result_future
+            # 调度线程先投递音频片段再设置结果，此时剩余的片段都已进入队列
+            for chunk_event in pop_audio_chunk_events():
+                yield chunk_event
+            # 音频数据通过结果接口以二进制方式获取，事件流中只返回结果的引用
+            completed_event = EventStreamResponse(
+                event="completed", result_id=result_id, audio_url=f"/api/v1/results/{result_id}")
             yield f"data: {json.dumps(completed_event.model_dump(exclude_none=True))}\n\n"
 
     except AssertionError as e:
         logger.exception(e)
         error_event = EventStreamResponse(event="error", message="音乐生成参数错误")
         yield f"data: {json.dumps(error_event.model_dump(exclude_none=True))}\n\n"
+    except QueueFullError as e:
+        logger.warning(str(e))
+        error_event = EventStreamResponse(event="error", message="等待队列已满，请稍后重试")
+        yield f"data: {json.dumps(error_event.model_dump(exclude_none=True))}\n\n"
     except asyncio.CancelledError as e:
-        progress_event.set()
-        stop_event.set()
         logger.error("client cancel connection")
+    except Exception as e:
+        logger.exception(e)
+        error_event = EventStreamResponse(event="error", message="音乐生成失败")
+        yield f"data: {json.dumps(error_event.model_dump(exclude_none=True))}\n\n"
     finally:
-        if generation_task is not None and not generation_task.done():
-            generation_task.cancel()
-        global_semaphore.release()
-        logger.info("Semaphore released after generate progress stream completion")
+        if job is not None and not job.future.done():
+            job.cancel()
+            logger.info("Generation job cancelled after generate progress stream completion")
 
 @app.post(
     "/api/v1/generate_music", 
@@ -200,30 +314,219 @@ async def http_generate_music(
     Returns:
         流式事件响应，包含进度和最终生成的音频数据
     """
-    # 限流检测
-    if global_semaphore.locked():
-        busy_response = ServerBusyResponse(error="服务器正忙，当前正在处理任务，请稍后重试")
-        return JSONResponse(
-            status_code=503,
-            content=busy_response.model_dump()
-        )
-    else:
-        await global_semaphore.acquire()
-        
-        # 将Pydantic模型转换为字典
-        params = music_params.model_dump()
-        
-        # 返回SSE流式响应
-        return StreamingResponse(
-            generate_progress_stream(params, request),
-            media_type="text/event-stream",
-            headers={
-                "Cache-Control": "no-cache", # 禁止浏览器缓存响应内容， 用于SSE流式响应
-                "Connection": "keep-alive", # 保持连接， 用于SSE流式响应
-                "X-Accel-Buffering": "no",  # 禁用 Nginx 缓冲， Nginx默认会缓冲响应再发送，导致流式数据延迟，禁用后，Nginx会立即发送响应
-                "Access-Control-Allow-Origin": "*"  # 允许跨域访问
-            }
-        )
+    # 等待队列已满时直接拒绝，客户端按Retry-After重试
+    if generation_scheduler.is_full():
+        return queue_full_response(generation_scheduler.estimate_retry_after())
+
+    # 将Pydantic模型转换为字典
+    params = music_params.model_dump()
+    
+    # 返回SSE流式响应, 并发请求由批处理调度器合并解码
+    return StreamingResponse(
+        generate_progress_stream(params, request),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache", # 禁止浏览器缓存响应内容， 用于SSE流式响应
+            "Connection": "keep-alive", # 保持连接， 用于SSE流式响应
+            "X-Accel-Buffering": "no",  # 禁用 Nginx 缓冲， Nginx默认会缓冲响应再发送，导致流式数据延迟，禁用后，Nginx会立即发送响应
+            "Access-Control-Allow-Origin": "*"  # 允许跨域访问
+        }
+    )
+
+
+AUDIO_RESPONSES_EXAMPLE: Dict[Union[int, str], Dict[str, Any]] = {
+    200: {
+        "description": "音频文件，以分块传输方式返回",
+        "content": {media_types[0]: {} for media_types in AUDIO_MEDIA_TYPES.values()}
+    },
+    404: {"description": "结果不存在或已过期"},
+    406: {"description": "不支持Accept中请求的音频格式"},
+}
+
+@app.get(
+    "/api/v1/results/{result_id}",
+    summary="Http Get Music Result",
+    description="获取生成的音频文件，根据Accept返回WAV、FLAC或Opus格式",
+    response_class=StreamingResponse,
+    responses=AUDIO_RESPONSES_EXAMPLE
+)
+async def http_get_music_result(
+    result_id: str,
+    accept: Optional[str] = Header(None, description="audio/wav、audio/flac或audio/ogg(Opus)，默认为audio/wav", alias="Accept"),
+) -> Response:
+    """获取生成的音频文件
+
+    Args:
+        result_id: completed事件中返回的结果ID
+        accept: 接收类型，决定返回的音频格式
+
+    Returns:
+        分块传输的音频文件
+    """
+    return await audio_response(result_id, accept)
+
+
+async def audio_response(result_id: str, accept: Optional[str]) -> Response:
+    """根据Accept选择音频格式，以分块传输方式返回生成结果"""
+    audio_format = negotiate_audio_format(accept)
+    if audio_format is None:
+        supported = ", ".join(media_types[0] for media_types in AUDIO_MEDIA_TYPES.values())
+        return JSONResponse(content={"detail": f"Supported audio types: {supported}"}, status_code=406)
+
+    # 读取结果文件不阻塞事件循环
+    audio_stream = await asyncio.get_running_loop().run_in_executor(
+        None, music_controller.get_audio_stream, result_id, audio_format)
+    if audio_stream is None:
+        return JSONResponse(content={"detail": "Result not found or expired"}, status_code=404)
+
+    extension = 'ogg' if audio_format == 'opus' else audio_format
+    return StreamingResponse(
+        audio_stream,
+        media_type=get_media_type(audio_format),
+        headers={
+            "Content-Disposition": f'attachment; filename="music_{result_id}.{extension}"',
+            "Vary": "Accept",  # 同一个地址会根据Accept返回不同的格式
+        }
+    )
+
+
+class JobResponse(BaseModel):
+    job_id: str = Field(..., description="任务ID")
+    status: Literal["queued", "running", "completed", "failed"] = Field(..., description="任务状态")
+    events_url: str = Field(..., description="任务事件流地址，支持通过Last-Event-ID断线续传")
+    audio_url: str = Field(..., description="任务完成后获取音频文件的地址")
+
+
+def job_response(record: JobRecord) -> JobResponse:
+    return JobResponse(
+        job_id=record.job_id,
+        status=record.status,
+        events_url=f"/api/v1/jobs/{record.job_id}/events",
+        audio_url=f"/api/v1/jobs/{record.job_id}/audio"
+    )
+
+
+@app.post(
+    "/api/v1/jobs",
+    summary="Http Submit Music Job",
+    description="提交异步音乐生成任务，立即返回任务ID，生成过程不受客户端连接影响",
+    status_code=202,
+    response_model=JobResponse,
+    responses={
+        400: {"description": "音乐生成参数错误"},
+        429: QUEUE_FULL_RESPONSE_EXAMPLE,
+        503: {"description": "未结束的任务过多"},
+    }
+)
+async def http_submit_music_job(request: Request, music_params: MusicGenerationRequest) -> Response:
+    """提交异步音乐生成任务
+
+    Args:
+        music_params: 音乐生成的参数
+
+    Returns:
+        任务ID及事件流、音频的获取地址
+    """
+    params = music_params.model_dump()
+    priority = params.pop("priority", 0) or 0
+    try:
+        record = job_manager.submit(params, client_id=get_client_id(request), priority=priority)
+    except AssertionError as e:
+        logger.exception(e)
+        return JSONResponse(content={"detail": "音乐生成参数错误"}, status_code=400)
+    except QueueFullError as e:
+        logger.warning(str(e))
+        return queue_full_response(e.retry_after)
+    except RuntimeError as e:
+        logger.warning(str(e))
+        return JSONResponse(content={"detail": "未结束的任务过多，请稍后重试"}, status_code=503)
+    return JSONResponse(content=job_response(record).model_dump(), status_code=202)
+
+
+@app.get(
+    "/api/v1/jobs/{job_id}",
+    summary="Http Get Music Job",
+    description="查询异步音乐生成任务的状态",
+    response_model=JobResponse,
+    responses={404: {"description": "任务不存在或已过期"}}
+)
+async def http_get_music_job(job_id: str) -> Response:
+    record = job_manager.get(job_id)
+    if record is None:
+        return JSONResponse(content={"detail": "Job not found or expired"}, status_code=404)
+    return JSONResponse(content=job_response(record).model_dump())
+
+
+async def job_event_stream(record: JobRecord, last_event_id: Optional[int]) -> AsyncGenerator[str, None]:
+    """任务事件流，每个事件带有ID，客户端重连时从Last-Event-ID之后的事件继续发送"""
+    loop = asyncio.get_running_loop()
+    async for item in job_manager.iter_events(record, last_event_id):
+        if item is None:
+            # SSE注释行作为心跳，防止代理断开空闲连接
+            yield ": keep-alive\n\n"
+            continue
+        event_id, event = item
+        # 音频片段从磁盘读取，不阻塞事件循环
+        event = await loop.run_in_executor(None, record.load_event, event)
+        if event is None:
+            continue
+        event_data = EventStreamResponse(**event)
+        yield f"id: {event_id}\ndata: {json.dumps(event_data.model_dump(exclude_none=True))}\n\n"
+
+
+@app.get(
+    "/api/v1/jobs/{job_id}/events",
+    summary="Http Music Job Events",
+    description="获取异步音乐生成任务的事件流，断线后通过Last-Event-ID继续接收",
+    response_class=StreamingResponse,
+    responses={200: SUCCESS_RESPONSE_EXAMPLE, 404: {"description": "任务不存在或已过期"}}
+)
+async def http_music_job_events(
+    job_id: str,
+    last_event_id: Optional[str] = Header(None, description="已收到的最后一个事件ID", alias="Last-Event-ID"),
+) -> Response:
+    """获取异步音乐生成任务的事件流
+
+    Args:
+        job_id: 任务ID
+        last_event_id: 已收到的最后一个事件ID，首次连接时不需要
+
+    Returns:
+        流式事件响应，事件与/api/v1/generate_music相同，任务结束后断开连接
+    """
+    record = job_manager.get(job_id)
+    if record is None:
+        return JSONResponse(content={"detail": "Job not found or expired"}, status_code=404)
+    resume_from = int(last_event_id) if last_event_id is not None and last_event_id.isdigit() else None
+    return StreamingResponse(
+        job_event_stream(record, resume_from),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no",
+            "Access-Control-Allow-Origin": "*"
+        }
+    )
+
+
+@app.get(
+    "/api/v1/jobs/{job_id}/audio",
+    summary="Http Get Music Job Audio",
+    description="获取异步音乐生成任务的音频文件，根据Accept返回WAV、FLAC或Opus格式",
+    response_class=StreamingResponse,
+    responses={**AUDIO_RESPONSES_EXAMPLE, 409: {"description": "任务尚未完成或生成失败"}}
+)
+async def http_get_music_job_audio(
+    job_id: str,
+    accept: Optional[str] = Header(None, description="audio/wav、audio/flac或audio/ogg(Opus)，默认为audio/wav", alias="Accept"),
+) -> Response:
+    record = job_manager.get(job_id)
+    if record is None:
+        return JSONResponse(content={"detail": "Job not found or expired"}, status_code=404)
+    if record.result_id is None:
+        return JSONResponse(content={"detail": f"Job is {record.status}"}, status_code=409)
+    return await audio_response(record.result_id, accept)
 
 
 def parse_arguments() -> argparse.Namespace:
@@ -232,6 +535,17 @@ def parse_arguments() -> argparse.Namespace:
     parser.add_argument("--host", type=str, default="0.0.0.0", help="服务监听地址，默认为0.0.0.0")
     parser.add_argument("--port", type=int, default=5555, help="服务监听端口，默认为5555")
     parser.add_argument("--music_model_name", type=str, default="facebook/musicgen-large", help="音乐生成模型名称，默认为facebook/musicgen-large")
+    parser.add_argument("--max_batch_size", type=int, default=4, help="单次解码合并的最大请求数，默认为4")
+    parser.add_argument("--batch_window", type=float, default=0.05, help="等待更多请求加入批次的时间(秒)，默认为0.05")
+    parser.add_argument("--max_queue_size", type=int, default=16, help="等待队列最多容纳的请求数，已满时返回429，默认为16")
+    parser.add_argument("--result_dir", type=str, default="output/results", help="生成结果的保存目录，默认为output/results")
+    parser.add_argument("--max_results", type=int, default=64, help="最多保留的同步请求生成结果数，异步任务的结果不计入其中，默认为64")
+    parser.add_argument("--result_ttl", type=float, default=600, help="生成结果和任务记录的保留时间(秒)，默认为600")
+    parser.add_argument("--max_jobs", type=int, default=256, help="最多保留的异步任务数，默认为256")
+    parser.add_argument("--job_dir", type=str, default="output/jobs", help="异步任务流式返回的音频片段的保存目录，默认为output/jobs")
+    parser.add_argument("--token_cache_dir", type=str, default="output/token_cache", help="指定了种子的请求生成的token的磁盘缓存目录，默认为output/token_cache")
+    parser.add_argument("--token_cache_items", type=int, default=128, help="内存中最多缓存的生成结果数，默认为128")
+    parser.add_argument("--token_cache_mb", type=int, default=1024, help="token磁盘缓存的最大容量(MB)，默认为1024")
     return parser.parse_args()
 
 
@@ -244,5 +558,17 @@ if __name__ == "__main__":
     # 初始化音乐大模型
     music_controller.init_music_model(args.music_model_name)
 
+    # 配置生成结果存储
+    ResultStore().configure(directory=args.result_dir, max_results=args.max_results, ttl=args.result_ttl)
+    job_manager.configure(max_jobs=args.max_jobs, ttl=args.result_ttl, directory=args.job_dir)
+
+    # 配置生成token缓存
+    TokenCache().configure(
+        directory=args.token_cache_dir, max_items=args.token_cache_items, max_bytes=args.token_cache_mb * 1024 * 1024)
+
+    # 启动批处理调度器
+    generation_scheduler.start(
+        max_batch_size=args.max_batch_size, batch_window=args.batch_window, max_queue_size=args.max_queue_size)
+
     import uvicorn
     uvicorn.run("main:app", host=args.host, port=args.port, log_config="uvicorn_config.json", log_level="info")
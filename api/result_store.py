@@ -0,0 +1,163 @@
+from loguru import logger
+
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+
+class ResultStore:
+    ''' 生成结果存储
+
+    把生成完成的原始音频数据保存在磁盘上，客户端通过结果ID获取音频，
+    断开连接的客户端重新连接后仍然可以取回结果。
+    结果最多保留max_results条，超过ttl秒的结果会被删除，服务启动时会清理目录中遗留的结果。
+    异步任务的结果通过pin固定，不计入容量也不会过期，由任务管理在清理任务记录时通过release删除。
+    '''
+
+    _instance: Optional['ResultStore'] = None
+
+    def __new__(cls):
+        ''' 单例模式 '''
+        if cls._instance is None:
+            cls._instance = super(ResultStore, cls).__new__(cls)
+            cls._instance._initialized = False
+        return cls._instance
+
+    def __init__(self):
+        if self._initialized:
+            return
+        self._initialized = True
+        self.directory: str = os.path.join("output", "results")
+        self.max_results: int = 64
+        self.ttl: float = 600.0
+        # 结果ID -> (创建时间, 采样率)，按创建时间排序
+        self._results: 'OrderedDict[str, Tuple[float, int]]' = OrderedDict()
+        # 被任务固定的结果ID -> 采样率
+        self._pinned: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def configure(self, directory: Optional[str] = None, max_results: int = 64, ttl: float = 600.0) -> None:
+        """设置存储目录、容量和结果保留时间，并清理目录中遗留的结果
+
+        Args:
+            directory (Optional[str]): 结果保存目录，默认为output/results
+            max_results (int): 最多保留的结果数
+            ttl (float): 结果保留时间（秒）
+        """
+        assert max_results >= 1 and ttl > 0
+        with self._lock:
+            if directory is not None:
+                self.directory = directory
+            self.max_results = max_results
+            self.ttl = ttl
+            os.makedirs(self.directory, exist_ok=True)
+            # 重启前的结果没有索引，无法判断是否过期，直接删除
+            for filename in os.listdir(self.directory):
+                if filename.endswith(".npy"):
+                    self._remove_file(filename[:-len(".npy")])
+            self._results.clear()
+            self._pinned.clear()
+        logger.info(f"Result store directory: {self.directory}, max results: {max_results}, ttl: {ttl}s")
+
+    def put(self, audio: np.ndarray, sampling_rate: int) -> str:
+        """保存一条生成结果
+
+        Args:
+            audio (np.ndarray): 音频数据，单声道为(samples,)，多声道为(channels, samples)
+            sampling_rate (int): 采样率
+
+        Returns:
+            str: 结果ID
+        """
+        result_id = uuid.uuid4().hex
+        os.makedirs(self.directory, exist_ok=True)
+        # 先写临时文件再重命名，避免读取到写了一半的文件
+        tmp_path = self._get_path(result_id) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.asarray(audio, dtype=np.float32))
+        os.replace(tmp_path, self._get_path(result_id))
+        with self._lock:
+            self._evict()
+            while len(self._results) >= self.max_results:
+                evicted_id, _ = self._results.popitem(last=False)
+                self._remove_file(evicted_id)
+                logger.warning(f"Result store is full, drop result {evicted_id}")
+            self._results[result_id] = (time.monotonic(), sampling_rate)
+        return result_id
+
+    def get(self, result_id: str) -> Optional[Tuple[np.ndarray, int]]:
+        """获取生成结果
+
+        Args:
+            result_id (str): 结果ID
+
+        Returns:
+            Optional[Tuple[np.ndarray, int]]: (音频数据, 采样率)，结果不存在或已过期时返回None
+        """
+        with self._lock:
+            self._evict()
+            if result_id in self._pinned:
+                sampling_rate = self._pinned[result_id]
+            elif result_id in self._results:
+                _, sampling_rate = self._results[result_id]
+            else:
+                return None
+        # 在锁外读取文件，避免读取大文件时阻塞其他请求
+        try:
+            audio = np.load(self._get_path(result_id))
+        except FileNotFoundError:
+            logger.warning(f"Result file of {result_id} is missing")
+            with self._lock:
+                self._results.pop(result_id, None)
+                self._pinned.pop(result_id, None)
+            return None
+        return audio, sampling_rate
+
+    def pin(self, result_id: str) -> bool:
+        """固定一条结果，使其不计入容量也不会过期，直到调用release
+
+        Args:
+            result_id (str): 结果ID
+
+        Returns:
+            bool: 结果已被清理时返回False
+        """
+        with self._lock:
+            self._evict()
+            result = self._results.pop(result_id, None)
+            if result is None:
+                return result_id in self._pinned
+            _, sampling_rate = result
+            self._pinned[result_id] = sampling_rate
+            return True
+
+    def release(self, result_id: str) -> None:
+        """删除一条结果，用于清理固定的结果"""
+        with self._lock:
+            self._results.pop(result_id, None)
+            self._pinned.pop(result_id, None)
+            self._remove_file(result_id)
+
+    def _get_path(self, result_id: str) -> str:
+        return os.path.join(self.directory, f"{result_id}.npy")
+
+    def _remove_file(self, result_id: str) -> None:
+        try:
+            os.remove(self._get_path(result_id))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self) -> None:
+        """清理过期的结果，调用时需要持有锁"""
+        deadline = time.monotonic() - self.ttl
+        while self._results:
+            result_id, (created_at, _) = next(iter(self._results.items()))
+            if created_at > deadline:
+                break
+            del self._results[result_id]
+            self._remove_file(result_id)
@@ -0,0 +1,265 @@
+from loguru import logger
+from controller import MusicController
+from audiocraft.utils.admission import GenerationTimeEstimator, QueueFullError, fair_order
+
+import time
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Optional, Callable, List, Dict, Any, Deque, Tuple
+
+# 超过模型最大时长的请求需要分段续写，同一批次内这些参数必须一致
+EXTENDED_BATCH_KEYS = ('duration', 'top_k', 'top_p', 'temperature', 'cfg_coef')
+
+_job_counter = itertools.count()
+
+
+@dataclass
+class GenerationJob:
+    ''' 调度器中的一条生成任务 '''
+    params: Dict[str, Any]
+    progress_callback: Optional[Callable[[float], None]] = None
+    audio_chunk_callback: Optional[Callable[[str, int], None]] = None
+    # 排队位置变化时调用，参数为排队位置（从0开始）和预计等待时间（秒）
+    queue_callback: Optional[Callable[[int, float], None]] = None
+    client_id: str = ""
+    priority: int = 0
+    seq: int = field(default_factory=lambda: next(_job_counter))
+    future: Future = field(default_factory=Future)
+    cancelled: threading.Event = field(default_factory=threading.Event)
+
+    def batch_key(self, max_duration: float) -> Tuple[Any, ...]:
+        """可以合并到同一批次的任务具有相同的batch_key
+
+        不超过max_duration的请求逐条使用自己的时长和采样参数，可以任意合并。
+        """
+        if self.params['duration'] <= max_duration:
+            return ('default',)
+        return ('extended',) + tuple(self.params[key] for key in EXTENDED_BATCH_KEYS)
+
+    def cancel(self) -> None:
+        """客户端断开时调用，未开始的任务会被丢弃，运行中的任务不再接收进度和结果"""
+        self.cancelled.set()
+
+
+class GenerationScheduler:
+    ''' 批处理生成调度器
+
+    收集等待中的生成请求，把它们合并成一次 LMModel.generate 批量解码，并把进度和结果分发回各自的请求。
+    每条请求可以使用不同的时长和采样参数，时长较短的请求生成完毕后即从批次中移除；
+    正在解码的批次结束后，期间到达的请求在下一个批次中加入。
+
+    等待队列最多容纳max_queue_size条请求，已满时拒绝新请求。队列按优先级排序（数值越小越优先），
+    同一优先级内在不同客户端之间轮转，同一客户端的请求按到达顺序排队，避免单个客户端占满队列。
+    排队顺序和等待时间的估计与Flask应用的准入队列共用，见audiocraft.utils.admission。
+    '''
+
+    _instance: Optional['GenerationScheduler'] = None
+
+    def __new__(cls):
+        ''' 单例模式 '''
+        if cls._instance is None:
+            cls._instance = super(GenerationScheduler, cls).__new__(cls)
+            cls._instance._initialized = False
+        else:
+            logger.warning("GenerationScheduler already initialized")
+        return cls._instance
+
+    def __init__(self):
+        if self._initialized:
+            return
+        self._initialized = True
+        self.music_controller = MusicController()
+        self.max_batch_size: int = 4
+        self.batch_window: float = 0.05
+        self.max_queue_size: int = 16
+        self._pending: Deque[GenerationJob] = deque()
+        self._condition = threading.Condition()
+        self._worker: Optional[threading.Thread] = None
+        # 批次耗时的统计，用于估计排队时间
+        self._batch_timer = GenerationTimeEstimator()
+
+    def start(self, max_batch_size: int = 4, batch_window: float = 0.05, max_queue_size: int = 16) -> None:
+        """启动后台调度线程
+
+        Args:
+            max_batch_size (int): 单个批次最多合并的请求数
+            batch_window (float): 收到第一个请求后等待更多请求加入批次的时间（秒）
+            max_queue_size (int): 等待队列最多容纳的请求数
+        """
+        assert max_batch_size >= 1 and batch_window >= 0 and max_queue_size >= 1
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.max_queue_size = max_queue_size
+        if self._worker is not None and self._worker.is_alive():
+            return
+        self._worker = threading.Thread(target=self._run, name="generation-scheduler", daemon=True)
+        self._worker.start()
+        logger.info(f"Generation scheduler started, max batch size: {max_batch_size}, batch window: {batch_window}s, "
+                    f"max queue size: {max_queue_size}")
+
+    def submit(
+        self,
+        params: Dict[str, Any],
+        progress_callback: Optional[Callable[[float], None]] = None,
+        audio_chunk_callback: Optional[Callable[[str, int], None]] = None,
+        queue_callback: Optional[Callable[[int, float], None]] = None,
+        client_id: str = "",
+        priority: int = 0
+        ) -> GenerationJob:
+        """提交一条生成请求
+
+        Args:
+            params (Dict[str, Any]): 音乐生成参数，见MusicController.validate_params
+            progress_callback: 进度回调函数，在调度线程中调用
+            audio_chunk_callback: 音频片段回调函数，参数为Base64编码的PCM数据和采样率，在调度线程中调用
+            queue_callback: 排队位置回调函数，参数为排队位置（从0开始）和预计等待时间（秒）
+            client_id (str): 客户端标识，用于在客户端之间公平排队
+            priority (int): 优先级，数值越小越优先
+
+        Returns:
+            GenerationJob: 任务句柄，结果为生成结果ID，通过job.future获取
+
+        Raises:
+            AssertionError: 参数不合法
+            QueueFullError: 等待队列已满
+        """
+        job = GenerationJob(
+            self.music_controller.validate_params(params),
+            progress_callback=progress_callback,
+            audio_chunk_callback=audio_chunk_callback,
+            queue_callback=queue_callback,
+            client_id=client_id,
+            priority=priority
+        )
+        with self._condition:
+            self._drop_cancelled()
+            if len(self._pending) >= self.max_queue_size:
+                raise QueueFullError(self._batch_timer.estimate_retry_after())
+            self._pending.append(job)
+            self._condition.notify()
+        self._notify_queue_positions()
+        return job
+
+    def is_full(self) -> bool:
+        """等待队列是否已满"""
+        with self._condition:
+            self._drop_cancelled()
+            return len(self._pending) >= self.max_queue_size
+
+    def estimate_retry_after(self) -> int:
+        """估计等待队列空出位置的时间（秒）"""
+        with self._condition:
+            return self._batch_timer.estimate_retry_after()
+
+    def _drop_cancelled(self) -> None:
+        """移除已取消的等待任务，调用时需要持有锁"""
+        if any(job.cancelled.is_set() for job in self._pending):
+            self._pending = deque(job for job in self._pending if not job.cancelled.is_set())
+
+    def _ordered_pending(self) -> List[GenerationJob]:
+        """按调度顺序返回等待中的任务，调用时需要持有锁
+
+        先按优先级排序，同一优先级内在不同客户端之间轮转，同一客户端的请求按到达顺序排序。
+        """
+        return fair_order(job for job in self._pending if not job.cancelled.is_set())
+
+    def _notify_queue_positions(self) -> None:
+        """把排队位置和预计等待时间通知给所有等待中的任务"""
+        with self._condition:
+            ordered = self._ordered_pending()
+            estimated_waits = [self._batch_timer.estimate_wait(position // self.max_batch_size)
+                               for position in range(len(ordered))]
+        for position, (job, estimated_wait) in enumerate(zip(ordered, estimated_waits)):
+            if job.queue_callback is None:
+                continue
+            try:
+                job.queue_callback(position, estimated_wait)
+            except Exception as e:
+                logger.exception(e)
+
+    def _collect_batch(self) -> List[GenerationJob]:
+        """从等待队列中取出一个批次，只合并与队首任务兼容的任务，其余任务保持原有顺序"""
+        with self._condition:
+            while True:
+                self._drop_cancelled()
+                if self._pending:
+                    break
+                self._condition.wait()
+
+            # 给同时到达的请求一个加入批次的机会
+            deadline = time.monotonic() + self.batch_window
+            while len(self._pending) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            max_duration = self.music_controller.get_max_duration()
+            ordered = self._ordered_pending()
+            if not ordered:
+                return []
+            key = ordered[0].batch_key(max_duration)
+            batch: List[GenerationJob] = []
+            for job in ordered:
+                if len(batch) < self.max_batch_size and job.batch_key(max_duration) == key:
+                    batch.append(job)
+            batch_ids = set(id(job) for job in batch)
+            self._pending = deque(job for job in self._pending if id(job) not in batch_ids)
+            self._batch_timer.start()
+            return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect_batch()
+            if not batch:
+                continue
+            self._notify_queue_positions()
+            try:
+                self._run_batch(batch)
+            finally:
+                with self._condition:
+                    self._batch_timer.finish()
+                self._notify_queue_positions()
+
+    def _run_batch(self, batch: List[GenerationJob]) -> None:
+        logger.info(f"Run generation batch, batch size: {len(batch)}")
+
+        def progress_callback(percentage: float):
+            alive_jobs = [job for job in batch if not job.cancelled.is_set()]
+            if not alive_jobs:
+                # 批次内所有客户端都已断开，没有必要继续占用GPU
+                raise InterruptedError("All jobs in batch are cancelled, stop generation")
+            for job in alive_jobs:
+                if job.progress_callback is not None:
+                    job.progress_callback(percentage)
+
+        def audio_chunk_callback(idx: int, audio_chunk: str, sampling_rate: int):
+            job = batch[idx]
+            if not job.cancelled.is_set() and job.audio_chunk_callback is not None:
+                job.audio_chunk_callback(audio_chunk, sampling_rate)
+
+        try:
+            results = self.music_controller.generate_music_batch_with_progress(
+                [job.params for job in batch],
+                progress_callback=progress_callback,
+                audio_chunk_callback=audio_chunk_callback
+            )
+        except InterruptedError:
+            logger.info("Generation batch interrupted, all clients disconnected")
+            for job in batch:
+                job.future.cancel()
+            return
+        except Exception as e:
+            logger.exception(e)
+            for job in batch:
+                job.future.set_exception(e)
+            return
+
+        for job, audio_data in zip(batch, results):
+            if job.cancelled.is_set():
+                job.future.cancel()
+            else:
+                job.future.set_result(audio_data)
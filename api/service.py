@@ -1,4 +1,5 @@
 from loguru import logger
+from token_cache import TokenCache
 from audiocraft.models.encodec import InterleaveStereoCompressionModel
 from audiocraft.models import MusicGen, MultiBandDiffusion
 
@@ -6,13 +7,72 @@ import torch
 import time
 import numpy as np
 from einops import rearrange
-from typing import Optional, Callable
+from typing import Optional, Callable, List, Dict, Any
+
+
+class IncrementalAudioDecoder:
+    ''' 增量音频解码器
+
+    逐步接收LM生成完成的token帧，每积累chunk_frames帧就用压缩模型的流式解码器解码一次，
+    各个片段拼接后与一次性解码整段token的结果一致。
+    同一批次的多个解码器共享同一个压缩模型，每个解码器各自保存流式解码状态。
+    '''
+
+    def __init__(self, model: MusicGen, chunk_frames: int):
+        self.model = model
+        self.chunk_frames = chunk_frames
+        self.codes: List[torch.Tensor] = []
+        self.pending_frames = 0
+        self.state: Dict[str, torch.Tensor] = {}
+
+    def push(self, codes: torch.Tensor) -> Optional[torch.Tensor]:
+        """追加新的token帧
+
+        Args:
+            codes (torch.Tensor): 新生成的token帧，形状为(1, K, n)
+
+        Returns:
+            Optional[torch.Tensor]: 积累到chunk_frames帧后返回解码出的音频片段(channels, samples)，否则返回None
+        """
+        self.codes.append(codes)
+        self.pending_frames += codes.shape[-1]
+        if self.pending_frames < self.chunk_frames:
+            return None
+        return self._decode()
+
+    def flush(self) -> Optional[torch.Tensor]:
+        """解码剩余的全部token帧，返回音频的最后一段"""
+        return self._decode(flush=True)
+
+    def _decode(self, flush: bool = False) -> Optional[torch.Tensor]:
+        compression_model = self.model.compression_model
+        audio_chunks: List[torch.Tensor] = []
+        # 与generate_audio一样在关闭autocast的情况下解码，保证结果一致
+        with torch.no_grad(), torch.autocast(device_type=self.model.device.type, enabled=False), \
+                compression_model.streaming():
+            compression_model.set_streaming_state(self.state)
+            if self.codes:
+                audio_chunks.append(compression_model.decode(torch.cat(self.codes, dim=-1), None))
+            if flush:
+                audio_end = compression_model.flush_decode()
+                if audio_end is not None:
+                    audio_chunks.append(audio_end)
+            self.state = compression_model.get_streaming_state()
+        self.codes = []
+        self.pending_frames = 0
+        if not audio_chunks:
+            return None
+        return torch.cat(audio_chunks, dim=-1)[0]
+
 
 class MusicGenService:
     ''' 音乐生成服务 '''
 
     _instance: Optional['MusicGenService'] = None
 
+    # 流式返回音频时每个片段的时长(秒)
+    AUDIO_CHUNK_DURATION: float = 1.0
+
     def __new__(cls):
         ''' 单例模式 '''
         if cls._instance is None:
@@ -27,8 +87,12 @@ class MusicGenService:
         if not torch.cuda.is_available():
             raise RuntimeError("CUDA is not available")
 
+        self.model_name = model_name
         self.model = MusicGen.get_pretrained(model_name)
+        # 缓存文本条件的T5编码结果，重复的描述和无分类器指导使用的空描述不再经过T5
+        self.model.lm.condition_provider.enable_text_cache()
         self.mbd_model = MultiBandDiffusion.get_mbd_musicgen()
+        self.token_cache = TokenCache()
     
     def enhance_user_prompt(self, user_prompt: str) -> str:
         # client = OpenAI(api_key=os.environ.get("o_key"))
@@ -53,6 +117,7 @@ class MusicGenService:
         top_p: float = 0.0, 
         temperature: float = 1.0, 
         cfg_coef: float = 3.0,
+        seed: Optional[int] = None,
         progress_callback: Optional[Callable[[float], None]] = None
         ) -> tuple[np.ndarray, int]:
         """生成音频数据
@@ -65,6 +130,7 @@ class MusicGenService:
             top_p (float, optional): top-p采样参数. Defaults to 0.0.
             temperature (float, optional): 温度参数. Defaults to 1.0.
             cfg_coef (float, optional): 无分类器指导系数. Defaults to 3.0.
+            seed (int, optional): 随机种子，指定后生成结果可复现并会被缓存. Defaults to None.
             progress_callback: 音乐处理中的回调函数. Defaults to None.
 
         Returns:
@@ -74,61 +140,235 @@ class MusicGenService:
             InterruptedError: 当生成过程被用户中断时抛出
             Exception: 其他生成过程中的错误
         """
-        logger.info("Generate audio start")
+        request = {
+            'description': user_prompt,
+            'mbd': mbd,
+            'duration': duration,
+            'top_k': top_k,
+            'top_p': top_p,
+            'temperature': temperature,
+            'cfg_coef': cfg_coef,
+            'seed': seed,
+            'stream_audio': False,
+        }
+        return self.generate_music_batch([request], progress_callback=progress_callback)[0]
+
+    @property
+    def max_duration(self) -> float:
+        """模型单次解码支持的最大时长(秒)，更长的音频需要分段续写"""
+        return self.model.max_duration
+
+    @property
+    def sample_rate(self) -> int:
+        """生成音频的采样率"""
+        return self.model.sample_rate
+
+    def generate_music_batch(
+        self,
+        requests: List[Dict[str, Any]],
+        progress_callback: Optional[Callable[[float], None]] = None,
+        audio_chunk_callback: Optional[Callable[[int, np.ndarray], None]] = None
+        ) -> List[tuple[np.ndarray, int]]:
+        """在一次LM解码中批量生成多个请求的音频数据
+
+        时长不超过max_duration的请求可以各自使用不同的时长和采样参数，时长较短的请求
+        生成完毕后会从批次中移除；超过max_duration的请求需要分段续写，同一批次内
+        必须具有相同的时长和采样参数（由调度器保证）。
+
+        设置了stream_audio的请求在生成过程中会通过audio_chunk_callback增量返回音频片段，
+        仅支持不超过max_duration且不使用mbd的请求。
+
+        指定了seed的请求使用各自的随机数生成器采样，生成的token按模型、描述、采样参数、时长和种子缓存，
+        命中缓存的请求不参与LM解码，只用压缩模型解码音频；所有请求都命中时完全跳过LM。
+
+        Args:
+            requests (List[Dict[str, Any]]): 已校验的请求参数列表，字段同generate_music
+            progress_callback: 整个批次共享的进度回调函数. Defaults to None.
+            audio_chunk_callback: 音频片段回调函数，参数为请求在批次中的序号和音频片段. Defaults to None.
+
+        Returns:
+            List[tuple]: 与requests一一对应的(audio_tensor, sample_rate)
+
+        Raises:
+            InterruptedError: 当回调要求中断整个批次时抛出
+        """
+        assert len(requests) > 0
+        logger.info(f"Generate audio batch start, batch size: {len(requests)}")
         start_time = time.time()
 
         def progress_handler(generated, to_generate):
             percentage = (generated/to_generate)*100
-            logger.info(f"generate music progress: {percentage:.2f}%")
+            logger.info(f"generate music batch progress: {percentage:.2f}%")
             if progress_callback:
                 progress_callback(percentage)
 
-        self.model.set_custom_progress_callback(progress_handler)
+        descriptions = [self.enhance_user_prompt(request['description']) for request in requests]
 
+        # 查询token缓存，未命中的请求交给LM解码
+        cache_keys = [
+            self.token_cache.make_key(self.model_name, dict(request, description=description))
+            for request, description in zip(requests, descriptions)
+        ]
+        token_list: List[Optional[torch.Tensor]] = [
+            None if key is None else self.token_cache.get(key) for key in cache_keys
+        ]
+        pending = [idx for idx, tokens in enumerate(token_list) if tokens is None]
+        if len(pending) < len(requests):
+            logger.info(f"Token cache hit: {len(requests) - len(pending)}/{len(requests)}")
+
+        # 命中缓存但需要流式返回音频的请求，在LM解码前按片段解码并依次返回
+        if audio_chunk_callback is not None:
+            chunk_frames = int(self.AUDIO_CHUNK_DURATION * self.model.frame_rate)
+            for idx, request in enumerate(requests):
+                if idx in pending or not self._can_stream(request):
+                    continue
+                decoder = IncrementalAudioDecoder(self.model, chunk_frames)
+                request_tokens = token_list[idx].to(self.model.device)
+                for start in range(0, request_tokens.shape[-1], chunk_frames):
+                    audio_chunk = decoder.push(request_tokens[..., start:start + chunk_frames])
+                    if audio_chunk is not None:
+                        audio_chunk_callback(idx, self._to_numpy(audio_chunk))
+                audio_chunk = decoder.flush()
+                if audio_chunk is not None:
+                    audio_chunk_callback(idx, self._to_numpy(audio_chunk))
+
+        if pending:
+            def _sub_chunk_callback(sub_idx: int, audio_chunk: np.ndarray):
+                assert audio_chunk_callback is not None
+                audio_chunk_callback(pending[sub_idx], audio_chunk)
+
+            generated = self._generate_tokens(
+                [requests[idx] for idx in pending],
+                [descriptions[idx] for idx in pending],
+                progress_handler,
+                _sub_chunk_callback if audio_chunk_callback is not None else None
+            )
+            for idx, request_tokens in zip(pending, generated):
+                token_list[idx] = request_tokens
+                if cache_keys[idx] is not None:
+                    self.token_cache.put(cache_keys[idx], request_tokens)
+        else:
+            progress_handler(1, 1)
+
+        device = self.model.device
+        token_list = [request_tokens.to(device) for request_tokens in token_list]
+
+        results = []
+        for request, request_tokens in zip(requests, token_list):
+            if request['mbd']:
+                audio_tensor = self._tokens_to_mbd_wav(request_tokens)[0]
+            else:
+                audio_tensor = self.model.generate_audio(request_tokens)[0]
+            results.append((self._to_numpy(audio_tensor), self.model.sample_rate))
+
+        logger.info(f"Generate audio batch completed, elapsed time: {time.time() - start_time:.2f} seconds, "
+                    f"text cache: {self.model.lm.condition_provider.text_cache_stats()}")
+        return results
+
+    def _can_stream(self, request: Dict[str, Any]) -> bool:
+        return request['stream_audio'] and not request['mbd'] and request['duration'] <= self.max_duration
+
+    def _make_generators(self, requests: List[Dict[str, Any]]) -> Optional[List[Optional[torch.Generator]]]:
+        """为指定了seed的请求创建各自的随机数生成器，使结果与同一批次中的其他请求无关"""
+        if all(request.get('seed') is None for request in requests):
+            return None
+        generators: List[Optional[torch.Generator]] = []
+        for request in requests:
+            if request.get('seed') is None:
+                generators.append(None)
+            else:
+                generators.append(torch.Generator(device=self.model.device).manual_seed(request['seed']))
+        return generators
+
+    def _generate_tokens(
+        self,
+        requests: List[Dict[str, Any]],
+        descriptions: List[str],
+        progress_handler: Callable[[int, int], None],
+        audio_chunk_callback: Optional[Callable[[int, np.ndarray], None]] = None
+        ) -> List[torch.Tensor]:
+        """使用LM批量生成token
+
+        Returns:
+            List[torch.Tensor]: 与requests一一对应的token，形状为(1, K, T)
+        """
+        generators = self._make_generators(requests)
+
+        if all(request['duration'] <= self.max_duration for request in requests):
+            # 每条请求使用各自的时长和采样参数，共享同一次LM解码
+            gen_lens = [int(request['duration'] * self.model.frame_rate) for request in requests]
+
+            # 需要流式返回音频的请求，各自使用一个增量解码器
+            decoders: Dict[int, IncrementalAudioDecoder] = {}
+            if audio_chunk_callback is not None:
+                chunk_frames = int(self.AUDIO_CHUNK_DURATION * self.model.frame_rate)
+                decoders = {
+                    idx: IncrementalAudioDecoder(self.model, chunk_frames)
+                    for idx, request in enumerate(requests) if self._can_stream(request)
+                }
+
+            def frame_handler(codes: torch.Tensor, start: int):
+                for idx, decoder in decoders.items():
+                    end = min(start + codes.shape[-1], gen_lens[idx])
+                    if end <= start:
+                        continue
+                    audio_chunk = decoder.push(codes[idx:idx + 1, :, :end - start])
+                    if audio_chunk is not None:
+                        audio_chunk_callback(idx, self._to_numpy(audio_chunk))
+
+            self.model.set_custom_progress_callback(progress_handler)
+            self.model.set_generation_params(use_sampling=True, generator=generators)
+            token_list = self.model.generate_tokens(
+                descriptions,
+                durations=[request['duration'] for request in requests],
+                progress=True,
+                frame_callback=frame_handler if decoders else None,
+                temperature=[float(request['temperature']) for request in requests],
+                top_k=[request['top_k'] for request in requests],
+                top_p=[float(request['top_p']) for request in requests],
+                cfg_coef=[float(request['cfg_coef']) for request in requests]
+            )
+            for idx, decoder in decoders.items():
+                audio_chunk = decoder.flush()
+                if audio_chunk is not None:
+                    audio_chunk_callback(idx, self._to_numpy(audio_chunk))
+            return token_list
+
+        self.model.set_custom_progress_callback(progress_handler)
+        first = requests[0]
         self.model.set_generation_params(
-            top_k = top_k,
-            top_p = top_p,
-            temperature = temperature,
-            duration = duration,
-            cfg_coef = cfg_coef
+            top_k = first['top_k'],
+            top_p = first['top_p'],
+            temperature = first['temperature'],
+            duration = first['duration'],
+            cfg_coef = first['cfg_coef'],
+            generator = generators
         )
-        
-        enhanced_prompt = self.enhance_user_prompt(user_prompt)
-        logger.info(f"Enhanced prompt : {enhanced_prompt}")
-
-        outputs = self.model.generate(
-            descriptions=[enhanced_prompt],
+        _, tokens = self.model.generate(
+            descriptions=descriptions,
             progress=True,
-            return_tokens=mbd
+            return_tokens=True
         )
+        return [tokens[idx:idx + 1] for idx in range(len(requests))]
 
-        if mbd:
-            tokens = outputs[1]
-            if isinstance(self.model.compression_model, InterleaveStereoCompressionModel):
-                left, right = self.model.compression_model.get_left_right_codes(tokens)
-                tokens = torch.cat([left, right])
-            outputs_diffusion = self.mbd_model.tokens_to_wav(tokens)
-            if isinstance(self.model.compression_model, InterleaveStereoCompressionModel):
-                assert outputs_diffusion.shape[1] == 1  # output is mono
-                outputs_diffusion = rearrange(outputs_diffusion, '(s b) c t -> b (s c) t', s=2)
-            audio_tensor = torch.cat([outputs[0], outputs_diffusion], dim=0)
-        else:
-            audio_tensor = outputs[0]  # 只获取音频数据，不需要tokens
-        
+    def _tokens_to_mbd_wav(self, tokens: torch.Tensor) -> torch.Tensor:
+        """使用MultiBand Diffusion将tokens解码为音频, 形状为(batch, channels, samples)"""
+        if isinstance(self.model.compression_model, InterleaveStereoCompressionModel):
+            left, right = self.model.compression_model.get_left_right_codes(tokens)
+            tokens = torch.cat([left, right])
+        outputs_diffusion = self.mbd_model.tokens_to_wav(tokens)
+        if isinstance(self.model.compression_model, InterleaveStereoCompressionModel):
+            assert outputs_diffusion.shape[1] == 1  # output is mono
+            outputs_diffusion = rearrange(outputs_diffusion, '(s b) c t -> b (s c) t', s=2)
+        return outputs_diffusion
+
+    def _to_numpy(self, audio_tensor: torch.Tensor) -> np.ndarray:
+        """将(channels, samples)的音频张量转换为numpy数组，单声道压缩为1D数组"""
         # 确保音频数据格式正确并转换为numpy数组
-        audio_tensor = audio_tensor.detach().cpu()
-        
-        # 如果是批处理输出，只取第一个样本
-        if audio_tensor.dim() == 3:  # (batch, channels, samples)
-            audio_tensor = audio_tensor[0]  # 只取第一个样本，变成 (channels, samples)
-        
-        # 转换为numpy数组
-        audio_tensor = audio_tensor.numpy()
+        audio_numpy = audio_tensor.detach().cpu().numpy()
         
         # 如果是单声道，压缩为1D数组
-        if audio_tensor.shape[0] == 1:  # 如果是单声道
+        if audio_numpy.shape[0] == 1:  # 如果是单声道
             logger.info("Audio tensor squeeze")
-            audio_tensor = audio_tensor.squeeze()  # 移除多余的维度
-        
-        logger.info(f"Generate audio completed, elapsed time: {time.time() - start_time:.2f} seconds")
-        return audio_tensor, self.model.sample_rate
\ No newline at end of file
+            audio_numpy = audio_numpy.squeeze()  # 移除多余的维度
+        return audio_numpy
@@ -0,0 +1,185 @@
+from loguru import logger
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Any
+
+import numpy as np
+import torch
+
+# 决定生成token的参数，mbd和stream_audio只影响解码，不参与缓存键
+TOKEN_CACHE_KEYS = ('description', 'duration', 'top_k', 'top_p', 'temperature', 'cfg_coef', 'seed')
+
+
+class TokenCache:
+    ''' 生成token缓存
+
+    指定了随机种子的请求生成结果可以复现，相同的模型、描述、采样参数、时长和种子总是得到相同的token，
+    命中缓存时跳过LM解码，只需要用压缩模型解码音频。
+    分为两级：内存中的LRU缓存最多保留max_items条；磁盘缓存总大小不超过max_bytes，按最近使用时间淘汰，
+    服务重启后仍然有效。
+    '''
+
+    _instance: Optional['TokenCache'] = None
+
+    def __new__(cls):
+        ''' 单例模式 '''
+        if cls._instance is None:
+            cls._instance = super(TokenCache, cls).__new__(cls)
+            cls._instance._initialized = False
+        return cls._instance
+
+    def __init__(self):
+        if self._initialized:
+            return
+        self._initialized = True
+        self.directory: Optional[str] = None
+        self.max_items: int = 128
+        self.max_bytes: int = 1 << 30
+        self.hits: int = 0
+        self.misses: int = 0
+        self._memory: 'OrderedDict[str, torch.Tensor]' = OrderedDict()
+        # 缓存键 -> 文件大小，按最近使用时间排序
+        self._files: 'OrderedDict[str, int]' = OrderedDict()
+        self._total_bytes: int = 0
+        self._lock = threading.Lock()
+
+    def configure(self, directory: Optional[str] = None, max_items: int = 128, max_bytes: int = 1 << 30) -> None:
+        """设置缓存容量，并加载磁盘缓存的索引
+
+        Args:
+            directory (Optional[str]): 磁盘缓存目录，为None时只使用内存缓存
+            max_items (int): 内存缓存最多保留的条数，为0时不使用内存缓存
+            max_bytes (int): 磁盘缓存的最大总字节数
+        """
+        assert max_items >= 0 and max_bytes >= 0
+        with self._lock:
+            self.directory = directory
+            self.max_items = max_items
+            self.max_bytes = max_bytes
+            self._memory.clear()
+            self._files.clear()
+            self._total_bytes = 0
+            if directory is not None:
+                os.makedirs(directory, exist_ok=True)
+                entries = []
+                for filename in os.listdir(directory):
+                    path = os.path.join(directory, filename)
+                    if filename.endswith(".tmp"):
+                        os.remove(path)
+                    elif filename.endswith(".npy"):
+                        stat = os.stat(path)
+                        entries.append((stat.st_mtime, filename[:-len(".npy")], stat.st_size))
+                # 文件的修改时间即最近使用时间
+                for _, key, size in sorted(entries):
+                    self._files[key] = size
+                    self._total_bytes += size
+                self._evict_files()
+        logger.info(f"Token cache directory: {directory}, max items: {max_items}, max bytes: {max_bytes}, "
+                    f"{len(self._files)} cached on disk")
+
+    @staticmethod
+    def make_key(model_name: str, params: Dict[str, Any]) -> Optional[str]:
+        """计算请求的缓存键，没有指定随机种子的请求不可复现，返回None
+
+        Args:
+            model_name (str): 模型名称
+            params (Dict[str, Any]): 已校验的请求参数
+        """
+        if params.get('seed') is None:
+            return None
+        content = json.dumps([model_name] + [params[key] for key in TOKEN_CACHE_KEYS], ensure_ascii=False)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[torch.Tensor]:
+        """获取缓存的token，未命中时返回None
+
+        Returns:
+            Optional[torch.Tensor]: 形状为(1, K, T)的token，位于CPU上
+        """
+        with self._lock:
+            tokens = self._memory.get(key)
+            if tokens is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return tokens
+            if key not in self._files:
+                self.misses += 1
+                return None
+            path = self._get_path(key)
+            try:
+                tokens = torch.from_numpy(np.load(path).astype(np.int64))
+                os.utime(path)
+            except (FileNotFoundError, ValueError) as e:
+                logger.warning(f"Failed to load cached tokens {key}: {e}")
+                self._total_bytes -= self._files.pop(key)
+                self.misses += 1
+                return None
+            self._files.move_to_end(key)
+            self._put_memory(key, tokens)
+            self.hits += 1
+            return tokens
+
+    def put(self, key: str, tokens: torch.Tensor) -> None:
+        """保存生成的token
+
+        Args:
+            key (str): make_key返回的缓存键
+            tokens (torch.Tensor): 形状为(1, K, T)的token
+        """
+        tokens = tokens.detach().cpu()
+        with self._lock:
+            self._put_memory(key, tokens)
+            if self.directory is None or key in self._files:
+                return
+        # 码本大小远小于32768，用int16保存以减少磁盘占用
+        array = tokens.numpy().astype(np.int16)
+        # 先写临时文件再重命名，避免读取到写了一半的文件
+        tmp_path = self._get_path(key) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, self._get_path(key))
+        with self._lock:
+            size = os.path.getsize(self._get_path(key))
+            self._files[key] = size
+            self._total_bytes += size
+            self._evict_files()
+
+    def stats(self) -> Dict[str, Any]:
+        """缓存命中统计"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'memory_items': len(self._memory),
+                'disk_items': len(self._files),
+                'disk_bytes': self._total_bytes,
+            }
+
+    def _get_path(self, key: str) -> str:
+        assert self.directory is not None
+        return os.path.join(self.directory, f"{key}.npy")
+
+    def _put_memory(self, key: str, tokens: torch.Tensor) -> None:
+        """放入内存缓存，超出容量时淘汰最久未使用的条目，调用时需要持有锁"""
+        if self.max_items == 0:
+            return
+        self._memory[key] = tokens
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def _evict_files(self) -> None:
+        """淘汰最久未使用的磁盘缓存直到总大小不超过max_bytes，调用时需要持有锁"""
+        while self._files and self._total_bytes > self.max_bytes:
+            key, size = self._files.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(self._get_path(key))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,116 @@
+import itertools
+import logging
+import threading
+from typing import List, Optional, Tuple
+
+from audiocraft.utils.admission import GenerationTimeEstimator, QueueFullError, fair_order
+
+logger = logging.getLogger(__name__)
+
+
+class Ticket:
+    """一条请求在准入队列中的排队凭证"""
+
+    def __init__(self, seq: int, client_id: str, priority: int):
+        self.seq = seq
+        self.client_id = client_id
+        self.priority = priority
+
+
+class AdmissionQueue:
+    """生成请求的准入队列
+
+    模型同一时间只能处理一个请求，其余请求在队列中等待，最多等待max_queue_size条，已满时拒绝新请求。
+    队列按优先级排序（数值越小越优先），同一优先级内在不同客户端之间轮转，同一客户端的请求按到达顺序排队。
+    排队顺序和等待时间的估计与FastAPI服务的批处理调度器共用，见audiocraft.utils.admission。
+    """
+
+    def __init__(self, max_queue_size: int = 16):
+        assert max_queue_size >= 1
+        self.max_queue_size = max_queue_size
+        self._waiting: List[Ticket] = []
+        self._running: Optional[Ticket] = None
+        self._condition = threading.Condition()
+        self._counter = itertools.count()
+        # 单次生成耗时的统计，用于估计排队时间
+        self._timer = GenerationTimeEstimator()
+
+    def acquire(self, client_id: str = "", priority: int = 0) -> Ticket:
+        """加入等待队列
+
+        Raises:
+            QueueFullError: 等待队列已满
+        """
+        with self._condition:
+            if len(self._waiting) >= self.max_queue_size:
+                raise QueueFullError(self._timer.estimate_retry_after())
+            ticket = Ticket(next(self._counter), client_id, priority)
+            self._waiting.append(ticket)
+            self._condition.notify_all()
+            return ticket
+
+    def wait_turn(self, ticket: Ticket, timeout: Optional[float] = None) -> Optional[Tuple[int, float]]:
+        """等待轮到该请求或排队位置变化
+
+        Args:
+            ticket (Ticket): 排队凭证
+            timeout (Optional[float]): 最长等待时间（秒）
+
+        Returns:
+            Optional[Tuple[int, float]]: 轮到该请求时返回None，否则返回(排队位置（从0开始）, 预计等待时间（秒）)
+        """
+        with self._condition:
+            if self._try_start(ticket):
+                return None
+            self._condition.wait(timeout)
+            if self._try_start(ticket):
+                return None
+            position = self._position(ticket)
+            return position, self._timer.estimate_wait(position)
+
+    def status(self, ticket: Ticket) -> Tuple[int, float]:
+        """返回(排队位置（从0开始）, 预计等待时间（秒）)"""
+        with self._condition:
+            position = self._position(ticket)
+            return position, self._timer.estimate_wait(position)
+
+    def release(self, ticket: Ticket) -> None:
+        """生成结束或客户端断开时调用，释放占用的位置"""
+        with self._condition:
+            if self._running is ticket:
+                self._running = None
+                self._timer.finish()
+            elif ticket in self._waiting:
+                self._waiting.remove(ticket)
+            self._condition.notify_all()
+
+    def is_full(self) -> bool:
+        """等待队列是否已满"""
+        with self._condition:
+            return len(self._waiting) >= self.max_queue_size
+
+    def is_idle(self) -> bool:
+        """没有正在生成和等待中的请求"""
+        with self._condition:
+            return self._running is None and not self._waiting
+
+    def estimate_retry_after(self) -> int:
+        """估计等待队列空出位置的时间（秒）"""
+        with self._condition:
+            return self._timer.estimate_retry_after()
+
+    def _position(self, ticket: Ticket) -> int:
+        """按调度顺序的排队位置，调用时需要持有锁"""
+        return fair_order(self._waiting).index(ticket)
+
+    def _try_start(self, ticket: Ticket) -> bool:
+        """轮到该请求时把它标记为正在生成，调用时需要持有锁"""
+        if self._running is ticket:
+            return True
+        if self._running is not None or self._position(ticket) != 0:
+            return False
+        self._waiting.remove(ticket)
+        self._running = ticket
+        self._timer.start()
+        self._condition.notify_all()
+        return True
@@ -1,7 +1,9 @@
 from .controller import MusicController
+from .admission import AdmissionQueue, QueueFullError
 
 from flask import Blueprint, request, jsonify, Response, stream_with_context, copy_current_request_context
 import json
+import time
 
 
 from queue import Queue, Empty
@@ -13,36 +15,66 @@ music_controller = MusicController()
 health_bp = Blueprint('health_bp', __name__)
 music_bp = Blueprint('music_bp', __name__)
 
-# 添加信号量来控制并发
-generation_lock = threading.Semaphore(1)
+# 准入队列，同一时间只生成一个请求，其余请求排队等待
+admission_queue = AdmissionQueue(max_queue_size=16)
+
+
+def queue_full_response(retry_after: int):
+    """等待队列已满时返回429，并通过Retry-After告知客户端重试时间"""
+    response = jsonify({"status": "busy", "error": "Generation queue is full"})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def queued_event(position: int, estimated_wait: float) -> str:
+    data = {
+        "status": "queued",
+        "queue_position": position + 1,
+        "estimated_wait": round(estimated_wait, 1),
+        "estimated_start_time": round(time.time() + estimated_wait, 1)
+    }
+    return f'event: queued\ndata: {json.dumps(data)}\n\n'
+
 
 @health_bp.route('/healthcheck', methods=['GET'])
 def handle_healthcheck():
-    if not generation_lock.acquire(blocking=False):
-        return jsonify({"status": "busy"}), 503
-    generation_lock.release()  # 立即释放锁
+    # 只有等待队列已满时才认为服务繁忙
+    if admission_queue.is_full():
+        response = jsonify({"status": "busy"})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(admission_queue.estimate_retry_after())
+        return response
     return jsonify({"status": "healthy"}), 200
 
 @music_bp.route('/music', methods=['POST'])
 def handle_music_generation():
-    # 尝试获取锁
-    if not generation_lock.acquire(blocking=False):
-        return jsonify({"status": "busy"}), 503
-    
+    if not request.is_json:
+        return jsonify({"error": "Content-Type must be application/json"}), 400
+
+    if not request.json or not isinstance(request.json, dict):
+        return jsonify({"error": "Description is required."}), 400
+
+    # 复制请求数据
+    request_data = request.json.copy()
+    priority = request_data.pop('priority', 0)
+    if not isinstance(priority, int) or isinstance(priority, bool) or not 0 <= priority <= 9:
+        return jsonify({"error": "priority must be an integer between 0 and 9"}), 400
+    client_id = request.headers.get('X-Client-Id') or request.remote_addr or ""
+
+    # 加入等待队列，队列已满时拒绝请求
     try:
-        if not request.is_json:
-            return jsonify({"error": "Content-Type must be application/json"}), 400
-        
-        if not request.json or not isinstance(request.json, dict):
-            return jsonify({"error": "Description is required."}), 400
-        
-        # 复制请求数据
-        request_data = request.json.copy()
+        ticket = admission_queue.acquire(client_id=client_id, priority=priority)
+    except QueueFullError as e:
+        logger.warning(str(e))
+        return queue_full_response(e.retry_after)
 
+    try:
         # 创建进度队列和控制标志
         progress_queue = Queue()
         result_queue = Queue()
         should_stop = threading.Event()
+        generation_started = threading.Event()
         
         def progress_callback(percentage: float):
             if should_stop and should_stop.is_set():
@@ -54,7 +86,21 @@ def handle_music_generation():
             try:
                 # 发送开始信号
                 yield f'event: start\ndata: {json.dumps({"status": "started"})}\n\n'
-                
+
+                # 排队等待，排队位置变化时发送queued事件，每秒检查一次客户端连接状态
+                queue_status = admission_queue.wait_turn(ticket, timeout=0)
+                while queue_status is not None:
+                    yield queued_event(*queue_status)
+                    last_position = queue_status[0]
+                    while True:
+                        wsgi_input = request.environ.get('wsgi.input')
+                        if wsgi_input and getattr(wsgi_input, 'closed', False):
+                            logger.info("Client connection closed while queued")
+                            return
+                        queue_status = admission_queue.wait_turn(ticket, timeout=1.0)
+                        if queue_status is None or queue_status[0] != last_position:
+                            break
+
                 # 在后台线程中生成音频
                 @copy_current_request_context
                 def generate_audio():
@@ -71,12 +117,13 @@ def handle_music_generation():
                         if not should_stop.is_set():
                             result_queue.put(("error", str(e)))
                     finally:
-                        # 确保在音频生成完成后释放锁
-                        generation_lock.release()
+                        # 确保在音频生成完成后释放队列位置
+                        admission_queue.release(ticket)
                         
 
                 audio_thread = threading.Thread(target=generate_audio)
                 audio_thread.start()
+                generation_started.set()
                 
                 # 持续发送进度更新直到生成完成或连接断开
                 while audio_thread.is_alive():
@@ -115,6 +162,9 @@ def handle_music_generation():
             finally:
                 # 确保设置停止标志
                 should_stop.set()
+                # 生成线程没有启动时由这里释放队列位置
+                if not generation_started.is_set():
+                    admission_queue.release(ticket)
                 
 
         return Response(
@@ -123,6 +173,6 @@ def handle_music_generation():
         )
         
     except Exception as e:
-        # 确保在发生异常时释放锁
-        generation_lock.release()
+        # 确保在发生异常时释放队列位置
+        admission_queue.release(ticket)
         return jsonify({"error": str(e)}), 500
\ No newline at end of file
@@ -7,4 +7,4 @@
 or also including some metadata."""
 
 # flake8: noqa
-from . import audio, audio_dataset, info_audio_dataset, music_dataset, sound_dataset, jasco_dataset
+from . import audio, audio_dataset, info_audio_dataset, music_dataset, sound_dataset, jasco_dataset, token_dataset
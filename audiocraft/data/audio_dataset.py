@@ -9,19 +9,23 @@ without having to scan again the folders, we precompute some metadata
 """
 import argparse
 import copy
-from concurrent.futures import ThreadPoolExecutor, Future
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
+from collections import deque
 from dataclasses import dataclass, fields
 from contextlib import ExitStack
 from functools import lru_cache
 import gzip
 import json
 import logging
+import math
 import os
 from pathlib import Path
 import random
 import sys
+import tempfile
 import typing as tp
 
+import numpy as np
 import torch
 import torch.nn.functional as F
 
@@ -201,6 +205,141 @@ def find_audio_files(path: tp.Union[Path, str],
     return meta
 
 
+def _resolve_path(path: str) -> str:
+    """Resolve a potentially relative path as `_resolve_audio_meta` does."""
+    if dora and not os.path.isabs(path):
+        return dora.git_save.to_absolute_path(path)
+    return path
+
+
+def _read_manifest_stats(path: tp.Union[str, Path], spool: tp.BinaryIO,
+                         key_fn: tp.Callable[[str], str]) -> tp.Dict[str, tp.Tuple[int, float, int]]:
+    """Read a manifest written by `build_audio_manifest`, returning for each audio file the size
+    and modification time recorded when scanning it, along with the offset of its entry in `spool`,
+    to which the uncompressed manifest is copied, so that only the entries to reuse are loaded.
+    """
+    stats = {}
+    open_fn = gzip.open if str(path).lower().endswith('.gz') else open
+    with open_fn(path, 'rb') as fp:  # type: ignore
+        for line in fp:
+            d = json.loads(line)
+            if 'file_size' in d and 'file_mtime' in d:
+                stats[key_fn(d['path'])] = (d['file_size'], d['file_mtime'], spool.tell())
+                spool.write(line.rstrip(b'\n') + b'\n')
+    return stats
+
+
+def build_audio_manifest(path: tp.Union[Path, str],
+                         output_meta_file: tp.Union[Path, str],
+                         exts: tp.List[str] = DEFAULT_EXTS,
+                         resolve: bool = True,
+                         minimal: bool = True,
+                         workers: int = 10,
+                         previous_meta_file: tp.Optional[tp.Union[Path, str]] = None,
+                         progress: bool = False) -> int:
+    """Scan a folder for audio files and write their AudioMeta to a manifest, optionally compressed.
+
+    Contrary to `find_audio_files`, the audio files are opened in a pool of processes and the entries
+    are written as soon as they are available, in the order the files are found, so that the memory stays flat
+    for large libraries. Each entry also records the size and modification time of the file, so that a later
+    scan given this manifest as `previous_meta_file` reuses the entries of the files that did not change.
+    The extra fields are ignored when loading the manifest.
+
+    Args:
+        path (str or Path): Path to folder containing audio files.
+        output_meta_file (str or Path): Manifest to write, as .jsonl or .jsonl.gz.
+        exts (list of str): List of file extensions to consider for audio files.
+        resolve (bool): Whether to resolve the path from AudioMeta.
+        minimal (bool): Whether to only load the minimal set of metadata (takes longer if not).
+        workers (int): Number of processes opening the audio files, if 0, use only the current process.
+        previous_meta_file (str or Path, optional): Manifest of a previous scan to reuse entries from.
+        progress (bool): Whether to log progress on audio files collection.
+    Returns:
+        int: Number of audio files written to the manifest.
+    """
+    def _key(file_path: str) -> str:
+        # the manifest holds resolved paths, the walked paths are resolved the same way to match them.
+        return _resolve_path(file_path) if resolve else file_path
+
+    previous: tp.Dict[str, tp.Tuple[int, float, int]] = {}
+    spool: tp.Optional[tp.BinaryIO] = None
+    stack = ExitStack()
+    if previous_meta_file is not None and Path(previous_meta_file).exists():
+        spool = stack.enter_context(tempfile.TemporaryFile())
+        previous = _read_manifest_stats(previous_meta_file, spool, _key)
+        logger.info("Loaded %d entries from previous manifest %s", len(previous), previous_meta_file)
+
+    def _iter_files() -> tp.Iterator[tp.Tuple[str, int, float]]:
+        for root, folders, files in os.walk(path, followlinks=True):
+            for file in files:
+                full_path = Path(root) / file
+                if full_path.suffix.lower() in exts:
+                    try:
+                        stat = full_path.stat()
+                    except OSError as err:
+                        logger.warning("Error with %s: %r", full_path, err)
+                        continue
+                    yield str(full_path), stat.st_size, stat.st_mtime
+
+    output_meta_file = Path(output_meta_file)
+    output_meta_file.parent.mkdir(exist_ok=True, parents=True)
+    open_fn = gzip.open if str(output_meta_file).lower().endswith('.gz') else open
+    tmp_path = output_meta_file.with_name(f"{output_meta_file.name}.tmp.{os.getpid()}")
+    num_written = num_reused = num_errors = 0
+    # entries waiting to be written in order, either reused ones or futures of the pool.
+    pending: tp.Deque[tp.Tuple[str, int, float, tp.Union[dict, Future]]] = deque()
+    max_pending = max(1, 4 * workers)
+    with stack:
+        pool: tp.Optional[ProcessPoolExecutor] = None
+        if workers > 0:
+            pool = stack.enter_context(ProcessPoolExecutor(workers))
+        fp = stack.enter_context(open_fn(tmp_path, 'wb'))  # type: ignore
+
+        def _write_next():
+            nonlocal num_written, num_errors
+            file_path, size, mtime, entry = pending.popleft()
+            if isinstance(entry, Future):
+                try:
+                    m = entry.result()
+                    if resolve:
+                        m = _resolve_audio_meta(m)
+                except Exception as err:
+                    logger.warning("Error with %s: %r", file_path, err)
+                    num_errors += 1
+                    return
+                entry = m.to_dict()
+            entry = {**entry, 'file_size': size, 'file_mtime': mtime}
+            fp.write((json.dumps(entry) + '\n').encode('utf-8'))
+            num_written += 1
+            if progress and num_written % 1000 == 0:
+                logger.info("Written %d audio files (%d reused, %d errors)", num_written, num_reused, num_errors)
+
+        for file_path, size, mtime in _iter_files():
+            previous_stats = previous.get(_key(file_path))
+            if previous_stats is not None and previous_stats[:2] == (size, mtime):
+                assert spool is not None
+                num_reused += 1
+                spool.seek(previous_stats[2])
+                pending.append((file_path, size, mtime, json.loads(spool.readline())))
+            elif pool is None:
+                future: Future = Future()
+                try:
+                    future.set_result(_get_audio_meta(file_path, minimal))
+                except Exception as err:
+                    future.set_exception(err)
+                pending.append((file_path, size, mtime, future))
+            else:
+                pending.append((file_path, size, mtime, pool.submit(_get_audio_meta, file_path, minimal)))
+            while len(pending) > max_pending:
+                _write_next()
+        while pending:
+            _write_next()
+    os.replace(tmp_path, output_meta_file)
+    logger.info("Written %d audio files to %s (%d reused from previous manifest, %d errors)",
+                num_written, output_meta_file, num_reused, num_errors)
+    return num_written
+
+
 def load_audio_meta(path: tp.Union[str, Path],
                     resolve: bool = True, fast: bool = True) -> tp.List[AudioMeta]:
     """Load list of AudioMeta from an optionally compressed json file.
@@ -241,6 +380,324 @@ def save_audio_meta(path: tp.Union[str, Path], meta: tp.List[AudioMeta]):
             fp.write(json_bytes)
 
 
+COLUMNS_ALIGNMENT = 64
+
+
+def save_columns(path: tp.Union[str, Path], magic: bytes, columns: tp.Dict[str, np.ndarray], **attributes):
+    """Save NumPy arrays to a binary file that can be memory-mapped with `load_columns`.
+    The file starts with the given magic bytes and a JSON header describing the arrays,
+    followed by the aligned raw content of each array.
+
+    Args:
+        path (str or Path): Path of the file.
+        magic (bytes): Magic bytes identifying the kind of file.
+        columns (dict[str, np.ndarray]): Arrays to save.
+        attributes: Additional attributes stored in the header.
+    """
+    arrays = [(name, np.ascontiguousarray(array)) for name, array in columns.items()]
+
+    def _get_header(header_size: int) -> dict:
+        entries = {}
+        offset = header_size
+        for name, array in arrays:
+            offset += -offset % COLUMNS_ALIGNMENT
+            entries[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+            offset += array.nbytes
+        return {'columns': entries, 'attributes': attributes}
+
+    # the header holds the offsets of the arrays following it, hence its size
+    # is increased until it is large enough to hold the offsets it describes.
+    header_size = 0
+    while True:
+        header = _get_header(header_size)
+        header_bytes = json.dumps(header).encode()
+        prefix = magic + len(header_bytes).to_bytes(8, 'little') + header_bytes
+        if len(prefix) <= header_size:
+            break
+        header_size = len(prefix) + (-len(prefix) % COLUMNS_ALIGNMENT)
+    with open(path, 'wb') as f:
+        f.write(prefix + bytes(header_size - len(prefix)))
+        position = header_size
+        for name, array in arrays:
+            offset = header['columns'][name]['offset']
+            f.write(bytes(offset - position))
+            f.write(array.tobytes())
+            position = offset + array.nbytes
+
+
+def load_columns_header(path: tp.Union[str, Path], magic: bytes) -> dict:
+    """Load the header of a file saved with `save_columns`, holding the `attributes` given when saving."""
+    with open(path, 'rb') as f:
+        assert f.read(len(magic)) == magic, f"Unexpected file format: {path}"
+        header_length = int.from_bytes(f.read(8), 'little')
+        return json.loads(f.read(header_length))
+
+
+def load_columns(path: tp.Union[str, Path], magic: bytes) -> tp.Tuple[tp.Dict[str, np.ndarray], dict]:
+    """Load the arrays saved with `save_columns` as read-only memory maps, along with the file header."""
+    header = load_columns_header(path, magic)
+    columns: tp.Dict[str, np.ndarray] = {}
+    for name, entry in header['columns'].items():
+        dtype = np.dtype(entry['dtype'])
+        shape = tuple(entry['shape'])
+        if 0 in shape:
+            columns[name] = np.empty(shape, dtype=dtype)
+        else:
+            columns[name] = np.memmap(path, dtype=dtype, mode='r', offset=entry['offset'], shape=shape)
+    return columns, header
+
+
+class AudioMetaIndex(tp.Sequence[AudioMeta]):
+    """Columnar representation of a list of AudioMeta, for manifests with millions of files.
+
+    The metadata is held in a few NumPy arrays, with the paths stored as offsets into a single
+    UTF-8 buffer, instead of one Python object per file. The index is saved next to the manifest
+    and memory-mapped when loading it, so that the startup time and the memory of each dataloader worker
+    do not depend on the number of files. `AudioMeta` objects are only created on access, with `index[i]`.
+    Missing amplitudes and weights are stored as NaN and missing info paths as empty strings.
+
+    Args:
+        columns (dict[str, np.ndarray]): Columns of the index, see `COLUMNS`.
+        rows (np.ndarray, optional): Rows of the columns that are part of this index,
+            e.g. after filtering, all of them if not provided.
+        path_mapper (callable, optional): Function applied to the paths, e.g. to match cluster specificities.
+    """
+    MAGIC = b'ACMETAIX'
+    VERSION = 1
+    COLUMNS = ['duration', 'sample_rate', 'amplitude', 'weight',
+               'path_offsets', 'paths', 'info_path_offsets', 'info_paths']
+
+    def __init__(self, columns: tp.Dict[str, np.ndarray], rows: tp.Optional[np.ndarray] = None,
+                 path_mapper: tp.Optional[tp.Callable[[str], str]] = None):
+        assert set(columns) == set(self.COLUMNS), f"Unexpected columns: {list(columns)}"
+        self.columns = columns
+        self.rows = rows
+        self.path_mapper = path_mapper
+
+    @classmethod
+    def from_meta(cls, meta: tp.Iterable[AudioMeta]) -> 'AudioMetaIndex':
+        """Build the index from AudioMeta, which can be lazily generated, e.g. while reading a manifest."""
+        durations: tp.List[float] = []
+        sample_rates: tp.List[int] = []
+        amplitudes: tp.List[float] = []
+        weights: tp.List[float] = []
+        paths = bytearray()
+        path_offsets = [0]
+        info_paths = bytearray()
+        info_path_offsets = [0]
+        for m in meta:
+            durations.append(m.duration)
+            sample_rates.append(m.sample_rate)
+            amplitudes.append(math.nan if m.amplitude is None else m.amplitude)
+            weights.append(math.nan if m.weight is None else m.weight)
+            paths += m.path.encode('utf-8')
+            path_offsets.append(len(paths))
+            if m.info_path is not None:
+                info_paths += str(m.info_path).encode('utf-8')
+            info_path_offsets.append(len(info_paths))
+        return cls({
+            'duration': np.array(durations, dtype=np.float64),
+            'sample_rate': np.array(sample_rates, dtype=np.int64),
+            'amplitude': np.array(amplitudes, dtype=np.float64),
+            'weight': np.array(weights, dtype=np.float64),
+            'path_offsets': np.array(path_offsets, dtype=np.int64),
+            'paths': np.frombuffer(bytes(paths), dtype=np.uint8),
+            'info_path_offsets': np.array(info_path_offsets, dtype=np.int64),
+            'info_paths': np.frombuffer(bytes(info_paths), dtype=np.uint8),
+        })
+
+    def save(self, path: tp.Union[str, Path], **attributes):
+        """Save the index to a binary file that can be memory-mapped with `load`.
+
+        Args:
+            path (str or Path): Path of the index file.
+            attributes: Additional attributes stored in the header, e.g. to check the index is up to date.
+        """
+        assert self.rows is None and self.path_mapper is None, "Only a full index can be saved."
+        save_columns(path, self.MAGIC, {name: self.columns[name] for name in self.COLUMNS}, **attributes)
+
+    @staticmethod
+    def load_header(path: tp.Union[str, Path]) -> dict:
+        return load_columns_header(path, AudioMetaIndex.MAGIC)
+
+    @classmethod
+    def load(cls, path: tp.Union[str, Path]) -> 'AudioMetaIndex':
+        """Load an index saved with `save`, memory-mapping its columns."""
+        columns, _ = load_columns(path, cls.MAGIC)
+        return cls(columns)
+
+    def select(self, rows: tp.Union[np.ndarray, tp.Sequence[int]]) -> 'AudioMetaIndex':
+        """Return a new index with the given rows of this index, sharing the same columns."""
+        rows = np.asarray(rows, dtype=np.int64)
+        if self.rows is not None:
+            rows = self.rows[rows]
+        return AudioMetaIndex(self.columns, rows, self.path_mapper)
+
+    def with_path_mapper(self, path_mapper: tp.Callable[[str], str]) -> 'AudioMetaIndex':
+        """Return a new index applying the given function to the paths and zip paths of the info paths."""
+        return AudioMetaIndex(self.columns, self.rows, path_mapper)
+
+    def _column(self, name: str) -> np.ndarray:
+        column = self.columns[name]
+        return column if self.rows is None else column[self.rows]
+
+    @property
+    def durations(self) -> np.ndarray:
+        return self._column('duration')
+
+    @property
+    def weights(self) -> np.ndarray:
+        """Weights of the files, NaN for files without weight."""
+        return self._column('weight')
+
+    def __len__(self) -> int:
+        return len(self.columns['duration']) if self.rows is None else len(self.rows)
+
+    @staticmethod
+    def _get_string(offsets: np.ndarray, buffer: np.ndarray, row: int) -> str:
+        return buffer[offsets[row]:offsets[row + 1]].tobytes().decode('utf-8')
+
+    def _get_meta(self, index: int) -> AudioMeta:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"AudioMeta index out of range: {index}")
+        row = index if self.rows is None else int(self.rows[index])
+        columns = self.columns
+        path = self._get_string(columns['path_offsets'], columns['paths'], row)
+        info_path_str = self._get_string(columns['info_path_offsets'], columns['info_paths'], row)
+        info_path = PathInZip(info_path_str) if info_path_str else None
+        if self.path_mapper is not None:
+            path = self.path_mapper(path)
+            if info_path is not None:
+                info_path.zip_path = self.path_mapper(info_path.zip_path)
+        amplitude = float(columns['amplitude'][row])
+        weight = float(columns['weight'][row])
+        return AudioMeta(path, float(columns['duration'][row]), int(columns['sample_rate'][row]),
+                         amplitude=None if math.isnan(amplitude) else amplitude,
+                         weight=None if math.isnan(weight) else weight,
+                         info_path=info_path)
+
+    @tp.overload
+    def __getitem__(self, index: int) -> AudioMeta: ...
+
+    @tp.overload
+    def __getitem__(self, index: slice) -> 'AudioMetaIndex': ...
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.select(np.arange(len(self))[index])
+        return self._get_meta(int(index))
+
+    def __iter__(self) -> tp.Iterator[AudioMeta]:
+        for index in range(len(self)):
+            yield self._get_meta(index)
+
+
+def build_alias_table(probabilities: torch.Tensor) -> tp.Tuple[torch.Tensor, torch.Tensor]:
+    """Build the alias table of a categorical distribution with Vose's variant of Walker's alias method,
+    in O(N), so that it can then be sampled in O(1) with `sample_alias_table`.
+
+    Args:
+        probabilities (torch.Tensor): Probabilities of the N outcomes, summing to 1.
+    Returns:
+        tuple[torch.Tensor, torch.Tensor]: Probability of keeping each bucket, and the alias of each bucket,
+            the outcome drawn when the bucket is not kept.
+    """
+    num_outcomes = len(probabilities)
+    scaled = (probabilities.double() * num_outcomes).tolist()
+    keep = [1.] * num_outcomes
+    alias = list(range(num_outcomes))
+    small = [idx for idx, value in enumerate(scaled) if value < 1.]
+    large = [idx for idx, value in enumerate(scaled) if value >= 1.]
+    while small and large:
+        less, more = small.pop(), large.pop()
+        keep[less] = scaled[less]
+        alias[less] = more
+        scaled[more] = (scaled[more] + scaled[less]) - 1.
+        if scaled[more] < 1.:
+            small.append(more)
+        else:
+            large.append(more)
+    # remaining buckets are full, up to numerical errors
+    return torch.tensor(keep, dtype=torch.float64), torch.tensor(alias, dtype=torch.int64)
+
+
+def sample_alias_table(keep: torch.Tensor, alias: torch.Tensor, rng: torch.Generator) -> int:
+    """Draw one outcome from an alias table built with `build_alias_table`, using the provided generator."""
+    bucket = int(torch.randint(len(keep), (1,), generator=rng).item())
+    if torch.rand(1, generator=rng, dtype=torch.float64).item() < float(keep[bucket]):
+        return bucket
+    return int(alias[bucket])
+
+
+def get_manifest_path(root: tp.Union[str, Path]) -> Path:
+    """Path of the manifest of a dataset, given either directly or as a folder holding
+    a data.jsonl or data.jsonl.gz file.
+    """
+    root = Path(root)
+    if root.is_dir():
+        if (root / 'data.jsonl').exists():
+            return root / 'data.jsonl'
+        elif (root / 'data.jsonl.gz').exists():
+            return root / 'data.jsonl.gz'
+        else:
+            raise ValueError("Don't know where to read metadata from in the dir. "
+                             "Expecting either a data.jsonl or data.jsonl.gz file but none found.")
+    return root
+
+
+def get_audio_meta_index_path(path: tp.Union[str, Path]) -> Path:
+    """Path of the AudioMeta index saved next to a manifest, e.g. `data.jsonl.index` for `data.jsonl`."""
+    return Path(str(path) + '.index')
+
+
+def load_audio_meta_index(path: tp.Union[str, Path],
+                          resolve: bool = True, fast: bool = True) -> AudioMetaIndex:
+    """Load an AudioMetaIndex for an optionally compressed json manifest.
+    The index is built from the manifest on first use and saved next to it, it is rebuilt
+    when the manifest is modified. If the index cannot be saved, e.g. on a read-only file system,
+    it is only kept in memory.
+
+    Args:
+        path (str or Path): Path to JSON file.
+        resolve (bool): Whether to resolve the path from AudioMeta (default=True).
+        fast (bool): activates some tricks to make things faster.
+    Returns:
+        AudioMetaIndex: Index of the audio files paths and metadata.
+    """
+    stat = os.stat(path)
+    attributes = {'version': AudioMetaIndex.VERSION, 'manifest_size': stat.st_size, 'manifest_mtime': stat.st_mtime,
+                  'resolve': resolve and bool(dora)}
+    index_path = get_audio_meta_index_path(path)
+    if index_path.exists():
+        try:
+            if AudioMetaIndex.load_header(index_path).get('attributes') == attributes:
+                return AudioMetaIndex.load(index_path)
+            logger.info("AudioMeta index %s is outdated, rebuilding it.", index_path)
+        except Exception as exc:
+            logger.warning("Error loading AudioMeta index %s: %r", index_path, exc)
+
+    def _iter_meta() -> tp.Iterator[AudioMeta]:
+        open_fn = gzip.open if str(path).lower().endswith('.gz') else open
+        with open_fn(path, 'rb') as fp:  # type: ignore
+            for line in fp:
+                m = AudioMeta.from_dict(json.loads(line))
+                if resolve:
+                    m = _resolve_audio_meta(m, fast=fast)
+                yield m
+
+    index = AudioMetaIndex.from_meta(_iter_meta())
+    try:
+        tmp_path = index_path.with_name(f"{index_path.name}.tmp.{os.getpid()}")
+        index.save(tmp_path, **attributes)
+        os.replace(tmp_path, index_path)
+    except OSError as exc:
+        logger.warning("Could not save AudioMeta index %s: %r", index_path, exc)
+        return index
+    return AudioMetaIndex.load(index_path)
+
+
 class AudioDataset:
     """Base audio dataset.
 
@@ -263,7 +720,7 @@ class AudioDataset:
     You can get back some diversity by setting the `shuffle_seed` param.
 
     Args:
-        meta (list of AudioMeta): List of audio files metadata.
+        meta (list of AudioMeta or AudioMetaIndex): List of audio files metadata.
         segment_duration (float, optional): Optional segment duration of audio to load.
             If not specified, the dataset will load the full audio segment from the file.
         shuffle (bool): Set to `True` to have the data reshuffled at every epoch.
@@ -293,7 +750,7 @@ class AudioDataset:
             `total_batch_size` the overall batch size accounting for all gpus.
     """
     def __init__(self,
-                 meta: tp.List[AudioMeta],
+                 meta: tp.Sequence[AudioMeta],
                  segment_duration: tp.Optional[float] = None,
                  shuffle: bool = True,
                  num_samples: int = 10_000,
@@ -320,9 +777,12 @@ class AudioDataset:
         self.min_audio_duration = min_audio_duration
         if self.min_audio_duration is not None and self.max_audio_duration is not None:
             assert self.min_audio_duration <= self.max_audio_duration
-        self.meta: tp.List[AudioMeta] = self._filter_duration(meta)
+        self.meta: tp.Sequence[AudioMeta] = self._filter_duration(meta)
         assert len(self.meta)  # Fail fast if all data has been filtered.
-        self.total_duration = sum(d.duration for d in self.meta)
+        if isinstance(self.meta, AudioMetaIndex):
+            self.total_duration = float(self.meta.durations.sum())
+        else:
+            self.total_duration = sum(d.duration for d in self.meta)
 
         if segment_duration is None:
             num_samples = len(self.meta)
@@ -354,7 +814,26 @@ class AudioDataset:
         return self.num_samples
 
     def _get_sampling_probabilities(self, normalized: bool = True):
-        """Return the sampling probabilities for each file inside `self.meta`."""
+        """Return the sampling probabilities for each file inside `self.meta`.
+        For normalized probabilities, the alias table used by `sample_file` is also built.
+        """
+        probabilities = self._get_file_scores()
+        if normalized:
+            probabilities /= probabilities.sum()
+            if self.sample_on_weight or self.sample_on_duration:
+                self._alias_keep, self._alias = build_alias_table(probabilities)
+        return probabilities
+
+    def _get_file_scores(self) -> torch.Tensor:
+        """Return the unnormalized sampling score of each file, from its weight and duration."""
+        if isinstance(self.meta, AudioMetaIndex):
+            index_scores = np.ones(len(self.meta), dtype=np.float64)
+            if self.sample_on_weight:
+                weights = self.meta.weights
+                index_scores *= np.where(np.isnan(weights), 1., weights)
+            if self.sample_on_duration:
+                index_scores *= self.meta.durations
+            return torch.from_numpy(index_scores).float()
         scores: tp.List[float] = []
         for file_meta in self.meta:
             score = 1.
@@ -363,10 +842,7 @@ class AudioDataset:
             if self.sample_on_duration:
                 score *= file_meta.duration
             scores.append(score)
-        probabilities = torch.tensor(scores)
-        if normalized:
-            probabilities /= probabilities.sum()
-        return probabilities
+        return torch.tensor(scores)
 
     @staticmethod
     @lru_cache(16)
@@ -397,10 +873,28 @@ class AudioDataset:
         if not self.sample_on_weight and not self.sample_on_duration:
             file_index = int(torch.randint(len(self.sampling_probabilities), (1,), generator=rng).item())
         else:
-            file_index = int(torch.multinomial(self.sampling_probabilities, 1, generator=rng).item())
+            # O(1) draw from the alias table rather than an O(N) torch.multinomial over all files.
+            file_index = sample_alias_table(self._alias_keep, self._alias, rng)
 
         return self.meta[file_index]
 
+    def get_segment_rng(self, index: int) -> torch.Generator:
+        """Random number generator used to sample the segment at a given index.
+        This is only used if `segment_duration` is not None.
+        """
+        rng = torch.Generator()
+        if self.shuffle:
+            # We use index, plus extra randomness, either totally random if we don't know the epoch.
+            # otherwise we make use of the epoch number and optional shuffle_seed.
+            if self.current_epoch is None:
+                rng.manual_seed(index + self.num_samples * random.randint(0, 2**24))
+            else:
+                rng.manual_seed(index + self.num_samples * (self.current_epoch + self.shuffle_seed))
+        else:
+            # We only use index
+            rng.manual_seed(index)
+        return rng
+
     def _audio_read(self, path: str, seek_time: float = 0, duration: float = -1):
         # Override this method in subclass if needed.
         if self.load_wav:
@@ -419,18 +913,7 @@ class AudioDataset:
             segment_info = SegmentInfo(file_meta, seek_time=0., n_frames=n_frames, total_frames=n_frames,
                                        sample_rate=self.sample_rate, channels=out.shape[0])
         else:
-            rng = torch.Generator()
-            if self.shuffle:
-                # We use index, plus extra randomness, either totally random if we don't know the epoch.
-                # otherwise we make use of the epoch number and optional shuffle_seed.
-                if self.current_epoch is None:
-                    rng.manual_seed(index + self.num_samples * random.randint(0, 2**24))
-                else:
-                    rng.manual_seed(index + self.num_samples * (self.current_epoch + self.shuffle_seed))
-            else:
-                # We only use index
-                rng.manual_seed(index)
-
+            rng = self.get_segment_rng(index)
             for retry in range(self.max_read_retry):
                 file_meta = self.sample_file(index, rng)
                 # We add some variance in the file position even if audio file is smaller than segment
@@ -499,17 +982,27 @@ class AudioDataset:
                 samples = [_pad_wav(s) for s in samples]
             return torch.stack(samples)
 
-    def _filter_duration(self, meta: tp.List[AudioMeta]) -> tp.List[AudioMeta]:
+    def _filter_duration(self, meta: tp.Sequence[AudioMeta]) -> tp.Sequence[AudioMeta]:
         """Filters out audio files with audio durations that will not allow to sample examples from them."""
         orig_len = len(meta)
 
-        # Filter data that is too short.
-        if self.min_audio_duration is not None:
-            meta = [m for m in meta if m.duration >= self.min_audio_duration]
+        if isinstance(meta, AudioMetaIndex):
+            durations = meta.durations
+            keep = np.ones(len(meta), dtype=bool)
+            if self.min_audio_duration is not None:
+                keep &= durations >= self.min_audio_duration
+            if self.max_audio_duration is not None:
+                keep &= durations <= self.max_audio_duration
+            if not keep.all():
+                meta = meta.select(np.nonzero(keep)[0])
+        else:
+            # Filter data that is too short.
+            if self.min_audio_duration is not None:
+                meta = [m for m in meta if m.duration >= self.min_audio_duration]
 
-        # Filter data that is too long.
-        if self.max_audio_duration is not None:
-            meta = [m for m in meta if m.duration <= self.max_audio_duration]
+            # Filter data that is too long.
+            if self.max_audio_duration is not None:
+                meta = [m for m in meta if m.duration <= self.max_audio_duration]
 
         filtered_len = len(meta)
         removed_percentage = 100*(1-float(filtered_len)/orig_len)
@@ -521,23 +1014,21 @@ class AudioDataset:
         return meta
 
     @classmethod
-    def from_meta(cls, root: tp.Union[str, Path], **kwargs):
+    def from_meta(cls, root: tp.Union[str, Path], meta_index: bool = True, **kwargs):
         """Instantiate AudioDataset from a path to a directory containing a manifest as a jsonl file.
 
         Args:
             root (str or Path): Path to root folder containing audio files.
+            meta_index (bool): Whether to load the manifest as a memory-mapped `AudioMetaIndex`
+                rather than a list of AudioMeta.
             kwargs: Additional keyword arguments for the AudioDataset.
         """
-        root = Path(root)
-        if root.is_dir():
-            if (root / 'data.jsonl').exists():
-                root = root / 'data.jsonl'
-            elif (root / 'data.jsonl.gz').exists():
-                root = root / 'data.jsonl.gz'
-            else:
-                raise ValueError("Don't know where to read metadata from in the dir. "
-                                 "Expecting either a data.jsonl or data.jsonl.gz file but none found.")
-        meta = load_audio_meta(root)
+        root = get_manifest_path(root)
+        meta: tp.Sequence[AudioMeta]
+        if meta_index:
+            meta = load_audio_meta_index(root)
+        else:
+            meta = load_audio_meta(root)
         return cls(meta, **kwargs)
 
     @classmethod
@@ -577,10 +1068,13 @@ def main():
     parser.add_argument('--workers',
                         default=10, type=int,
                         help='Number of workers.')
+    parser.add_argument('--incremental', metavar='PREVIOUS_META_FILE',
+                        help='Reuse the entries of a previous manifest for the files that did not change. '
+                             'It can be the output file itself.')
     args = parser.parse_args()
-    meta = find_audio_files(args.root, DEFAULT_EXTS, progress=True,
-                            resolve=args.resolve, minimal=args.minimal, workers=args.workers)
-    save_audio_meta(args.output_meta_file, meta)
+    build_audio_manifest(args.root, args.output_meta_file, DEFAULT_EXTS, progress=True,
+                         resolve=args.resolve, minimal=args.minimal, workers=args.workers,
+                         previous_meta_file=args.incremental)
 
 
 if __name__ == '__main__':
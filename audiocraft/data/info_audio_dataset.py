@@ -14,7 +14,7 @@ import typing as tp
 
 import torch
 
-from .audio_dataset import AudioDataset, AudioMeta
+from .audio_dataset import AudioDataset, AudioMeta, AudioMetaIndex
 from ..environment import AudioCraftEnvironment
 from ..modules.conditioners import SegmentWithAttributes, ConditioningAttributes
 
@@ -30,8 +30,11 @@ def _clusterify_meta(meta: AudioMeta) -> AudioMeta:
     return meta
 
 
-def clusterify_all_meta(meta: tp.List[AudioMeta]) -> tp.List[AudioMeta]:
+def clusterify_all_meta(meta: tp.Sequence[AudioMeta]) -> tp.Sequence[AudioMeta]:
     """Monkey-patch all meta to match cluster specificities."""
+    if isinstance(meta, AudioMetaIndex):
+        # the paths of the index are mapped when accessing the meta
+        return meta.with_path_mapper(AudioCraftEnvironment.apply_dataset_mappers)
     return [_clusterify_meta(m) for m in meta]
 
 
@@ -56,7 +59,7 @@ class InfoAudioDataset(AudioDataset):
 
     See `audiocraft.data.audio_dataset.AudioDataset` for initialization arguments.
     """
-    def __init__(self, meta: tp.List[AudioMeta], **kwargs):
+    def __init__(self, meta: tp.Sequence[AudioMeta], **kwargs):
         super().__init__(clusterify_all_meta(meta), **kwargs)
 
     def __getitem__(self, index: int) -> tp.Union[torch.Tensor, tp.Tuple[torch.Tensor, SegmentWithAttributes]]:
@@ -5,19 +5,27 @@
 # LICENSE file in the root directory of this source tree.
 """Dataset of music tracks with rich metadata.
 """
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field, fields, replace
 import gzip
+from hashlib import sha1
 import json
 import logging
+import os
 from pathlib import Path
 import random
+import sys
 import typing as tp
 
+import numpy as np
 import torch
 
+from .audio_dataset import AudioMeta, get_manifest_path, load_audio_meta_index, load_columns, save_columns
 from .info_audio_dataset import (
     InfoAudioDataset,
     AudioInfo,
+    clusterify_all_meta,
     get_keyword_list,
     get_keyword,
     get_string
@@ -184,6 +192,103 @@ class Paraphraser:
         return new_desc
 
 
+def _hash_path(path: str) -> int:
+    return int.from_bytes(sha1(path.encode('utf-8')).digest()[:8], 'little')
+
+
+class MusicInfoStore:
+    """Consolidated store of the .json music metadata sidecars of a list of audio files,
+    to avoid opening a sidecar for each sampled segment, which is slow on network file systems.
+
+    The records are stored by manifest index as compact JSON in a single UTF-8 buffer with offsets,
+    and the record of an audio file is found from a hash of its path, with a binary search
+    over the sorted hashes. The store can be built when creating the dataset,
+    or offline with `python -m audiocraft.data.music_dataset` and memory-mapped, in which case
+    the size and modification time of the manifest are saved to detect an outdated store.
+
+    Args:
+        columns (dict[str, np.ndarray]): Columns of the store, see `build`.
+    """
+    MAGIC = b'ACMUSINF'
+
+    def __init__(self, columns: tp.Dict[str, np.ndarray]):
+        self.columns = columns
+
+    @classmethod
+    def build(cls, meta: tp.Sequence[AudioMeta], workers: int = 16) -> 'MusicInfoStore':
+        """Read the sidecars of the given audio files, files without sidecar having an empty record."""
+        def _read(path: str) -> bytes:
+            info_path = Path(path).with_suffix('.json')
+            if not info_path.exists():
+                return b''
+            with open(info_path, 'r') as json_file:
+                return json.dumps(json.load(json_file), separators=(',', ':')).encode('utf-8')
+
+        paths = [m.path for m in meta]
+        records = bytearray()
+        offsets = [0]
+        with ThreadPoolExecutor(workers) as pool:
+            for record in pool.map(_read, paths):
+                records += record
+                offsets.append(len(records))
+        hashes = np.array([_hash_path(path) for path in paths], dtype=np.uint64)
+        order = np.argsort(hashes, kind='stable')
+        logger.info("Loaded %d music info sidecars for %d audio files", int((np.diff(offsets) > 0).sum()), len(paths))
+        return cls({
+            'hashes': hashes[order],
+            'rows': order.astype(np.int64),
+            'offsets': np.array(offsets, dtype=np.int64),
+            'records': np.frombuffer(bytes(records), dtype=np.uint8),
+        })
+
+    @staticmethod
+    def get_manifest_attributes(manifest_path: tp.Union[str, Path]) -> dict:
+        """Attributes of the manifest saved with the store, to check that it matches the manifest when loading it."""
+        stat = os.stat(manifest_path)
+        return {'manifest_size': stat.st_size, 'manifest_mtime': stat.st_mtime}
+
+    def save(self, path: tp.Union[str, Path], manifest_path: tp.Optional[tp.Union[str, Path]] = None):
+        attributes = {} if manifest_path is None else self.get_manifest_attributes(manifest_path)
+        save_columns(path, self.MAGIC, self.columns, **attributes)
+
+    @classmethod
+    def load(cls, path: tp.Union[str, Path],
+             manifest_path: tp.Optional[tp.Union[str, Path]] = None) -> 'MusicInfoStore':
+        """Load a store saved with `save`, checking that it was built from the given manifest if provided,
+        and raising a ValueError otherwise.
+        """
+        columns, header = load_columns(path, cls.MAGIC)
+        if manifest_path is not None and header.get('attributes') != cls.get_manifest_attributes(manifest_path):
+            raise ValueError(f"Music info store {path} was not built from the current manifest {manifest_path}")
+        return cls(columns)
+
+    def __len__(self) -> int:
+        return len(self.columns['rows'])
+
+    def __contains__(self, path: str) -> bool:
+        hashes = self.columns['hashes']
+        key = np.uint64(_hash_path(path))
+        position = int(np.searchsorted(hashes, key))
+        return position < len(hashes) and hashes[position] == key
+
+    def get_record(self, row: int) -> tp.Optional[dict]:
+        """Return the music metadata of the audio file at the given manifest index, None without sidecar."""
+        offsets = self.columns['offsets']
+        record = self.columns['records'][offsets[row]:offsets[row + 1]]
+        if len(record) == 0:
+            return None
+        return json.loads(record.tobytes())
+
+    def get(self, path: str) -> tp.Optional[dict]:
+        """Return the music metadata of the given audio file, None if it has no sidecar or is unknown."""
+        hashes = self.columns['hashes']
+        key = np.uint64(_hash_path(path))
+        position = int(np.searchsorted(hashes, key))
+        if position == len(hashes) or hashes[position] != key:
+            return None
+        return self.get_record(int(self.columns['rows'][position]))
+
+
 class MusicDataset(InfoAudioDataset):
     """Music dataset is an AudioDataset with music-related metadata.
 
@@ -198,6 +303,13 @@ class MusicDataset(InfoAudioDataset):
             original info path (e.g. track_path.json) and each value is a list of possible
             paraphrased.
         paraphrase_p (float): probability of taking a paraphrase.
+        preload_info (bool): Whether to load all the .json metadata sidecars when creating the dataset,
+            rather than opening the sidecar of each sampled segment.
+        info_store (str, optional): Path to a `MusicInfoStore` built offline for the dataset manifest,
+            to use instead of the .json metadata sidecars. The sidecars are still read for the audio files
+            missing from the store, and the store is ignored if it was built from another version of the manifest.
+        manifest_path (str, optional): Path to the manifest of the dataset, to check the info store against,
+            set by `from_meta`.
 
     See `audiocraft.data.info_audio_dataset.InfoAudioDataset` for full initialization arguments.
     """
@@ -205,7 +317,8 @@ class MusicDataset(InfoAudioDataset):
                  merge_text_p: float = 0., drop_desc_p: float = 0., drop_other_p: float = 0.,
                  joint_embed_attributes: tp.List[str] = [],
                  paraphrase_source: tp.Optional[str] = None, paraphrase_p: float = 0,
-                 **kwargs):
+                 preload_info: bool = False, info_store: tp.Optional[str] = None,
+                 manifest_path: tp.Optional[str] = None, **kwargs):
         kwargs['return_info'] = True  # We require the info for each song of the dataset.
         super().__init__(*args, **kwargs)
         self.info_fields_required = info_fields_required
@@ -216,17 +329,43 @@ class MusicDataset(InfoAudioDataset):
         self.paraphraser = None
         if paraphrase_source is not None:
             self.paraphraser = Paraphraser(paraphrase_source, paraphrase_p)
+        self.info_store: tp.Optional[MusicInfoStore] = None
+        if info_store is not None:
+            try:
+                self.info_store = MusicInfoStore.load(info_store, manifest_path)
+            except ValueError as exc:
+                logger.warning("%s, ignoring it.", exc)
+        if self.info_store is None and preload_info:
+            self.info_store = MusicInfoStore.build(self.meta)
 
-    def __getitem__(self, index):
-        wav, info = super().__getitem__(index)
+    @classmethod
+    def from_meta(cls, root: tp.Union[str, Path], meta_index: bool = True, **kwargs):
+        kwargs.setdefault('manifest_path', str(get_manifest_path(root)))
+        return super().from_meta(root, meta_index=meta_index, **kwargs)
+
+    def _load_music_data(self, path: str) -> tp.Optional[dict]:
+        """Load the music metadata of an audio file, None if it has no sidecar."""
+        if self.info_store is not None:
+            if path in self.info_store:
+                return self.info_store.get(path)
+            warn_once(logger, "Some audio files are missing from the music info store, "
+                      "reading their .json sidecars instead.")
+        music_info_path = Path(path).with_suffix('.json')
+        if not music_info_path.exists():
+            return None
+        with open(music_info_path, 'r') as json_file:
+            return json.load(json_file)
+
+    def get_music_info(self, info: AudioInfo) -> MusicInfo:
+        """Load the music metadata accompanying the given segment, from the .json file next to the audio file,
+        and apply the text augmentations. The wav conditions are not populated.
+        """
         info_data = info.to_dict()
-        music_info_path = Path(info.meta.path).with_suffix('.json')
+        music_data = self._load_music_data(info.meta.path)
 
-        if Path(music_info_path).exists():
-            with open(music_info_path, 'r') as json_file:
-                music_data = json.load(json_file)
-                music_data.update(info_data)
-                music_info = MusicInfo.from_dict(music_data, fields_required=self.info_fields_required)
+        if music_data is not None:
+            music_data.update(info_data)
+            music_info = MusicInfo.from_dict(music_data, fields_required=self.info_fields_required)
             if self.paraphraser is not None:
                 music_info.description = self.paraphraser.sample(music_info.meta.path, music_info.description)
             if self.merge_text_p:
@@ -234,6 +373,11 @@ class MusicDataset(InfoAudioDataset):
                     music_info, self.merge_text_p, self.drop_desc_p, self.drop_other_p)
         else:
             music_info = MusicInfo.from_dict(info_data, fields_required=False)
+        return music_info
+
+    def __getitem__(self, index):
+        wav, info = super().__getitem__(index)
+        music_info = self.get_music_info(info)
 
         music_info.self_wav = WavCondition(
             wav=wav[None], length=torch.tensor([info.n_frames]),
@@ -268,3 +412,20 @@ def get_bpm(value: tp.Optional[str]) -> tp.Optional[float]:
         return float(value)
     except ValueError:
         return None
+
+
+def main():
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        prog='music_dataset',
+        description='Consolidate the .json music metadata sidecars of a manifest into a single store.')
+    parser.add_argument('meta_path', help='Manifest of the audio files, as a .jsonl or .jsonl.gz file.')
+    parser.add_argument('output', help='Path of the store, to be given as the info_store of the MusicDataset.')
+    parser.add_argument('--workers', default=16, type=int, help='Number of threads reading the sidecars.')
+    args = parser.parse_args()
+    meta = clusterify_all_meta(load_audio_meta_index(args.meta_path))
+    MusicInfoStore.build(meta, workers=args.workers).save(args.output, manifest_path=args.meta_path)
+
+
+if __name__ == '__main__':
+    main()
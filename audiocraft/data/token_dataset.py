@@ -0,0 +1,247 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Pre-tokenized datasets, to train language models on the tokens of a frozen compression model
+without decoding audio nor running the compression model at every step.
+
+The tokens of all the tracks of a manifest are exported once with:
+
+    python -m audiocraft.data.token_dataset egs/my_dataset/data.jsonl /path/to/token_store \\
+        --compression_model_checkpoint //pretrained/facebook/encodec_32khz
+
+The token store holds the int16 codes `[K, T]` of each track in memory-mapped shards with an index,
+using `audiocraft.utils.cache.PackedEmbeddingStore`, along with a `header.json` describing the
+compression model. The `TokenDataset` then samples random token segments from the store,
+following the sampling of the wrapped audio dataset, which is only used for its metadata.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import math
+from pathlib import Path
+import sys
+import typing as tp
+
+import torch
+import torch.nn.functional as F
+
+from .audio import audio_read
+from .audio_dataset import AudioMetaIndex, SegmentInfo, load_audio_meta
+from .audio_utils import convert_audio
+from .info_audio_dataset import AudioInfo, InfoAudioDataset, clusterify_all_meta
+from .music_dataset import MusicDataset
+from ..utils.cache import PackedEmbeddingStore
+
+
+logger = logging.getLogger(__name__)
+
+HEADER_NAME = 'header.json'
+
+
+def load_token_store_header(store_path: tp.Union[str, Path]) -> dict:
+    """Load the description of the compression model used to export a token store."""
+    with open(Path(store_path) / HEADER_NAME, 'r') as f:
+        return json.load(f)
+
+
+class TokenDataset(torch.utils.data.Dataset):
+    """Dataset of audio tokens segments, sampled from a token store exported with this module.
+
+    The wrapped dataset provides the list of tracks, the sampling of the segments and the metadata,
+    but no audio is read. Each item is a tuple of the tokens, of shape [K, T] with T the number of token
+    frames in a segment, zero padded for segments shorter than the segment duration, and of the segment info,
+    with `n_frames` matching the number of valid tokens so that the padding can be masked by the solver.
+    As the padding is not the tokens of silence, `tokens.padding_with_special_token` is required to train on it.
+    Tracks missing from the token store are discarded.
+
+    Args:
+        dataset (InfoAudioDataset): Dataset with segment duration, wrapped to sample the segments
+            and provide the metadata.
+        store_path (str or Path): Folder of the token store.
+    """
+    def __init__(self, dataset: InfoAudioDataset, store_path: tp.Union[str, Path]):
+        assert dataset.segment_duration is not None, "TokenDataset requires a segment duration."
+        assert not dataset.permutation_on_files, "TokenDataset does not support permutation_on_files."
+        self.dataset = dataset
+        self.store_path = Path(store_path)
+        header = load_token_store_header(self.store_path)
+        self.frame_rate: float = header['frame_rate']
+        self.num_codebooks: int = header['num_codebooks']
+        self.segment_frames = int(math.ceil(dataset.segment_duration * self.frame_rate))
+        store = PackedEmbeddingStore(self.store_path)
+        rows = [row for row, m in enumerate(dataset.meta) if m.path in store]
+        if len(rows) < len(dataset.meta):
+            logger.warning("%d tracks out of %d are missing from the token store %s and are discarded.",
+                           len(dataset.meta) - len(rows), len(dataset.meta), self.store_path)
+            assert len(rows), f"No track of the dataset found in the token store {self.store_path}"
+            if isinstance(dataset.meta, AudioMetaIndex):
+                dataset.meta = dataset.meta.select(rows)
+            else:
+                dataset.meta = [dataset.meta[row] for row in rows]
+            dataset.total_duration = sum(m.duration for m in dataset.meta)
+            dataset.sampling_probabilities = dataset._get_sampling_probabilities()
+        # opened lazily, so that each dataloader worker has its own memory maps.
+        self._store: tp.Optional[PackedEmbeddingStore] = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_store'] = None
+        return state
+
+    @property
+    def current_epoch(self) -> tp.Optional[int]:
+        return self.dataset.current_epoch
+
+    @current_epoch.setter
+    def current_epoch(self, epoch: tp.Optional[int]):
+        self.dataset.current_epoch = epoch
+
+    def start_epoch(self, epoch: int):
+        self.dataset.start_epoch(epoch)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def _get_tokens(self, path: str) -> torch.Tensor:
+        if self._store is None:
+            self._store = PackedEmbeddingStore(self.store_path)
+        tokens = self._store.get(path)
+        assert tokens is not None, f"Missing tokens for {path} in {self.store_path}"
+        return tokens
+
+    def __getitem__(self, index: int) -> tp.Tuple[torch.Tensor, AudioInfo]:
+        dataset = self.dataset
+        assert dataset.segment_duration is not None
+        rng = dataset.get_segment_rng(index)
+        file_meta = dataset.sample_file(index, rng)
+        tokens = self._get_tokens(file_meta.path)
+        max_seek = max(0, file_meta.duration - dataset.segment_duration * dataset.min_segment_ratio)
+        seek_time = torch.rand(1, generator=rng).item() * max_seek
+        offset = min(int(seek_time * self.frame_rate), max(0, tokens.shape[-1] - 1))
+        # the tokens are copied out of the memory map, as int16 to keep the transfer to the main process small.
+        segment = tokens[:, offset:offset + self.segment_frames].clone()
+        n_tokens = segment.shape[-1]
+        segment = F.pad(segment, (0, self.segment_frames - n_tokens))
+        # audio frames covered by the valid tokens, e.g. to create the padding mask in the solver.
+        n_frames = int(math.ceil(n_tokens * dataset.sample_rate / self.frame_rate))
+        segment_info = SegmentInfo(file_meta, offset / self.frame_rate, n_frames=n_frames,
+                                   total_frames=int(dataset.segment_duration * dataset.sample_rate),
+                                   sample_rate=dataset.sample_rate, channels=dataset.channels)
+        info = AudioInfo(**segment_info.to_dict())
+        if isinstance(dataset, MusicDataset):
+            info = dataset.get_music_info(info)
+        return segment, info
+
+    def collater(self, samples):
+        """Collate the token segments, as a tensor of shape [B, K, T], and the list of segment infos."""
+        tokens = torch.stack([tokens for tokens, _ in samples])
+        infos = [info for _, info in samples]
+        return tokens, infos
+
+
+def export_tokens(meta_path: tp.Union[str, Path], store_path: tp.Union[str, Path],
+                  compression_model_checkpoint: str, device: str = 'cpu',
+                  num_codebooks: tp.Optional[int] = None, chunk_duration: float = 60.,
+                  shard: int = 0, num_shards: int = 1, workers: int = 4):
+    """Encode all the tracks of a manifest with a compression model and store their tokens.
+
+    Tracks already present in the store are skipped, so that an interrupted export can be resumed,
+    and the manifest can be split across several processes with `shard` and `num_shards`.
+
+    Args:
+        meta_path (str or Path): Manifest of the audio files, as a .jsonl or .jsonl.gz file.
+        store_path (str or Path): Folder of the token store.
+        compression_model_checkpoint (str): Checkpoint, dora sig or pretrained name of the compression model,
+            see `CompressionSolver.model_from_checkpoint`.
+        device (str): Device on which to run the compression model.
+        num_codebooks (int, optional): Number of codebooks to keep, all of them if not provided.
+        chunk_duration (float): Long tracks are encoded by chunks of this duration, in seconds.
+        shard (int): Index of the part of the manifest to export.
+        num_shards (int): Number of parts the manifest is split into.
+        workers (int): Number of threads decoding the audio files.
+    """
+    from ..solvers.compression import CompressionSolver
+
+    model = CompressionSolver.model_from_checkpoint(compression_model_checkpoint, device=device)
+    model.eval()
+    if num_codebooks is not None:
+        model.set_num_codebooks(num_codebooks)
+    assert model.cardinality <= 2 ** 15, "Tokens are stored as int16."
+    header = {
+        'compression_model': compression_model_checkpoint,
+        'sample_rate': model.sample_rate,
+        'channels': model.channels,
+        'frame_rate': model.frame_rate,
+        'num_codebooks': model.num_codebooks,
+        'cardinality': model.cardinality,
+    }
+    store_path = Path(store_path)
+    store = PackedEmbeddingStore(store_path)
+    header_path = store_path / HEADER_NAME
+    if header_path.exists():
+        assert load_token_store_header(store_path) == header, \
+            f"Token store {store_path} was exported with another compression model."
+    else:
+        with open(header_path, 'w') as f:
+            json.dump(header, f, indent=2)
+
+    # keys of the store match the paths seen by the datasets
+    meta = clusterify_all_meta(load_audio_meta(meta_path))[shard::num_shards]
+    todo = [m for m in meta if m.path not in store]
+    logger.info("Exporting tokens of %d tracks out of %d to %s", len(todo), len(meta), store_path)
+    hop_length = int(model.sample_rate / model.frame_rate)
+    chunk_length = max(1, int(chunk_duration * model.frame_rate)) * hop_length
+
+    def _load(path: str) -> torch.Tensor:
+        wav, sr = audio_read(path)
+        return convert_audio(wav, sr, model.sample_rate, model.channels)
+
+    def _iter_wavs() -> tp.Iterator[tp.Tuple[tp.Any, torch.Tensor]]:
+        # decode a few files ahead of the compression model, without loading the whole manifest in memory.
+        with ThreadPoolExecutor(workers) as pool:
+            for start in range(0, len(todo), 2 * workers):
+                window = todo[start:start + 2 * workers]
+                yield from zip(window, pool.map(_load, [m.path for m in window]))
+
+    for idx, (file_meta, wav) in enumerate(_iter_wavs()):
+        codes = []
+        with torch.no_grad():
+            for offset in range(0, wav.shape[-1], chunk_length):
+                chunk = wav[None, :, offset:offset + chunk_length].to(device)
+                chunk_codes, scale = model.encode(chunk)
+                assert scale is None, "Scaled compression models are not supported."
+                codes.append(chunk_codes[0])
+        store.put(file_meta.path, torch.cat(codes, dim=-1).short())
+        if (idx + 1) % 100 == 0:
+            logger.info("Exported %d/%d tracks", idx + 1, len(todo))
+    store.close()
+    logger.info("Export done, %d tracks in %s", len(PackedEmbeddingStore(store_path)), store_path)
+
+
+def main():
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        prog='token_dataset',
+        description='Export the compression model tokens of the tracks of a manifest.')
+    parser.add_argument('meta_path', help='Manifest of the audio files, as a .jsonl or .jsonl.gz file.')
+    parser.add_argument('store_path', help='Output folder of the token store.')
+    parser.add_argument('--compression_model_checkpoint', required=True,
+                        help='Checkpoint, dora sig or //pretrained/NAME of the compression model.')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--num_codebooks', type=int, help='Number of codebooks to keep.')
+    parser.add_argument('--chunk_duration', type=float, default=60.,
+                        help='Long tracks are encoded by chunks of this duration, in seconds.')
+    parser.add_argument('--shard', type=int, default=0, help='Part of the manifest to export.')
+    parser.add_argument('--num_shards', type=int, default=1, help='Number of parts of the manifest.')
+    parser.add_argument('--workers', type=int, default=4, help='Number of threads decoding audio.')
+    args = parser.parse_args()
+    export_tokens(args.meta_path, args.store_path, args.compression_model_checkpoint, device=args.device,
+                  num_codebooks=args.num_codebooks, chunk_duration=args.chunk_duration,
+                  shard=args.shard, num_shards=args.num_shards, workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -63,7 +63,8 @@ class AudioGen(BaseGenModel):
     def set_generation_params(self, use_sampling: bool = True, top_k: int = 250,
                               top_p: float = 0.0, temperature: float = 1.0,
                               duration: float = 10.0, cfg_coef: float = 3.0,
-                              two_step_cfg: bool = False, extend_stride: float = 2):
+                              two_step_cfg: bool = False, extend_stride: float = 2,
+                              rolling_context: bool = False):
         """Set the generation parameters for AudioGen.
 
         Args:
@@ -79,9 +80,13 @@ class AudioGen(BaseGenModel):
             extend_stride: when doing extended generation (i.e. more than 10 seconds), by how much
                 should we extend the audio each time. Larger values will mean less context is
                 preserved, and shorter value will require extra computations.
+            rolling_context (bool, optional): If True, extended generation runs in a single pass attending
+                to the last 10 seconds of tokens, instead of restarting every `extend_stride` seconds with
+                the previous tokens as prompt. Defaults to False.
         """
         assert extend_stride < self.max_duration, "Cannot stride by more than max generation duration."
         self.extend_stride = extend_stride
+        self.rolling_context = rolling_context
         self.duration = duration
         self.generation_params = {
             'use_sampling': use_sampling,
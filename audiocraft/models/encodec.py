@@ -20,6 +20,7 @@ from torch import nn
 from transformers import EncodecModel as HFEncodecModel
 
 from .. import quantization as qt
+from ..modules.streaming import StreamingModule
 
 
 logger = logging.getLogger()
@@ -49,6 +50,10 @@ class CompressionModel(ABC, nn.Module):
         """Decode from the discrete codes to continuous latent space."""
         ...
 
+    def flush_decode(self, scale: tp.Optional[torch.Tensor] = None) -> tp.Optional[torch.Tensor]:
+        """See `EncodecModel.flush_decode`."""
+        raise NotImplementedError(f"{self.__class__.__name__} doesn't support streaming decoding.")
+
     @property
     @abstractmethod
     def channels(self) -> int:
@@ -122,9 +127,13 @@ class CompressionModel(ABC, nn.Module):
         return model.to(device).eval()
 
 
-class EncodecModel(CompressionModel):
+class EncodecModel(CompressionModel, StreamingModule):
     """Encodec model operating on the raw waveform.
 
+    The decoder supports streaming: within `with model.streaming():`, codes can be provided
+    to `decode` chunk by chunk, and `flush_decode` returns the end of the audio once the last codes
+    were provided. The concatenation of all the chunks matches the output of a single `decode` call.
+
     Args:
         encoder (nn.Module): Encoder network.
         decoder (nn.Module): Decoder network.
@@ -247,6 +256,7 @@ class EncodecModel(CompressionModel):
 
         Returns:
             out (torch.Tensor): Float tensor of shape [B, C, T], the reconstructed audio.
+                In streaming mode, only the audio that no longer depends on the next codes is returned.
         """
         emb = self.decode_latent(codes)
         out = self.decoder(emb)
@@ -254,6 +264,22 @@ class EncodecModel(CompressionModel):
         # out contains extra padding added by the encoder and decoder
         return out
 
+    def flush_decode(self, scale: tp.Optional[torch.Tensor] = None) -> tp.Optional[torch.Tensor]:
+        """Return the audio still held by the streaming decoder once all the codes were provided to `decode`,
+        and reset the decoder streaming state so that a new sequence can be decoded.
+
+        Args:
+            scale (torch.Tensor, optional): Float tensor containing the scale value.
+
+        Returns:
+            out (torch.Tensor, optional): Float tensor of shape [B, C, T], or None if no codes were provided.
+        """
+        assert self._is_streaming, "flush_decode is only supported in streaming mode."
+        out = self.decoder.flush()
+        if out is None:
+            return None
+        return self.postprocess(out, scale)
+
     def decode_latent(self, codes: torch.Tensor):
         """Decode from the discrete codes to continuous latent space."""
         return self.quantizer.decode(codes)
@@ -394,7 +420,7 @@ class HFEncodecCompressionModel(CompressionModel):
         self._num_codebooks = n
 
 
-class InterleaveStereoCompressionModel(CompressionModel):
+class InterleaveStereoCompressionModel(CompressionModel, StreamingModule):
     """Wraps a CompressionModel to support stereo inputs. The wrapped model
     will be applied independently to the left and right channels, and both codebooks
     will be interleaved. If the wrapped model returns a representation `[B, K ,T]` per
@@ -497,10 +523,32 @@ class InterleaveStereoCompressionModel(CompressionModel):
             scale_c1 = scale[1, ...]
 
         codes_c0, codes_c1 = self.get_left_right_codes(codes)
+        if self._is_streaming:
+            # both channels share the streaming state of the wrapped model, so they are decoded as one batch.
+            audio = self.model.decode(torch.cat([codes_c0, codes_c1], dim=0), self._cat_scales(scale_c0, scale_c1))
+            return torch.cat(audio.chunk(2, dim=0), dim=1)
         audio_c0 = self.model.decode(codes_c0, scale_c0)
         audio_c1 = self.model.decode(codes_c1, scale_c1)
         return torch.cat([audio_c0, audio_c1], dim=1)
 
+    def flush_decode(self, scale: tp.Optional[torch.Tensor] = None) -> tp.Optional[torch.Tensor]:
+        """See `EncodecModel.flush_decode`."""
+        scale_c0, scale_c1 = None, None
+        if scale is not None:
+            scale_c0 = scale[0, ...]
+            scale_c1 = scale[1, ...]
+        audio = self.model.flush_decode(self._cat_scales(scale_c0, scale_c1))
+        if audio is None:
+            return None
+        return torch.cat(audio.chunk(2, dim=0), dim=1)
+
+    @staticmethod
+    def _cat_scales(scale_c0: tp.Optional[torch.Tensor],
+                    scale_c1: tp.Optional[torch.Tensor]) -> tp.Optional[torch.Tensor]:
+        if scale_c0 is None or scale_c1 is None:
+            return None
+        return torch.cat([scale_c0, scale_c1], dim=0)
+
     def decode_latent(self, codes: torch.Tensor):
         """Decode from the discrete codes to continuous latent space."""
         raise NotImplementedError("Not supported by interleaved stereo wrapped models.")
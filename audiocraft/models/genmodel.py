@@ -23,6 +23,8 @@ from .builders import get_wrapped_compression_model
 from ..data.audio_utils import convert_audio
 from ..modules.conditioners import ConditioningAttributes
 from ..utils.autocast import TorchAutocast
+from ..utils.cache import LRUTensorCache, hash_tensor
+from ..utils.utils import Generators
 
 
 class BaseGenModel(ABC):
@@ -68,9 +70,15 @@ class BaseGenModel(ABC):
         # than self.max_duration. NOTE: the derived class must set self.extend_stride to a
         # positive float value when generating with self.duration > self.max_duration.
         self.extend_stride: tp.Optional[float] = None
+        # when True, generation beyond self.max_duration runs in a single pass of the LM, attending
+        # only to the last self.max_duration of tokens, see `_generate_tokens_rolling`.
+        self.rolling_context: bool = False
         self.device = next(iter(lm.parameters())).device
         self.generation_params: dict = {}
+        # generator only used by the next generation, see `_pop_generation_params`.
+        self._generator: tp.Optional[Generators] = None
         self._progress_callback: tp.Optional[tp.Callable[[int, int], None]] = None
+        self._prompt_cache: tp.Optional[LRUTensorCache] = None
         if self.device.type == 'cpu':
             self.autocast = TorchAutocast(enabled=False)
         else:
@@ -96,6 +104,59 @@ class BaseGenModel(ABC):
         """Override the default progress callback."""
         self._progress_callback = progress_callback
 
+    def set_prefix_cache(self, max_bytes: int = 0):
+        """Cache the tokens of the audio prompts and the state of the language model after processing them,
+        so that generating again from the same prompt and conditions, e.g. several continuations
+        of the same audio, skips both the encoding of the prompt and the prefill of the language model.
+        The cached states are large, around the size of the attention keys and values over the prompt
+        for each sample, and the least recently used ones are evicted to stay within the budget.
+
+        Args:
+            max_bytes (int): Memory budget of the caches in bytes, 0 disabling them.
+        """
+        if max_bytes > 0:
+            self._prompt_cache = LRUTensorCache(max_bytes // 16)
+            self.lm.prefix_cache = LRUTensorCache(max_bytes - max_bytes // 16)
+        else:
+            self._prompt_cache = None
+            self.lm.prefix_cache = None
+
+    def prefix_cache_stats(self) -> tp.Dict[str, tp.Dict[str, int]]:
+        """Statistics of the prompt and prefix caches, see `set_prefix_cache`."""
+        stats = {}
+        if self._prompt_cache is not None:
+            stats['prompt'] = self._prompt_cache.stats()
+        if self.lm.prefix_cache is not None:
+            stats['prefix'] = self.lm.prefix_cache.stats()
+        return stats
+
+    def _encode_prompt(self, prompt: torch.Tensor) -> torch.Tensor:
+        """Encode audio prompts of shape [B, C, T] into tokens, reusing the cached tokens of known prompts."""
+        if self._prompt_cache is None:
+            prompt_tokens, scale = self.compression_model.encode(prompt)
+            assert scale is None
+            return prompt_tokens
+        keys = [hash_tensor(wav) for wav in prompt]
+        cached = [self._prompt_cache.get(key) for key in keys]
+        missing = [idx for idx, tokens in enumerate(cached) if tokens is None]
+        if missing:
+            prompt_tokens, scale = self.compression_model.encode(prompt[missing])
+            assert scale is None
+            for idx, tokens in zip(missing, prompt_tokens):
+                cached[idx] = tokens
+                self._prompt_cache.put(keys[idx], tokens.clone())
+        return torch.stack(cached)
+
+    def _pop_generation_params(self) -> dict:
+        """Return the parameters of the next generation of the LM. A generator given to `set_generation_params`
+        is only used by the next generation, instead of silently sharing its state with all the later ones.
+        """
+        generation_params = dict(self.generation_params)
+        if self._generator is not None:
+            generation_params['generator'] = self._generator
+            self._generator = None
+        return generation_params
+
     @abstractmethod
     def set_generation_params(self, *args, **kwargs):
         """Set the generation parameters."""
@@ -126,8 +187,7 @@ class BaseGenModel(ABC):
             if descriptions is not None:
                 assert len(descriptions) == len(prompt), "Prompt and nb. descriptions doesn't match"
             prompt = prompt.to(self.device)
-            prompt_tokens, scale = self.compression_model.encode(prompt)
-            assert scale is None
+            prompt_tokens = self._encode_prompt(prompt)
         else:
             prompt_tokens = None
         return attributes, prompt_tokens
@@ -201,6 +261,7 @@ class BaseGenModel(ABC):
         Returns:
             torch.Tensor: Generated audio, of shape [B, C, T], T is defined by the generation params.
         """
+        generation_params = self._pop_generation_params()
         total_gen_len = int(self.duration * self.frame_rate)
         max_prompt_len = int(min(self.duration, self.max_duration) * self.frame_rate)
         current_gen_offset: int = 0
@@ -227,7 +288,10 @@ class BaseGenModel(ABC):
             with self.autocast:
                 gen_tokens = self.lm.generate(
                     prompt_tokens, attributes,
-                    callback=callback, max_gen_len=total_gen_len, **self.generation_params)
+                    callback=callback, max_gen_len=total_gen_len, **generation_params)
+
+        elif self.rolling_context:
+            gen_tokens = self._generate_tokens_rolling(attributes, prompt_tokens, generation_params, callback)
 
         else:
             assert self.extend_stride is not None, "Stride should be defined to generate beyond max_duration"
@@ -247,7 +311,7 @@ class BaseGenModel(ABC):
                 with self.autocast:
                     gen_tokens = self.lm.generate(
                         prompt_tokens, attributes,
-                        callback=callback, max_gen_len=max_gen_len, **self.generation_params)
+                        callback=callback, max_gen_len=max_gen_len, **generation_params)
                 if prompt_tokens is None:
                     all_tokens.append(gen_tokens)
                 else:
@@ -259,6 +323,23 @@ class BaseGenModel(ABC):
             gen_tokens = torch.cat(all_tokens, dim=-1)
         return gen_tokens
 
+    def _generate_tokens_rolling(self, attributes: tp.List[ConditioningAttributes],
+                                 prompt_tokens: tp.Optional[torch.Tensor], generation_params: dict,
+                                 callback: tp.Optional[tp.Callable[[int, int], None]] = None) -> torch.Tensor:
+        """Generate beyond `max_duration` with a single streaming session of the LM, the self attention
+        only attending to the last `max_duration` of tokens, older keys and values being evicted.
+        Unlike the extension by `extend_stride`, the context is never prefilled again, hence the cost
+        of each step stays constant whatever the duration. Positions keep increasing past the
+        training ones, which the positional embedding of the model must tolerate.
+        """
+        assert not self.lm.fuser.fuse2cond.get('prepend'), \
+            "Rolling context generation does not support conditions prepended to the sequence."
+        past_context = int(self.max_duration * self.frame_rate)
+        with self.autocast:
+            return self.lm.generate(
+                prompt_tokens, attributes, callback=callback, max_gen_len=int(self.duration * self.frame_rate),
+                past_context=past_context, **generation_params)
+
     def generate_audio(self, gen_tokens: torch.Tensor) -> torch.Tensor:
         """Generate Audio from tokens."""
         assert gen_tokens.dim() == 3
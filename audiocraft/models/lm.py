@@ -6,6 +6,7 @@
 
 from dataclasses import dataclass
 from functools import partial
+from hashlib import sha1
 import logging
 import math
 import typing as tp
@@ -14,6 +15,7 @@ import torch
 from torch import nn
 
 from ..utils import utils
+from ..utils.cache import LRUTensorCache, hash_tensor
 from ..modules.streaming import StreamingModule, State
 from ..modules.transformer import StreamingTransformer, create_norm_fn
 from ..modules.conditioners import (
@@ -32,6 +34,51 @@ from ..modules.activations import get_activation_fn
 logger = logging.getLogger(__name__)
 ConditionTensors = tp.Dict[str, ConditionType]
 CFGConditions = tp.Union[ConditionTensors, tp.Tuple[ConditionTensors, ConditionTensors]]
+SamplingParam = tp.Union[int, float, torch.Tensor]
+
+
+def _per_row_param(value: SamplingParam, num_rows: int, device: torch.device,
+                   dtype: torch.dtype) -> torch.Tensor:
+    """Broadcast a sampling parameter given either for the whole batch or per row to a tensor of shape [B]."""
+    if isinstance(value, torch.Tensor):
+        assert value.shape == (num_rows,), \
+            f"Per-row parameter should have shape [{num_rows}], got {list(value.shape)}"
+        return value.to(device=device, dtype=dtype)
+    return torch.full((num_rows,), value, device=device, dtype=dtype)
+
+
+def _select_state_rows(state: State, rows: torch.Tensor) -> State:
+    """Keep only the given batch rows of a streaming state. By convention the first dimension
+    of each state tensor is the batch, except for scalar entries that are shared by all rows."""
+    return {key: value[rows] if value.dim() > 0 else value for key, value in state.items()}
+
+
+def _select_condition_rows(condition_tensors: ConditionTensors, rows: torch.Tensor) -> ConditionTensors:
+    """Keep only the given batch rows of precomputed condition tensors."""
+    return {name: (cond[rows], mask[rows]) for name, (cond, mask) in condition_tensors.items()}
+
+
+def _get_model_rows(cfg_conditions: CFGConditions, rows: torch.Tensor, num_rows: int) -> torch.Tensor:
+    """Return the rows of the model batch holding the given samples, out of `num_rows` samples.
+    With single step CFG, the conditional and null conditions are concatenated along the batch dimension,
+    so that each sample spans several rows of the model batch."""
+    if isinstance(cfg_conditions, dict) and cfg_conditions:
+        copies = next(iter(cfg_conditions.values()))[0].shape[0] // num_rows
+        return torch.cat([rows + copy * num_rows for copy in range(copies)])
+    return rows
+
+
+def _merge_state_rows(states: tp.Sequence[State]) -> State:
+    """Merge streaming states of single samples, as returned by `_select_state_rows` with `_get_model_rows`,
+    into the state of a batch of these samples, each state having as many rows as model rows per sample."""
+    merged: State = {}
+    for key, value in states[0].items():
+        if value.dim() == 0:
+            merged[key] = value.clone()
+        else:
+            # [copies, ...] per sample to [copies * B, ...], following the layout of `_get_model_rows`.
+            merged[key] = torch.stack([state[key] for state in states], dim=1).flatten(0, 1)
+    return merged
 
 
 def get_init_fn(method: str, input_dim: int, init_depth: tp.Optional[int] = None):
@@ -175,6 +222,11 @@ class LMModel(StreamingModule):
         self._init_weights(weight_init, depthwise_init, zero_bias_init)
         self._fsdp: tp.Optional[nn.Module]
         self.__dict__['_fsdp'] = None
+        # when set, the streaming state after the first generation step is cached for each sample,
+        # see `generate_stream`.
+        self.prefix_cache: tp.Optional[LRUTensorCache] = None
+        # statistics of the last generation with a draft model, see `_speculative_decode`.
+        self.speculative_stats: tp.Dict[str, float] = {}
 
     def _init_weights(self, weight_init: tp.Optional[str], depthwise_init: tp.Optional[str], zero_bias_init: bool):
         """Initialization of the transformer module weights.
@@ -325,12 +377,14 @@ class LMModel(StreamingModule):
                            cfg_conditions: CFGConditions,
                            unconditional_state: State,
                            use_sampling: bool = False,
-                           temp: float = 1.0,
-                           top_k: int = 0,
-                           top_p: float = 0.0,
-                           cfg_coef: tp.Optional[float] = None,
+                           temp: tp.Union[float, torch.Tensor] = 1.0,
+                           top_k: tp.Union[int, torch.Tensor] = 0,
+                           top_p: tp.Union[float, torch.Tensor] = 0.0,
+                           cfg_coef: tp.Optional[tp.Union[float, torch.Tensor]] = None,
                            cfg_coef_beta: tp.Optional[float] = None,
-                           two_step_cfg: tp.Optional[bool] = None) -> torch.Tensor:
+                           two_step_cfg: tp.Optional[bool] = None,
+                           generator: tp.Optional[utils.Generators] = None,
+                           logits: tp.Optional[torch.Tensor] = None) -> torch.Tensor:
         """Sample next token from the model given a sequence and a set of conditions. The model supports
         multiple sampling strategies (greedy sampling, softmax, top-k, top-p...).
 
@@ -341,22 +395,74 @@ class LMModel(StreamingModule):
             condition_tensors (dict[str, ConditionType): Set of conditions. If CFG is used,
                 should be twice the batch size, being the concatenation of the conditions + null conditions.
             use_sampling (bool): Whether to use a sampling strategy or not.
-            temp (float): Sampling temperature.
-            top_k (int): K for "top-k" sampling.
-            top_p (float): P for "top-p" sampling.
-            cfg_coef (float, optional): classifier free guidance coefficient
+            temp (float or torch.Tensor): Sampling temperature, or per row temperatures of shape [B].
+            top_k (int or torch.Tensor): K for "top-k" sampling, or per row values of shape [B].
+            top_p (float or torch.Tensor): P for "top-p" sampling, or per row values of shape [B].
+            cfg_coef (float or torch.Tensor, optional): classifier free guidance coefficient,
+                or per row coefficients of shape [B].
             cfg_coef_beta (float, optional): If None, simple classifier free guidance is used with cfg_coef.
                 If not None, we apply double classifier free guidance as introduced in MusicGen-Style
                 in paragraph 4.3 (https://arxiv.org/pdf/2407.12563). This beta coefficient is meant to
                 push the text condition more than the style condition in the case where both text and style
                 conditions are being used.
             two_step_cfg (bool): Whether to run classifier free-guidance with 2 distinct steps.
+            generator (torch.Generator or list of torch.Generator, optional): Generator used for sampling,
+                or one generator per row.
+            logits (torch.Tensor, optional): Logits of the next token, of shape [B, K, card], as returned by
+                `_get_next_logits`, in which case the model is not evaluated.
 
         Returns:
             next_token (torch.Tensor): Next token tensor of shape [B, K, 1].
         """
+        if logits is None:
+            logits = self._get_next_logits(sequence, cfg_conditions, unconditional_state,
+                                           cfg_coef=cfg_coef, cfg_coef_beta=cfg_coef_beta, two_step_cfg=two_step_cfg)
+
+        if any(isinstance(param, torch.Tensor) for param in [temp, top_k, top_p]):
+            return self._sample_per_row(logits, use_sampling, temp, top_k, top_p, generator)
+
+        # Apply softmax for sampling if temp > 0. Else, do greedy sampling to avoid zero division error.
+        if use_sampling and temp > 0.0:
+            probs = torch.softmax(logits / temp, dim=-1)
+            if top_p > 0.0:
+                next_token = utils.sample_top_p(probs, p=top_p, generator=generator)
+            elif top_k > 0:
+                next_token = utils.sample_top_k(probs, k=top_k, generator=generator)
+            else:
+                next_token = utils.multinomial(probs, num_samples=1, generator=generator)
+        else:
+            next_token = torch.argmax(logits, dim=-1, keepdim=True)
+
+        return next_token
+
+    def _get_next_logits(self,
+                         sequence: torch.Tensor,
+                         cfg_conditions: CFGConditions,
+                         unconditional_state: State,
+                         cfg_coef: tp.Optional[tp.Union[float, torch.Tensor]] = None,
+                         cfg_coef_beta: tp.Optional[float] = None,
+                         two_step_cfg: tp.Optional[bool] = None) -> torch.Tensor:
+        """Evaluate the model on the given sequence and return the logits of the next token,
+        with classifier free guidance applied, of shape [B, K, card].
+        See `_sample_next_token` for the description of the arguments.
+        """
+        return self._get_cfg_logits(sequence, cfg_conditions, unconditional_state, cfg_coef=cfg_coef,
+                                    cfg_coef_beta=cfg_coef_beta, two_step_cfg=two_step_cfg)[:, :, -1]
+
+    def _get_cfg_logits(self,
+                        sequence: torch.Tensor,
+                        cfg_conditions: CFGConditions,
+                        unconditional_state: State,
+                        cfg_coef: tp.Optional[tp.Union[float, torch.Tensor]] = None,
+                        cfg_coef_beta: tp.Optional[float] = None,
+                        two_step_cfg: tp.Optional[bool] = None) -> torch.Tensor:
+        """Same as `_get_next_logits` but returning the logits after each step of the sequence,
+        of shape [B, K, S, card].
+        """
         B = sequence.shape[0]
         cfg_coef = self.cfg_coef if cfg_coef is None else cfg_coef
+        if isinstance(cfg_coef, torch.Tensor):
+            cfg_coef = cfg_coef.view(-1, 1, 1, 1)  # broadcast against [B, K, T, card] logits
         model = self if self._fsdp is None else self._fsdp
         two_step_cfg = self.two_step_cfg if two_step_cfg is None else two_step_cfg
         if cfg_coef_beta is not None:
@@ -384,7 +490,7 @@ class LMModel(StreamingModule):
             uncond_logits = model(sequence, conditions=[], condition_tensors=null_condition_tensors)
             unconditional_state.update(self.get_streaming_state())
             self.set_streaming_state(state)
-            logits = uncond_logits + (cond_logits - uncond_logits) * self.cfg_coef
+            logits = uncond_logits + (cond_logits - uncond_logits) * cfg_coef
         else:
             assert isinstance(cfg_conditions, dict)
             condition_tensors = cfg_conditions
@@ -400,53 +506,151 @@ class LMModel(StreamingModule):
             else:
                 logits = all_logits
 
-        logits = logits.permute(0, 1, 3, 2)  # [B, K, card, T]
-        logits = logits[..., -1]  # [B x K x card]
+        return logits  # [B, K, T, card]
 
-        # Apply softmax for sampling if temp > 0. Else, do greedy sampling to avoid zero division error.
-        if use_sampling and temp > 0.0:
-            probs = torch.softmax(logits / temp, dim=-1)
-            if top_p > 0.0:
-                next_token = utils.sample_top_p(probs, p=top_p)
-            elif top_k > 0:
-                next_token = utils.sample_top_k(probs, k=top_k)
-            else:
-                next_token = utils.multinomial(probs, num_samples=1)
-        else:
-            next_token = torch.argmax(logits, dim=-1, keepdim=True)
+    def _sample_per_row(self, logits: torch.Tensor, use_sampling: bool,
+                        temp: SamplingParam, top_k: SamplingParam, top_p: SamplingParam,
+                        generator: tp.Optional[utils.Generators] = None) -> torch.Tensor:
+        """Sample next token with sampling parameters that can differ for each row of the batch,
+        using the same conventions as `_sample_next_token`: rows with temp <= 0 are greedy, then
+        top-p is used if p > 0, top-k if k > 0, and plain sampling otherwise.
 
-        return next_token
+        Args:
+            logits (torch.Tensor): Logits of shape [B, K, card].
+            use_sampling (bool): Whether to use a sampling strategy or not.
+            temp (float or torch.Tensor): Sampling temperature(s).
+            top_k (int or torch.Tensor): K(s) for "top-k" sampling.
+            top_p (float or torch.Tensor): P(s) for "top-p" sampling.
+            generator (torch.Generator or list of torch.Generator, optional): Generator(s) used for sampling.
+        Returns:
+            next_token (torch.Tensor): Next token tensor of shape [B, K, 1].
+        """
+        B = logits.shape[0]
+        greedy_token = torch.argmax(logits, dim=-1, keepdim=True)
+        temp = _per_row_param(temp, B, logits.device, torch.float)
+        sampled_rows = temp > 0.0
+        if not use_sampling or not sampled_rows.any():
+            return greedy_token
+        temp = torch.where(sampled_rows, temp, torch.ones_like(temp))
+        probs = torch.softmax(logits / temp.view(-1, 1, 1), dim=-1)
+        next_token = utils.sample_top_k_top_p(
+            probs,
+            k=_per_row_param(top_k, B, logits.device, torch.long),
+            p=_per_row_param(top_p, B, logits.device, torch.float),
+            generator=generator)
+        return torch.where(sampled_rows.view(-1, 1, 1), next_token, greedy_token)
+
+    def _get_sampling_probs(self, logits: torch.Tensor, use_sampling: bool, temp: float,
+                            top_k: int, top_p: float) -> torch.Tensor:
+        """Return the distribution the next tokens are sampled from given the logits,
+        using the same conventions as `_sample_next_token`, greedy sampling being a one-hot distribution.
+
+        Args:
+            logits (torch.Tensor): Logits of shape [..., card].
+            use_sampling (bool): Whether to use a sampling strategy or not.
+            temp (float): Sampling temperature.
+            top_k (int): K for "top-k" sampling.
+            top_p (float): P for "top-p" sampling.
+        Returns:
+            probs (torch.Tensor): Probabilities of shape [..., card].
+        """
+        if use_sampling and temp > 0.0:
+            probs = torch.softmax(logits.float() / temp, dim=-1)
+            return utils.filter_top_k_top_p(probs, k=top_k, p=top_p)
+        return nn.functional.one_hot(torch.argmax(logits, dim=-1), logits.shape[-1]).float()
 
     @torch.no_grad()
     def generate(self,
                  prompt: tp.Optional[torch.Tensor] = None,
                  conditions: tp.List[ConditioningAttributes] = [],
                  num_samples: tp.Optional[int] = None,
-                 max_gen_len: int = 256,
+                 max_gen_len: tp.Union[int, torch.Tensor] = 256,
                  use_sampling: bool = True,
-                 temp: float = 1.0,
-                 top_k: int = 250,
-                 top_p: float = 0.0,
-                 cfg_coef: tp.Optional[float] = None,
+                 temp: tp.Union[float, torch.Tensor] = 1.0,
+                 top_k: tp.Union[int, torch.Tensor] = 250,
+                 top_p: tp.Union[float, torch.Tensor] = 0.0,
+                 cfg_coef: tp.Optional[tp.Union[float, torch.Tensor]] = None,
                  cfg_coef_beta: tp.Optional[float] = None,
                  two_step_cfg: tp.Optional[bool] = None,
                  remove_prompts: bool = False,
                  check: bool = False,
                  callback: tp.Optional[tp.Callable[[int, int], None]] = None,
+                 static_kv_cache: bool = False,
+                 frame_callback: tp.Optional[tp.Callable[[torch.Tensor, int], None]] = None,
+                 generator: tp.Optional[utils.Generators] = None,
+                 past_context: tp.Optional[int] = None,
+                 draft_lm: tp.Optional['LMModel'] = None,
+                 draft_steps: int = 4,
                  ) -> torch.Tensor:
         """Generate tokens sampling from the model given a prompt or unconditionally. Generation can
         be performed in a greedy fashion or using sampling with top K and top P strategies.
+        See `generate_stream` for the description of the arguments.
+
+        Args:
+            frame_callback (Callable, optional): Called as soon as new timesteps have all their codebooks
+                generated, with the codes of those timesteps, of shape [B, K, n], and the index of the first one.
+                Timesteps are reported in order and follow `remove_prompts`, so that the concatenation of
+                all the frames is equal to the returned codes.
+        Returns:
+            torch.Tensor: Generated tokens.
+        """
+        frames: tp.List[torch.Tensor] = []
+        next_frame = prompt.shape[-1] if remove_prompts and prompt is not None else 0
+        for frame in self.generate_stream(
+                prompt, conditions, num_samples=num_samples, max_gen_len=max_gen_len,
+                use_sampling=use_sampling, temp=temp, top_k=top_k, top_p=top_p, cfg_coef=cfg_coef,
+                cfg_coef_beta=cfg_coef_beta, two_step_cfg=two_step_cfg, remove_prompts=remove_prompts,
+                check=check, callback=callback, static_kv_cache=static_kv_cache, generator=generator,
+                past_context=past_context, draft_lm=draft_lm, draft_steps=draft_steps):
+            if frame_callback is not None:
+                frame_callback(frame, next_frame)
+            next_frame += frame.shape[-1]
+            frames.append(frame)
+        return torch.cat(frames, dim=-1)
+
+    @torch.no_grad()
+    def generate_stream(self,
+                        prompt: tp.Optional[torch.Tensor] = None,
+                        conditions: tp.List[ConditioningAttributes] = [],
+                        num_samples: tp.Optional[int] = None,
+                        max_gen_len: tp.Union[int, torch.Tensor] = 256,
+                        use_sampling: bool = True,
+                        temp: tp.Union[float, torch.Tensor] = 1.0,
+                        top_k: tp.Union[int, torch.Tensor] = 250,
+                        top_p: tp.Union[float, torch.Tensor] = 0.0,
+                        cfg_coef: tp.Optional[tp.Union[float, torch.Tensor]] = None,
+                        cfg_coef_beta: tp.Optional[float] = None,
+                        two_step_cfg: tp.Optional[bool] = None,
+                        remove_prompts: bool = False,
+                        check: bool = False,
+                        callback: tp.Optional[tp.Callable[[int, int], None]] = None,
+                        static_kv_cache: bool = False,
+                        generator: tp.Optional[utils.Generators] = None,
+                        past_context: tp.Optional[int] = None,
+                        draft_lm: tp.Optional['LMModel'] = None,
+                        draft_steps: int = 4,
+                        ) -> tp.Iterator[torch.Tensor]:
+        """Generate tokens sampling from the model given a prompt or unconditionally, yielding the codes
+        of new timesteps as soon as all their codebooks are generated, e.g. with the delay pattern,
+        timestep t is yielded K - 1 sequence steps after its first codebook is sampled.
+        Sampling is the same as with `generate`, which consumes this generator.
+
+        The model is in streaming mode until the generator is exhausted or closed, hence a single
+        generation can run at a time for a given model.
 
         Args:
             prompt (torch.Tensor, optional): Prompt tokens of shape [B, K, T].
             conditions (list of ConditioningAttributes, optional): List of conditions.
             num_samples (int, optional): Number of samples to generate when no prompt and no conditions are given.
-            max_gen_len (int): Maximum generation length.
+            max_gen_len (int or torch.Tensor): Maximum generation length, or per sample lengths of shape [B].
+                With per sample lengths, finished samples are removed from the batch as soon as all their
+                timesteps are generated, and their codes past their own length are set to -1.
             use_sampling (bool): Whether to use a sampling strategy or not.
-            temp (float): Sampling temperature.
-            top_k (int): K for "top-k" sampling.
-            top_p (float): P for "top-p" sampling.
-            cfg_coef (float, optional): Classifier-free guidance coefficient.
+            temp (float or torch.Tensor): Sampling temperature, or per sample temperatures of shape [B].
+            top_k (int or torch.Tensor): K for "top-k" sampling, or per sample values of shape [B].
+            top_p (float or torch.Tensor): P for "top-p" sampling, or per sample values of shape [B].
+            cfg_coef (float or torch.Tensor, optional): Classifier-free guidance coefficient,
+                or per sample coefficients of shape [B].
             cfg_coef_beta (float, optional): If None, simple classifier free guidance is used with cfg_coef.
                 If not None, we apply double classifier free guidance as introduced in MusicGen-Style
                 in paragraph 4.3 (https://arxiv.org/pdf/2407.12563). This beta coefficient is meant to
@@ -456,8 +660,25 @@ class LMModel(StreamingModule):
             remove_prompts (bool): Whether to remove prompts from generation or not.
             check (bool): Whether to apply further checks on generated sequence.
             callback (Callback, optional): Callback function to report generation progress.
-        Returns:
-            torch.Tensor: Generated tokens.
+            static_kv_cache (bool): Whether to preallocate the self attention key/value caches
+                for the whole generation and fill them in place, rather than growing them at every step.
+            generator (torch.Generator or list of torch.Generator, optional): Generator used for sampling,
+                or a list with one generator per sample (None using the global generator), so that each
+                seeded sample is reproducible whatever the other samples in the batch.
+            past_context (int, optional): If set, the self attention only attends to that many past sequence
+                steps, older keys and values being evicted, so that generations longer than the training
+                sequences run in a single pass with a bounded cost per step. The conditions must not be
+                prepended to the sequence, as they would be evicted as well.
+            draft_lm (LMModel, optional): Smaller language model over the same codebooks, used for speculative
+                decoding: it drafts `draft_steps` sequence steps which are then verified in a single forward
+                of this model, with accept/reject sampling so that the output distribution is unchanged,
+                see `_speculative_decode`. Requires a single generation length and sampling parameters
+                shared by the batch, single step classifier free guidance and the dynamic key/value cache.
+            draft_steps (int): Number of sequence steps drafted before each verification.
+        Yields:
+            torch.Tensor: Codes of the newly completed timesteps, of shape [B, K, n]. Timesteps are yielded
+                in order and follow `remove_prompts`, so that the concatenation of all the frames is equal
+                to the codes returned by `generate`.
         """
         assert not self.training, "generation shouldn't be used in training mode."
         first_param = next(iter(self.parameters()))
@@ -509,6 +730,14 @@ class LMModel(StreamingModule):
                     cfg_conditions = self.condition_provider(tokenized)
         else:
             cfg_conditions = {}
+        draft_cfg_conditions: ConditionTensors = {}
+        if draft_lm is not None:
+            assert isinstance(cfg_conditions, dict), "Speculative decoding requires single step CFG."
+            assert (draft_lm.card, draft_lm.num_codebooks) == (self.card, self.num_codebooks), \
+                "The draft model should model the same codebooks."
+            if cfg_conditions:
+                # same conditions for the draft model, including the null conditions.
+                draft_cfg_conditions = draft_lm.condition_provider(draft_lm.condition_provider.tokenize(conditions))
 
         if prompt is None:
             assert num_samples > 0
@@ -516,6 +745,15 @@ class LMModel(StreamingModule):
 
         B, K, T = prompt.shape
         start_offset = T
+        if generator is not None and not isinstance(generator, torch.Generator):
+            generator = list(generator)
+            assert len(generator) == B, f"Expected one generator per sample ({B}), got {len(generator)}"
+
+        gen_lens: tp.Optional[torch.Tensor] = None
+        if isinstance(max_gen_len, torch.Tensor):
+            gen_lens = _per_row_param(max_gen_len, B, device, torch.long)
+            max_gen_len = int(gen_lens.max().item())
+            assert start_offset < int(gen_lens.min().item())
         assert start_offset < max_gen_len
 
         pattern = self.pattern_provider.get_pattern(max_gen_len)
@@ -532,56 +770,407 @@ class LMModel(StreamingModule):
         # it is the first sequence step that contains the `start_offset` timestep
         start_offset_sequence = pattern.get_first_step_with_timesteps(start_offset)
         assert start_offset_sequence is not None
+        gen_sequence_len = gen_sequence.shape[-1]  # gen_sequence shape is [B, K, S]
 
-        with self.streaming():
+        # with per sample lengths, each sample is done after the last sequence step holding its last timestep.
+        completion_steps = pattern.get_completion_steps()
+        end_steps: tp.Optional[torch.Tensor] = None
+        if gen_lens is not None:
+            end_steps = torch.tensor([completion_steps[length - 1] for length in gen_lens.tolist()], device=device)
+        if end_steps is not None or any(isinstance(param, torch.Tensor) for param in [temp, top_k, top_p, cfg_coef]):
+            temp = _per_row_param(temp, B, device, torch.float)
+            top_k = _per_row_param(top_k, B, device, torch.long)
+            top_p = _per_row_param(top_p, B, device, torch.float)
+            if cfg_coef is not None:
+                cfg_coef = _per_row_param(cfg_coef, B, device, torch.float)
+        # indices of the samples that are still being generated, None meaning all of them.
+        active: tp.Optional[torch.Tensor] = None
+        # timesteps from `next_frame` are yielded once completed.
+        next_frame = 0 if not remove_prompts else start_offset
+        _, frame_indexes, _ = pattern.revert_pattern_sequence(gen_sequence, special_token=unknown_token)
+        frame_indexes = frame_indexes[:, :max_gen_len]
+        # the first streaming step processes the whole prompt, then we append one step at a time.
+        static_kv_cache_steps = gen_sequence_len - start_offset_sequence if static_kv_cache else None
+        if static_kv_cache_steps is not None and past_context is not None:
+            # the preallocated caches only need to hold the receptive field, see `_complete_static_kv`.
+            static_kv_cache_steps = min(static_kv_cache_steps, 2 * past_context)
+        # with a prefix cache, the first step, which processes the whole prompt, is restored from the cache
+        # when it holds all the samples, e.g. when generating several continuations of the same prompt.
+        prefix_keys: tp.Optional[tp.List[str]] = None
+        if self.prefix_cache is not None:
+            prefix_keys = self._get_prefix_keys(
+                gen_sequence[..., :start_offset_sequence], cfg_conditions,
+                cfg_coef=self.cfg_coef if cfg_coef is None else cfg_coef, cfg_coef_beta=cfg_coef_beta,
+                two_step_cfg=self.two_step_cfg if two_step_cfg is None else two_step_cfg,
+                static_kv_cache_steps=static_kv_cache_steps, past_context=past_context)
+        if draft_lm is not None:
+            assert gen_lens is None and not any(
+                isinstance(param, torch.Tensor) for param in [temp, top_k, top_p, cfg_coef]), \
+                "Speculative decoding requires a generation length and sampling parameters shared by the batch."
+            assert generator is None or isinstance(generator, torch.Generator), \
+                "Speculative decoding doesn't support per sample generators."
+            assert static_kv_cache_steps is None and past_context is None and prefix_keys is None, \
+                "Speculative decoding requires the dynamic key/value cache, without prefix cache."
+            assert start_offset_sequence > 0
+
+        with self.streaming(), self.transformer.static_kv_cache(static_kv_cache_steps), \
+                self.transformer.restrict_past_context(past_context):
             unconditional_state = self.get_streaming_state()
             prev_offset = 0
-            gen_sequence_len = gen_sequence.shape[-1]  # gen_sequence shape is [B, K, S]
-            for offset in range(start_offset_sequence, gen_sequence_len):
-                # get current sequence (note that the streaming API is providing the caching over previous offsets)
-                curr_sequence = gen_sequence[..., prev_offset:offset]
-                curr_mask = mask[None, ..., prev_offset:offset].expand(B, -1, -1)
-                if check:
-                    # check coherence between mask and sequence
-                    assert (curr_sequence == torch.where(curr_mask, curr_sequence, self.special_token_id)).all()
-                    # should never happen as gen_sequence is filled progressively
-                    assert not (curr_sequence == unknown_token).any()
-                # sample next token from the model, next token shape is [B, K, 1]
-                next_token = self._sample_next_token(
-                    curr_sequence, cfg_conditions, unconditional_state, use_sampling, temp, top_k, top_p,
-                    cfg_coef=cfg_coef, cfg_coef_beta=cfg_coef_beta, two_step_cfg=two_step_cfg)
-                # ensure the tokens that should be masked are properly set to special_token_id
-                # as the model never output special_token_id
-                valid_mask = mask[..., offset:offset+1].expand(B, -1, -1)
-                next_token[~valid_mask] = self.special_token_id
-                # ensure we don't overwrite prompt tokens, we only write over unknown tokens
-                # (then mask tokens should be left as is as well, which is correct)
-                gen_sequence[..., offset:offset+1] = torch.where(
-                    gen_sequence[..., offset:offset+1] == unknown_token,
-                    next_token, gen_sequence[..., offset:offset+1]
-                )
-                prev_offset = offset
+            offsets: tp.Iterable[int] = range(start_offset_sequence, gen_sequence_len)
+            if draft_lm is not None:
+                assert isinstance(cfg_conditions, dict) and not isinstance(cfg_coef, torch.Tensor)
+                assert isinstance(generator, (torch.Generator, type(None)))
+                offsets = self._speculative_decode(
+                    draft_lm, draft_steps, gen_sequence, start_offset_sequence, cfg_conditions,
+                    draft_cfg_conditions, use_sampling, float(temp), int(top_k), float(top_p),
+                    cfg_coef=cfg_coef, cfg_coef_beta=cfg_coef_beta, generator=generator)
+            for offset in offsets:
+                if draft_lm is None:
+                    if end_steps is not None:
+                        rows = torch.arange(B, device=device) if active is None else active
+                        keep = end_steps[rows] >= offset
+                        if not keep.all():
+                            # retire finished samples so that they no longer cost any compute.
+                            active = rows[keep]
+                            cfg_conditions = self._retire_rows(keep, cfg_conditions, unconditional_state)
+                            assert isinstance(temp, torch.Tensor) and isinstance(top_k, torch.Tensor)
+                            assert isinstance(top_p, torch.Tensor)
+                            temp, top_k, top_p = temp[keep], top_k[keep], top_p[keep]
+                            if isinstance(cfg_coef, torch.Tensor):
+                                cfg_coef = cfg_coef[keep]
+                            if isinstance(generator, list):
+                                generator = [gen for gen, kept in zip(generator, keep.tolist()) if kept]
+                    # get current sequence (note that the streaming API is providing the caching over previous offsets)
+                    if active is None:
+                        curr_sequence = gen_sequence[..., prev_offset:offset]
+                    else:
+                        curr_sequence = gen_sequence[active, :, prev_offset:offset]
+                    curr_B = curr_sequence.shape[0]
+                    curr_mask = mask[None, ..., prev_offset:offset].expand(curr_B, -1, -1)
+                    if check:
+                        # check coherence between mask and sequence
+                        assert (curr_sequence == torch.where(curr_mask, curr_sequence, self.special_token_id)).all()
+                        # should never happen as gen_sequence is filled progressively
+                        assert not (curr_sequence == unknown_token).any()
+                    logits: tp.Optional[torch.Tensor] = None
+                    if prefix_keys is not None and offset == start_offset_sequence:
+                        logits = self._restore_prefix(prefix_keys, unconditional_state)
+                        if logits is None:
+                            logits = self._get_next_logits(
+                                curr_sequence, cfg_conditions, unconditional_state,
+                                cfg_coef=cfg_coef, cfg_coef_beta=cfg_coef_beta, two_step_cfg=two_step_cfg)
+                            self._store_prefix(prefix_keys, logits, cfg_conditions, unconditional_state)
+                    # sample next token from the model, next token shape is [B, K, 1]
+                    next_token = self._sample_next_token(
+                        curr_sequence, cfg_conditions, unconditional_state, use_sampling, temp, top_k, top_p,
+                        cfg_coef=cfg_coef, cfg_coef_beta=cfg_coef_beta, two_step_cfg=two_step_cfg,
+                        generator=generator, logits=logits)
+                    # ensure the tokens that should be masked are properly set to special_token_id
+                    # as the model never output special_token_id
+                    valid_mask = mask[..., offset:offset+1].expand(curr_B, -1, -1)
+                    next_token[~valid_mask] = self.special_token_id
+                    # ensure we don't overwrite prompt tokens, we only write over unknown tokens
+                    # (then mask tokens should be left as is as well, which is correct)
+                    if active is None:
+                        gen_sequence[..., offset:offset+1] = torch.where(
+                            gen_sequence[..., offset:offset+1] == unknown_token,
+                            next_token, gen_sequence[..., offset:offset+1]
+                        )
+                    else:
+                        curr_step = gen_sequence[active, :, offset:offset+1]
+                        gen_sequence[active, :, offset:offset+1] = torch.where(
+                            curr_step == unknown_token, next_token, curr_step)
+                    prev_offset = offset
                 if callback is not None:
                     callback(1 + offset - start_offset_sequence, gen_sequence_len - start_offset_sequence)
+                end_frame = next_frame
+                while end_frame < max_gen_len and completion_steps[end_frame] <= offset:
+                    end_frame += 1
+                if end_frame > next_frame:
+                    frames = self._get_frames(gen_sequence, frame_indexes, next_frame, end_frame, gen_lens)
+                    next_frame = end_frame
+                    yield frames
         unconditional_state.clear()
 
         # ensure sequence has been entirely filled
-        assert not (gen_sequence == unknown_token).any()
+        if end_steps is None:
+            assert not (gen_sequence == unknown_token).any()
+        else:
+            filled_steps = torch.arange(gen_sequence_len, device=device)[None, :] <= end_steps[:, None]
+            assert not ((gen_sequence == unknown_token) & filled_steps[:, None, :]).any()
         # ensure gen_sequence pattern and mask are matching
         # which means the gen_sequence is valid according to the pattern
         assert (
             gen_sequence == torch.where(mask[None, ...].expand(B, -1, -1), gen_sequence, self.special_token_id)
         ).all()
+        assert next_frame == max_gen_len, "All the timesteps should have been yielded."
         # get back the codes, trimming the prompt if needed and cutting potentially incomplete timesteps
         out_codes, out_indexes, out_mask = pattern.revert_pattern_sequence(gen_sequence, special_token=unknown_token)
+        out_codes = out_codes[..., :max_gen_len]
+
+        # codes past the length of each sample are not valid, we explicitly mark them as unknown.
+        beyond_len = torch.zeros((B, 1, max_gen_len), dtype=torch.bool, device=device)
+        if gen_lens is not None:
+            beyond_len = torch.arange(max_gen_len, device=device)[None, None, :] >= gen_lens[:, None, None]
+            out_codes = out_codes.masked_fill(beyond_len, unknown_token)
 
         # sanity checks over the returned codes and corresponding masks
-        assert (out_codes[..., :max_gen_len] != unknown_token).all()
+        assert ((out_codes != unknown_token) | beyond_len).all()
         assert (out_mask[..., :max_gen_len] == 1).all()
 
         out_start_offset = start_offset if remove_prompts else 0
-        out_codes = out_codes[..., out_start_offset:max_gen_len]
+        out_codes = out_codes[..., out_start_offset:]
+        beyond_len = beyond_len[..., out_start_offset:]
+
+        # ensure the yielded codes are all valid
+        assert (((out_codes >= 0) & (out_codes <= self.card)) | beyond_len).all()
+
+    def _speculative_decode(self, draft_lm: 'LMModel', draft_steps: int, gen_sequence: torch.Tensor,
+                            start_offset: int, cfg_conditions: ConditionTensors,
+                            draft_cfg_conditions: ConditionTensors, use_sampling: bool, temp: float,
+                            top_k: int, top_p: float, cfg_coef: tp.Optional[float] = None,
+                            cfg_coef_beta: tp.Optional[float] = None,
+                            generator: tp.Optional[torch.Generator] = None) -> tp.Iterator[int]:
+        """Fill a pattern sequence with speculative decoding, yielding the sequence steps in order
+        as soon as they are generated. This model must be in streaming mode.
+
+        At each round, the draft model samples the next `draft_steps` steps one at a time, then this model
+        evaluates all of them in a single streaming forward. A drafted token x is accepted with probability
+        min(1, p(x) / q(x)), with p and q the sampling distributions of this model and of the draft model,
+        and the first rejected token is sampled again from the normalized residual max(0, p - q), so that
+        the tokens follow p exactly (Leviathan et al., 2023, https://arxiv.org/abs/2211.17192).
+        The codebooks of a step being sampled independently given the previous steps, the test is done
+        per codebook, and a step is accepted once all its codebooks are. Each round keeps the steps accepted
+        for all the samples of the batch, plus one step sampled from this model, and the streaming states
+        of both models are rewound past the discarded steps. Statistics of the generation are stored
+        in `speculative_stats`.
+
+        Args:
+            draft_lm (LMModel): Draft model, over the same codebooks.
+            draft_steps (int): Number of sequence steps drafted at each round.
+            gen_sequence (torch.Tensor): Pattern sequence of shape [B, K, S], with -1 for the tokens
+                to generate, filled in place.
+            start_offset (int): First sequence step to generate.
+            cfg_conditions (dict): Condition tensors, including the null conditions with CFG.
+            draft_cfg_conditions (dict): Same conditions, for the draft model.
+            use_sampling (bool): Whether to use a sampling strategy or not.
+            temp (float): Sampling temperature.
+            top_k (int): K for "top-k" sampling.
+            top_p (float): P for "top-p" sampling.
+            cfg_coef (float, optional): Classifier free guidance coefficient, used for both models.
+            cfg_coef_beta (float, optional): Double classifier free guidance coefficient,
+                see `_sample_next_token`.
+            generator (torch.Generator, optional): Generator used for sampling.
+        Yields:
+            int: Generated sequence steps.
+        """
+        S = gen_sequence.shape[-1]
+        cfg_coef = self.cfg_coef if cfg_coef is None else cfg_coef
+        # prompt and special tokens are kept as is.
+        free = gen_sequence == -1
+        # number of sequence steps processed by the streaming states of each model.
+        target_fed = draft_fed = 0
+        rounds = drafted = accepted = 0
+        offset = start_offset
+        with draft_lm.streaming():
+            while offset < S:
+                # the step following the drafted ones is always sampled from this model.
+                n = min(draft_steps, S - 1 - offset)
+                draft_probs = []
+                for step in range(offset, offset + n):
+                    logits = draft_lm._get_next_logits(
+                        gen_sequence[..., draft_fed:step], draft_cfg_conditions, {},
+                        cfg_coef=cfg_coef, cfg_coef_beta=cfg_coef_beta, two_step_cfg=False)
+                    draft_fed = step
+                    probs = self._get_sampling_probs(logits, use_sampling, temp, top_k, top_p)
+                    token = utils.multinomial(probs, num_samples=1, generator=generator)
+                    gen_sequence[..., step:step + 1] = torch.where(
+                        free[..., step:step + 1], token, gen_sequence[..., step:step + 1])
+                    draft_probs.append(probs)
+                # distributions of this model for the drafted steps and the following one, [B, K, n + 1, card].
+                logits = self._get_cfg_logits(
+                    gen_sequence[..., target_fed:offset + n], cfg_conditions, {},
+                    cfg_coef=cfg_coef, cfg_coef_beta=cfg_coef_beta, two_step_cfg=False)
+                target_fed = offset + n
+                target_probs = self._get_sampling_probs(logits[:, :, -(n + 1):], use_sampling, temp, top_k, top_p)
+                rounds += 1
+
+                num_accepted = 0
+                if n > 0:
+                    q_probs = torch.stack(draft_probs, dim=2)  # [B, K, n, card]
+                    tokens = gen_sequence[..., offset:offset + n]
+                    drafted_mask = free[..., offset:offset + n]
+                    index = torch.where(drafted_mask, tokens, torch.zeros_like(tokens))[..., None]
+                    p = target_probs[:, :, :n].gather(-1, index)[..., 0]
+                    q = q_probs.gather(-1, index)[..., 0]
+                    u = torch.rand(p.shape, device=p.device, generator=generator)
+                    token_accepted = (u * q < p) | ~drafted_mask  # [B, K, n]
+                    step_accepted = token_accepted.all(dim=1)  # [B, n]
+                    num_accepted = int(step_accepted.long().cumprod(dim=-1).sum(dim=-1).min().item())
+                    drafted += n
+                    accepted += num_accepted
+                last = offset + num_accepted
+                if num_accepted < n:
+                    # codebooks of the first rejected step are kept if accepted, or sampled from the residual.
+                    p_last = target_probs[:, :, num_accepted]
+                    residual = (p_last - q_probs[:, :, num_accepted]).clamp(min=0)
+                    residual = torch.where(residual.sum(dim=-1, keepdim=True) > 0, residual, p_last)
+                    residual = residual / residual.sum(dim=-1, keepdim=True)
+                    resampled = utils.multinomial(residual, num_samples=1, generator=generator)
+                    token = torch.where(token_accepted[..., num_accepted:num_accepted + 1],
+                                        gen_sequence[..., last:last + 1], resampled)
+                else:
+                    token = utils.multinomial(target_probs[:, :, n], num_samples=1, generator=generator)
+                gen_sequence[..., last:last + 1] = torch.where(
+                    free[..., last:last + 1], token, gen_sequence[..., last:last + 1])
+                # forget the discarded steps, the last one being fed to both models at the next round.
+                if target_fed > last:
+                    self.rewind_streaming(target_fed - last)
+                    target_fed = last
+                if draft_fed > last:
+                    draft_lm.rewind_streaming(draft_fed - last)
+                    draft_fed = last
+                yield from range(offset, last + 1)
+                offset = last + 1
+
+        steps = S - start_offset
+        self.speculative_stats = {
+            'rounds': rounds,
+            'drafted_steps': drafted,
+            'accepted_steps': accepted,
+            'acceptance_rate': accepted / max(drafted, 1),
+            'steps_per_forward': steps / max(rounds, 1),
+        }
+        logger.debug("Speculative decoding: %d steps in %d rounds, %.1f%% of the drafted steps accepted.",
+                     steps, rounds, 100 * self.speculative_stats['acceptance_rate'])
+
+    def _get_frames(self, gen_sequence: torch.Tensor, frame_indexes: torch.Tensor,
+                    start: int, end: int, gen_lens: tp.Optional[torch.Tensor] = None) -> torch.Tensor:
+        """Gather the codes of timesteps [start, end) from a pattern sequence being generated.
+
+        Args:
+            gen_sequence (torch.Tensor): Pattern sequence of shape [B, K, S].
+            frame_indexes (torch.Tensor): Reverted pattern indexes of shape [K, T],
+                see `Pattern.revert_pattern_sequence`.
+            start (int): First timestep to gather.
+            end (int): Timestep to stop at, excluded.
+            gen_lens (torch.Tensor, optional): Per sample lengths, codes past them are set to -1.
+        Returns:
+            torch.Tensor: Codes of shape [B, K, end - start].
+        """
+        B, K, _ = gen_sequence.shape
+        indexes = frame_indexes[:, start:end].reshape(-1)
+        frames = gen_sequence.reshape(B, -1)[:, indexes].view(B, K, end - start)
+        if gen_lens is not None:
+            beyond_len = torch.arange(start, end, device=frames.device)[None, None, :] >= gen_lens[:, None, None]
+            frames = frames.masked_fill(beyond_len, -1)
+        return frames
 
-        # ensure the returned codes are all valid
-        assert (out_codes >= 0).all() and (out_codes <= self.card).all()
-        return out_codes
+    def _get_prefix_keys(self, sequence: torch.Tensor, cfg_conditions: CFGConditions,
+                         cfg_coef: tp.Union[float, torch.Tensor], **params: tp.Any) -> tp.List[str]:
+        """Return the key of each sample in the prefix cache, from the content of the first chunk
+        of its pattern sequence, of its conditions and of the parameters affecting the streaming state
+        and the logits after that chunk. The cache is not aware of the model weights, hence it must be
+        cleared if they change.
+
+        Args:
+            sequence (torch.Tensor): First chunk of the pattern sequence, of shape [B, K, S].
+            cfg_conditions (CFGConditions): CFG conditions, see `generate_stream`.
+            cfg_coef (float or torch.Tensor): Classifier-free guidance coefficient(s).
+            **params: Other parameters of the generation, to be part of the keys.
+        Returns:
+            list of str: Key of each sample.
+        """
+        B = sequence.shape[0]
+        condition_sets = list(cfg_conditions) if isinstance(cfg_conditions, tuple) else [cfg_conditions]
+        keys = []
+        for row in range(B):
+            rows = torch.tensor([row], device=sequence.device)
+            row_cfg_coef = cfg_coef[row].item() if isinstance(cfg_coef, torch.Tensor) else cfg_coef
+            hasher = sha1(repr((row_cfg_coef, sorted(params.items()))).encode())
+            hasher.update(hash_tensor(sequence[row]).encode())
+            for condition_tensors in condition_sets:
+                model_rows = _get_model_rows(condition_tensors, rows, B)
+                for name in sorted(condition_tensors):
+                    cond, mask = condition_tensors[name]
+                    hasher.update(name.encode())
+                    hasher.update(hash_tensor(cond[model_rows]).encode())
+                    hasher.update(hash_tensor(mask[model_rows]).encode())
+            keys.append(hasher.hexdigest())
+        return keys
+
+    def _restore_prefix(self, keys: tp.List[str], unconditional_state: State) -> tp.Optional[torch.Tensor]:
+        """Restore the streaming states after the first generation step from the prefix cache,
+        if all the samples are cached, and return the logits of the next token, of shape [B, K, card].
+        Each sample gets its own copy of the cached states.
+
+        Args:
+            keys (list of str): Key of each sample, see `_get_prefix_keys`.
+            unconditional_state (State): Streaming state for the unconditional pass with two step CFG,
+                updated in place.
+        Returns:
+            torch.Tensor, optional: Logits of the next token, None if any sample is missing from the cache.
+        """
+        assert self.prefix_cache is not None
+        entries = [self.prefix_cache.get(key) for key in keys]
+        if any(entry is None for entry in entries):
+            return None
+        self.set_streaming_state(_merge_state_rows([entry['state'] for entry in entries]))
+        if entries[0]['unconditional_state']:
+            unconditional_state.update(_merge_state_rows([entry['unconditional_state'] for entry in entries]))
+        return torch.stack([entry['logits'] for entry in entries])
+
+    def _store_prefix(self, keys: tp.List[str], logits: torch.Tensor, cfg_conditions: CFGConditions,
+                      unconditional_state: State):
+        """Cache the streaming states after the first generation step and the logits of the next token
+        of each sample missing from the prefix cache, see `_restore_prefix`."""
+        assert self.prefix_cache is not None
+        B = logits.shape[0]
+        state = self.get_streaming_state()
+        for row, key in enumerate(keys):
+            if key in self.prefix_cache:
+                continue
+            rows = torch.tensor([row], device=logits.device)
+            # scalar entries are shared by all rows and may be updated in place, hence are copied.
+            entry = {
+                'state': _select_state_rows(state, _get_model_rows(cfg_conditions, rows, B)),
+                'unconditional_state': _select_state_rows(unconditional_state, rows),
+                'logits': logits[row].clone(),
+            }
+            for name in ['state', 'unconditional_state']:
+                entry[name] = {state_key: value.clone() if value.dim() == 0 else value
+                               for state_key, value in entry[name].items()}
+            self.prefix_cache.put(key, entry)
+
+    def _retire_rows(self, keep: torch.Tensor, cfg_conditions: CFGConditions,
+                     unconditional_state: State) -> CFGConditions:
+        """Remove finished samples from an ongoing streaming generation.
+        The streaming state of the model, the unconditional state used with two step CFG
+        and the CFG conditions are restricted to the samples to keep.
+
+        Args:
+            keep (torch.Tensor): Boolean mask of shape [B] over the samples currently generated.
+            cfg_conditions (CFGConditions): Current CFG conditions, see `generate`.
+            unconditional_state (State): Streaming state for the unconditional pass with two step CFG,
+                updated in place.
+        Returns:
+            CFGConditions: The CFG conditions restricted to the kept samples.
+        """
+        B = keep.shape[0]
+        kept = keep.nonzero().squeeze(1)
+        if isinstance(cfg_conditions, tuple):
+            condition_tensors, null_condition_tensors = cfg_conditions
+            cfg_conditions = (_select_condition_rows(condition_tensors, kept),
+                              _select_condition_rows(null_condition_tensors, kept))
+            model_rows = kept
+            if unconditional_state:
+                unconditional_state.update(_select_state_rows(unconditional_state, kept))
+        elif cfg_conditions:
+            # conditional and null conditions are concatenated along the batch dimension.
+            model_rows = _get_model_rows(cfg_conditions, kept, B)
+            cfg_conditions = _select_condition_rows(cfg_conditions, model_rows)
+        else:
+            model_rows = kept
+        self.set_streaming_state(_select_state_rows(self.get_streaming_state(), model_rows))
+        return cfg_conditions
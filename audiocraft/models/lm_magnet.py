@@ -148,6 +148,9 @@ class MagnetLMModel(LMModel):
                                      top_p=top_p,
                                      callback=callback, **kwargs)
 
+    def generate_stream(self, *args, **kwargs) -> tp.Iterator[torch.Tensor]:
+        raise NotImplementedError("MAGNeT decodes all the timesteps in parallel, use generate instead.")
+
     @torch.no_grad()
     def _generate_magnet(self,
                          prompt: tp.Optional[torch.Tensor] = None,
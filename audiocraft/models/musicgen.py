@@ -20,6 +20,7 @@ from .lm import LMModel
 from .builders import get_debug_compression_model, get_debug_lm_model
 from .loaders import load_compression_model, load_lm_model
 from ..data.audio_utils import convert_audio
+from ..utils.utils import Generators
 from ..modules.conditioners import ConditioningAttributes, WavCondition, StyleConditioner
 
 
@@ -97,7 +98,11 @@ class MusicGen(BaseGenModel):
                               top_p: float = 0.0, temperature: float = 1.0,
                               duration: float = 30.0, cfg_coef: float = 3.0,
                               cfg_coef_beta: tp.Optional[float] = None,
-                              two_step_cfg: bool = False, extend_stride: float = 18,):
+                              two_step_cfg: bool = False, extend_stride: float = 18,
+                              static_kv_cache: bool = False,
+                              generator: tp.Optional[Generators] = None,
+                              rolling_context: bool = False,
+                              draft_model: tp.Optional['MusicGen'] = None, draft_steps: int = 4):
         """Set the generation parameters for MusicGen.
 
         Args:
@@ -117,9 +122,30 @@ class MusicGen(BaseGenModel):
             extend_stride: when doing extended generation (i.e. more than 30 seconds), by how much
                 should we extend the audio each time. Larger values will mean less context is
                 preserved, and shorter value will require extra computations.
+            static_kv_cache (bool, optional): If True, preallocate the attention key/value caches for
+                the whole generation instead of growing them at every decoding step. Defaults to False.
+            generator (torch.Generator or list of torch.Generator, optional): Generator used for sampling,
+                or one generator per generated sample, for reproducible generation. It is only used by
+                the next generation, and should be set again before each seeded generation. Defaults to None.
+            rolling_context (bool, optional): If True, extended generation runs in a single pass attending
+                to the last 30 seconds of tokens, instead of restarting every `extend_stride` seconds with
+                the previous tokens as prompt. Not supported by models prepending conditions to the sequence,
+                such as the melody models. Defaults to False.
+            draft_model (MusicGen, optional): Smaller model sharing the same compression model, e.g. musicgen-small
+                for musicgen-large, drafting `draft_steps` steps that are verified in a single forward of this model,
+                for faster generation with the same output distribution. Requires single step CFG, a single
+                generator, and no static key/value cache nor rolling context. Defaults to None.
+            draft_steps (int, optional): Number of steps drafted before each verification. Defaults to 4.
         """
         assert extend_stride < self.max_duration, "Cannot stride by more than max generation duration."
+        if draft_model is not None:
+            assert draft_model.frame_rate == self.frame_rate and draft_model.sample_rate == self.sample_rate \
+                and draft_model.lm.card == self.lm.card and draft_model.lm.num_codebooks == self.lm.num_codebooks, \
+                "The draft model should share the compression model codebooks."
+            assert not (two_step_cfg or static_kv_cache or rolling_context), \
+                "Speculative decoding requires single step CFG, no static key/value cache and no rolling context."
         self.extend_stride = extend_stride
+        self.rolling_context = rolling_context
         self.duration = duration
         self.generation_params = {
             'use_sampling': use_sampling,
@@ -129,7 +155,12 @@ class MusicGen(BaseGenModel):
             'cfg_coef': cfg_coef,
             'two_step_cfg': two_step_cfg,
             'cfg_coef_beta': cfg_coef_beta,
+            'static_kv_cache': static_kv_cache,
         }
+        self._generator = generator
+        if draft_model is not None:
+            self.generation_params['draft_lm'] = draft_model.lm
+            self.generation_params['draft_steps'] = draft_steps
 
     def set_style_conditioner_params(self, eval_q: int = 3, excerpt_length: float = 3.0,
                                      ds_factor: tp.Optional[int] = None,
@@ -190,6 +221,49 @@ class MusicGen(BaseGenModel):
             return self.generate_audio(tokens), tokens
         return self.generate_audio(tokens)
 
+    def generate_tokens(self, descriptions: tp.List[tp.Optional[str]], durations: tp.Sequence[float],
+                        progress: bool = False,
+                        frame_callback: tp.Optional[tp.Callable[[torch.Tensor, int], None]] = None,
+                        **per_row_params: tp.Sequence[float]) -> tp.List[torch.Tensor]:
+        """Generate the tokens of samples conditioned on text in a single batch, each sample having its own
+        duration, within `max_duration`, and optionally its own sampling parameters. The other parameters
+        are the ones given to `set_generation_params`.
+
+        Args:
+            descriptions (list of str): A list of strings used as text conditioning.
+            durations (list of float): Duration of each sample, in seconds.
+            progress (bool, optional): Flag to display progress of the generation process. Defaults to False.
+            frame_callback (Callable, optional): Called with the generated frames of the batch, of shape [B, K, T],
+                and the index of the first one, as soon as all their codebooks are generated, e.g. for streaming.
+            per_row_params: One value per sample for any of `temperature`, `top_k`, `top_p` and `cfg_coef`.
+        Returns:
+            list of torch.Tensor: Generated tokens of each sample, of shape [1, K, T],
+                T being the number of frames of its duration.
+        """
+        param_names = {'temperature': 'temp', 'top_k': 'top_k', 'top_p': 'top_p', 'cfg_coef': 'cfg_coef'}
+        assert set(per_row_params) <= set(param_names), f"Unexpected parameters: {list(per_row_params)}"
+        assert len(durations) == len(descriptions), "Durations and descriptions should match."
+        assert max(durations) <= self.max_duration, "Cannot generate beyond max_duration in a single batch."
+        generation_params = self._pop_generation_params()
+        for name, values in per_row_params.items():
+            assert len(values) == len(descriptions), f"Expected one value of {name} per sample."
+            generation_params[param_names[name]] = torch.tensor(values, device=self.device)
+        gen_lens = [int(duration * self.frame_rate) for duration in durations]
+
+        def _progress_callback(generated_tokens: int, tokens_to_generate: int):
+            if self._progress_callback is not None:
+                self._progress_callback(generated_tokens, tokens_to_generate)
+            else:
+                print(f'{generated_tokens: 6d} / {tokens_to_generate: 6d}', end='\r')
+
+        attributes, _ = self._prepare_tokens_and_attributes(descriptions, None)
+        with self.autocast:
+            gen_tokens = self.lm.generate(
+                None, attributes, max_gen_len=torch.tensor(gen_lens, device=self.device),
+                callback=_progress_callback if progress else None, frame_callback=frame_callback,
+                **generation_params)
+        return [gen_tokens[idx:idx + 1, :, :gen_len] for idx, gen_len in enumerate(gen_lens)]
+
     @torch.no_grad()
     def _prepare_tokens_and_attributes(
             self,
@@ -242,8 +316,7 @@ class MusicGen(BaseGenModel):
             if descriptions is not None:
                 assert len(descriptions) == len(prompt), "Prompt and nb. descriptions doesn't match"
             prompt = prompt.to(self.device)
-            prompt_tokens, scale = self.compression_model.encode(prompt)
-            assert scale is None
+            prompt_tokens = self._encode_prompt(prompt)
         else:
             prompt_tokens = None
         return attributes, prompt_tokens
@@ -259,6 +332,7 @@ class MusicGen(BaseGenModel):
         Returns:
             torch.Tensor: Generated audio, of shape [B, C, T], T is defined by the generation params.
         """
+        generation_params = self._pop_generation_params()
         total_gen_len = int(self.duration * self.frame_rate)
         max_prompt_len = int(min(self.duration, self.max_duration) * self.frame_rate)
         current_gen_offset: int = 0
@@ -285,7 +359,10 @@ class MusicGen(BaseGenModel):
             with self.autocast:
                 gen_tokens = self.lm.generate(
                     prompt_tokens, attributes,
-                    callback=callback, max_gen_len=total_gen_len, **self.generation_params)
+                    callback=callback, max_gen_len=total_gen_len, **generation_params)
+
+        elif self.rolling_context:
+            gen_tokens = self._generate_tokens_rolling(attributes, prompt_tokens, generation_params, callback)
 
         else:
             # now this gets a bit messier, we need to handle prompts,
@@ -325,7 +402,7 @@ class MusicGen(BaseGenModel):
                 with self.autocast:
                     gen_tokens = self.lm.generate(
                         prompt_tokens, attributes,
-                        callback=callback, max_gen_len=max_gen_len, **self.generation_params)
+                        callback=callback, max_gen_len=max_gen_len, **generation_params)
                 if prompt_tokens is None:
                     all_tokens.append(gen_tokens)
                 else:
@@ -11,6 +11,7 @@ import logging
 import typing as tp
 
 from abc import ABC, abstractmethod
+import numpy as np
 import torch
 
 LayoutCoord = namedtuple('LayoutCoord', ['t', 'q'])  # (timestep, codebook index)
@@ -50,6 +51,7 @@ class Pattern:
     def __post_init__(self):
         assert len(self.layout) > 0
         self._validate_layout()
+        self._build_layout_coords()
         self._build_reverted_sequence_scatter_indexes = lru_cache(100)(self._build_reverted_sequence_scatter_indexes)
         self._build_pattern_sequence_scatter_indexes = lru_cache(100)(self._build_pattern_sequence_scatter_indexes)
         logger.info("New pattern, time steps: %d, sequence steps: %d", self.timesteps, len(self.layout))
@@ -75,22 +77,37 @@ class Pattern:
                 assert len(qs) == len(seq_coords), \
                     f"Multiple entries for a same codebook are found at step {s}"
 
+    def _build_layout_coords(self):
+        """Flatten the layout into arrays of sequence steps, timesteps and codebooks of all the coordinates,
+        ordered by sequence step, from which the scatter indexes are built without iterating over the layout.
+        """
+        num_coords = sum(len(seq_coords) for seq_coords in self.layout)
+        self._coords_s = np.repeat(np.arange(len(self.layout), dtype=np.int64),
+                                   [len(seq_coords) for seq_coords in self.layout])
+        self._coords_t = np.fromiter((coords.t for seq_coords in self.layout for coords in seq_coords),
+                                     dtype=np.int64, count=num_coords)
+        self._coords_q = np.fromiter((coords.q for seq_coords in self.layout for coords in seq_coords),
+                                     dtype=np.int64, count=num_coords)
+        coords_t = self._coords_t[self._coords_s >= 1]
+        max_t_in_seq_coords = int(coords_t.max()) + 1 if len(coords_t) else 0
+        self._max_delay = max_t_in_seq_coords - self.timesteps
+        self._num_valid_steps = len(self.layout[:len(self.layout) - self._max_delay])
+
     @property
     def num_sequence_steps(self):
         return len(self.layout) - 1
 
     @property
     def max_delay(self):
-        max_t_in_seq_coords = 0
-        for seq_coords in self.layout[1:]:
-            for coords in seq_coords:
-                max_t_in_seq_coords = max(max_t_in_seq_coords, coords.t + 1)
-        return max_t_in_seq_coords - self.timesteps
+        return self._max_delay
+
+    @property
+    def num_valid_steps(self):
+        return self._num_valid_steps
 
     @property
     def valid_layout(self):
-        valid_step = len(self.layout) - self.max_delay
-        return self.layout[:valid_step]
+        return self.layout[:self.num_valid_steps]
 
     def starts_with_special_token(self):
         return self.layout[0] == []
@@ -117,6 +134,17 @@ class Pattern:
         steps_with_timesteps = self.get_steps_with_timestep(t, q)
         return steps_with_timesteps[0] if len(steps_with_timesteps) > 0 else None
 
+    def get_completion_steps(self) -> tp.List[int]:
+        """Get for each timestep t < timesteps the last sequence step holding a coordinate for t,
+        i.e. the step after which all the codebooks of timestep t are known.
+        """
+        completion_steps = [0] * self.timesteps
+        for s, seq_coords in enumerate(self.layout):
+            for coords in seq_coords:
+                if coords.t < self.timesteps:
+                    completion_steps[coords.t] = max(completion_steps[coords.t], s)
+        return completion_steps
+
     def _build_pattern_sequence_scatter_indexes(self, timesteps: int, n_q: int, keep_only_valid_steps: bool,
                                                 device: tp.Union[torch.device, str] = 'cpu'):
         """Build scatter indexes corresponding to the pattern, up to the provided sequence_steps.
@@ -133,20 +161,17 @@ class Pattern:
         assert timesteps <= self.timesteps, "invalid number of timesteps used to build the sequence from the pattern"
         # use the proper layout based on whether we limit ourselves to valid steps only or not,
         # note that using the valid_layout will result in a truncated sequence up to the valid steps
-        ref_layout = self.valid_layout if keep_only_valid_steps else self.layout
-        # single item indexing being super slow with pytorch vs. numpy, so we use numpy here
-        indexes = torch.zeros(n_q, len(ref_layout), dtype=torch.long).numpy()
-        mask = torch.zeros(n_q, len(ref_layout), dtype=torch.bool).numpy()
+        num_steps = self.num_valid_steps if keep_only_valid_steps else len(self.layout)
         # fill indexes with last sequence step value that will correspond to our special token
         # the last value is n_q * timesteps as we have flattened z and append special token as the last token
         # which will correspond to the index: n_q * timesteps
-        indexes[:] = n_q * timesteps
-        # iterate over the pattern and fill scattered indexes and mask
-        for s, sequence_coords in enumerate(ref_layout):
-            for coords in sequence_coords:
-                if coords.t < timesteps:
-                    indexes[coords.q, s] = coords.t + coords.q * timesteps
-                    mask[coords.q, s] = 1
+        indexes = np.full((n_q, num_steps), n_q * timesteps, dtype=np.int64)
+        mask = np.zeros((n_q, num_steps), dtype=bool)
+        # scatter all the coordinates of the pattern at once, each sequence step holding at most one per codebook
+        keep = (self._coords_s < num_steps) & (self._coords_t < timesteps)
+        s, t, q = self._coords_s[keep], self._coords_t[keep], self._coords_q[keep]
+        indexes[q, s] = t + q * timesteps
+        mask[q, s] = True
         indexes = torch.from_numpy(indexes).to(device)
         mask = torch.from_numpy(mask).to(device)
         return indexes, mask
@@ -196,28 +221,29 @@ class Pattern:
             indexes (torch.Tensor): Indexes for reconstructing the output, of shape [K, T].
             mask (torch.Tensor): Mask corresponding to indexes that matches valid indexes of shape [K, T].
         """
-        ref_layout = self.valid_layout if keep_only_valid_steps else self.layout
+        num_steps = self.num_valid_steps if keep_only_valid_steps else len(self.layout)
         # TODO(jade): Do we want to further truncate to only valid timesteps here as well?
         timesteps = self.timesteps
         assert n_q == self.n_q, f"invalid number of codebooks for the sequence and the pattern: {n_q} != {self.n_q}"
-        assert sequence_steps <= len(ref_layout), \
-            f"sequence to revert is longer than the defined pattern: {sequence_steps} > {len(ref_layout)}"
+        assert sequence_steps <= num_steps, \
+            f"sequence to revert is longer than the defined pattern: {sequence_steps} > {num_steps}"
 
         # ensure we take the appropriate indexes to keep the model output from the first special token as well
-        if is_model_output and self.starts_with_special_token():
-            ref_layout = ref_layout[1:]
+        first_step = 1 if is_model_output and self.starts_with_special_token() else 0
 
-        # single item indexing being super slow with pytorch vs. numpy, so we use numpy here
-        indexes = torch.zeros(n_q, timesteps, dtype=torch.long).numpy()
-        mask = torch.zeros(n_q, timesteps, dtype=torch.bool).numpy()
         # fill indexes with last sequence step value that will correspond to our special token
-        indexes[:] = n_q * sequence_steps
-        for s, sequence_codes in enumerate(ref_layout):
-            if s < sequence_steps:
-                for code in sequence_codes:
-                    if code.t < timesteps:
-                        indexes[code.q, code.t] = s + code.q * sequence_steps
-                        mask[code.q, code.t] = 1
+        indexes = np.full((n_q, timesteps), n_q * sequence_steps, dtype=np.int64)
+        mask = np.zeros((n_q, timesteps), dtype=bool)
+        s = self._coords_s - first_step
+        keep = (self._coords_s < num_steps) & (s >= 0) & (s < sequence_steps) & (self._coords_t < timesteps)
+        s, t, q = s[keep], self._coords_t[keep], self._coords_q[keep]
+        # a same coordinate may appear at several sequence steps, in which case the last step is kept,
+        # the coordinates being ordered by sequence step
+        _, last = np.unique((q * timesteps + t)[::-1], return_index=True)
+        last = len(s) - 1 - last
+        s, t, q = s[last], t[last], q[last]
+        indexes[q, t] = s + q * sequence_steps
+        mask[q, t] = True
         indexes = torch.from_numpy(indexes).to(device)
         mask = torch.from_numpy(mask).to(device)
         return indexes, mask
@@ -259,7 +285,7 @@ class Pattern:
         """
         B, card, K, S = logits.shape
         indexes, mask = self._build_reverted_sequence_scatter_indexes(
-            S, K, keep_only_valid_steps, is_model_output=True, device=logits.device
+            S, K, keep_only_valid_steps, is_model_output=True, device=str(logits.device)
         )
         logits = logits.reshape(B, card, -1)
         # we append the special token as the last index of our flattened z tensor
@@ -34,7 +34,7 @@ from ..data.audio_utils import convert_audio
 from ..environment import AudioCraftEnvironment
 from ..quantization import ResidualVectorQuantizer
 from ..utils.autocast import TorchAutocast
-from ..utils.cache import EmbeddingCache
+from ..utils.cache import EmbeddingCache, LRUTensorCache, hash_tensor
 from ..utils.utils import collate, hash_trick, length_to_mask, load_clap_state_dict, warn_once
 
 
@@ -381,7 +381,12 @@ class BaseConditioner(nn.Module):
 
 
 class TextConditioner(BaseConditioner):
-    ...
+    def get_cache_key(self, text: TextCondition) -> TextCondition:
+        """Normalize a text condition into the key used to cache the output of the conditioner
+        for this text, see `ConditioningProvider.enable_text_cache`. Texts sharing the same key
+        must produce the same condition.
+        """
+        return text
 
 
 class LUTConditioner(TextConditioner):
@@ -506,6 +511,10 @@ class T5Conditioner(TextConditioner):
         mask[empty_idx, :] = 0  # zero-out index where the input is non-existant
         return inputs
 
+    def get_cache_key(self, text: TextCondition) -> TextCondition:
+        # missing texts are encoded as empty ones, and the T5 tokenizer ignores extra whitespaces.
+        return " ".join((text or "").split())
+
     def forward(self, inputs: tp.Dict[str, torch.Tensor]) -> ConditionType:
         mask = inputs['attention_mask']
         with torch.set_grad_enabled(self.finetune), self.autocast:
@@ -531,6 +540,48 @@ class WaveformConditioner(BaseConditioner):
         self.device = device
         # if False no masking is done, used in ChromaStemConditioner when completing by periodicity a sample.
         self._use_masking = True
+        self.wav_cache: tp.Optional[LRUTensorCache] = None
+
+    def enable_wav_cache(self, max_bytes: int = 256 * 2 ** 20) -> None:
+        """Cache the features extracted from the reference waveforms at evaluation time, keyed by a hash
+        of the waveform and its sample rate, so that conditioning repeatedly on the same waveform only
+        runs the feature extraction once. Unlike the `EmbeddingCache`, it does not require the waveforms
+        to come from files. The cache is never used in training mode.
+
+        Args:
+            max_bytes (int): Memory budget of the cache, the least recently used features are evicted first.
+        """
+        self.wav_cache = LRUTensorCache(max_bytes)
+
+    def disable_wav_cache(self) -> None:
+        self.wav_cache = None
+
+    def _get_cached_wav_features(self, wav: torch.Tensor, sample_rate: int,
+                                 compute_fn: tp.Callable[[torch.Tensor, int], torch.Tensor]) -> torch.Tensor:
+        """Compute `compute_fn(wav, sample_rate)` on a batch of waveforms of shape [B, C, T], returning
+        features with the batch as first dimension. When the wav cache is enabled, the features of the
+        waveforms already seen are taken from the cache and only the other ones are computed.
+        """
+        if self.wav_cache is None or self.training:
+            return compute_fn(wav, sample_rate)
+        keys = [(sample_rate, hash_tensor(item)) for item in wav]
+        features: tp.Dict[tp.Hashable, torch.Tensor] = {}
+        missing: tp.Dict[tp.Hashable, int] = {}  # index of the first waveform for each missing key
+        for idx, key in enumerate(keys):
+            if key in features or key in missing:
+                continue
+            cached = self.wav_cache.get(key)
+            if cached is None:
+                missing[key] = idx
+            else:
+                features[key] = cached
+        if missing:
+            computed = compute_fn(wav[list(missing.values())], sample_rate)
+            for key, item in zip(missing.keys(), computed):
+                item = item.detach()
+                self.wav_cache.put(key, item)
+                features[key] = item
+        return torch.stack([features[key] for key in keys])
 
     def tokenize(self, x: WavCondition) -> WavCondition:
         wav, length, sample_rate, path, seek_time = x
@@ -587,13 +638,18 @@ class ChromaStemConditioner(WaveformConditioner):
             conditions during eval (for cases where we don't want to leak test conditions like MusicCaps).
             Defaults to None.
         n_eval_wavs (int, optional): limits the number of waveforms used for conditioning. Defaults to 0.
+        cache_path (str or Path, optional): Path for pre-computed chroma caching. Defaults to None.
+        cache_max_memory_bytes (int, optional): Memory budget of the in-memory tier of the chroma cache.
+        cache_pin_memory (bool, optional): Whether to keep the in-memory chroma cache in pinned memory.
+        cache_storage (str, optional): On-disk storage of the chroma cache, either 'files' or 'packed'.
         device (tp.Union[torch.device, str], optional): Device for the conditioner.
         **kwargs: Additional parameters for the chroma extractor.
     """
     def __init__(self, output_dim: int, sample_rate: int, n_chroma: int, radix2_exp: int,
                  duration: float, match_len_on_eval: bool = True, eval_wavs: tp.Optional[str] = None,
                  n_eval_wavs: int = 0, cache_path: tp.Optional[tp.Union[str, Path]] = None,
-                 device: tp.Union[torch.device, str] = 'cpu', **kwargs):
+                 cache_max_memory_bytes: int = 2 * 2 ** 30, cache_pin_memory: bool = False,
+                 cache_storage: str = 'files', device: tp.Union[torch.device, str] = 'cpu', **kwargs):
         from demucs import pretrained
         super().__init__(dim=n_chroma, output_dim=output_dim, device=device)
         self.autocast = TorchAutocast(enabled=device != 'cpu', device_type=self.device, dtype=torch.float32)
@@ -613,7 +669,9 @@ class ChromaStemConditioner(WaveformConditioner):
         if cache_path is not None:
             self.cache = EmbeddingCache(Path(cache_path) / 'wav', self.device,
                                         compute_embed_fn=self._get_full_chroma_for_cache,
-                                        extract_embed_fn=self._extract_chroma_chunk)
+                                        extract_embed_fn=self._extract_chroma_chunk,
+                                        max_memory_bytes=cache_max_memory_bytes,
+                                        pin_memory=cache_pin_memory, storage=cache_storage)
 
     def _downsampling_factor(self) -> int:
         return self.chroma.winhop
@@ -732,8 +790,10 @@ class ChromaStemConditioner(WaveformConditioner):
         elif self.cache is not None and no_undefined_paths and no_nullified_cond:
             paths = [Path(p) for p in x.path if p is not None]
             chroma = self.cache.get_embed_from_cache(paths, x)
-        else:
+        elif no_nullified_cond:
             assert all(sr == x.sample_rate[0] for sr in x.sample_rate), "All sample rates in batch should be equal."
+            chroma = self._get_cached_wav_features(x.wav, x.sample_rate[0], self._compute_wav_embedding)
+        else:
             chroma = self._compute_wav_embedding(x.wav, x.sample_rate[0])
 
         if self.match_len_on_eval:
@@ -839,10 +899,9 @@ class FeatureExtractor(WaveformConditioner):
                 if self.compute_mask:
                     self.temp_mask = self._get_mask_wav(x, start)
                 if self.model_name == 'encodec':
-                    tokens = self.feat_extractor.encode(wav)[0]  # type: ignore
+                    tokens = self._get_cached_wav_features(wav, x.sample_rate[0], self._extract_features)
                 elif self.model_name == 'mert':
-                    wav = convert_audio(wav, from_rate=x.sample_rate[0], to_rate=24000, to_channels=1)
-                    embeds = self.feat_extractor(wav.squeeze(-2)).last_hidden_state
+                    embeds = self._get_cached_wav_features(wav, x.sample_rate[0], self._extract_features)
             if self.model_name == 'encodec':
                 tokens = tokens[:, :self.encodec_n_q]
                 embeds = sum([self.embed[k](tokens[:, k]) for k in range(self.encodec_n_q)])  # type: ignore
@@ -851,6 +910,14 @@ class FeatureExtractor(WaveformConditioner):
 
             return embeds  # [B, T, dim]
 
+    @torch.no_grad()
+    def _extract_features(self, wav: torch.Tensor, sample_rate: int) -> torch.Tensor:
+        """Run the feature extractor on an excerpt, returning encodec tokens or MERT hidden states."""
+        if self.model_name == 'encodec':
+            return self.feat_extractor.encode(wav)[0]  # type: ignore
+        wav = convert_audio(wav, from_rate=sample_rate, to_rate=24000, to_channels=1)
+        return self.feat_extractor(wav.squeeze(-2)).last_hidden_state
+
     def _downsampling_factor(self):
         if self.model_name == 'encodec':
             return self.sample_rate / self.feat_extractor.frame_rate
@@ -1089,13 +1156,18 @@ class CLAPEmbeddingConditioner(JointEmbeddingConditioner):
         batch_size (Optional[int]): Batch size for CLAP embedding computation.
         autocast_dtype (str): Autocast for the conditioner.
         cache_path (Optional[str]): Path for pre-computed embeddings caching.
+        cache_max_memory_bytes (int): Memory budget of the in-memory tier of each embeddings cache.
+        cache_pin_memory (bool): Whether to keep the in-memory embeddings caches in pinned memory.
+        cache_storage (str): On-disk storage of the embeddings caches, either 'files' or 'packed'.
         kwargs: Additional parameters for residual vector quantizer.
     """
     def __init__(self, dim: int, output_dim: int, device: str, attribute: str,
                  quantize: bool, n_q: int, bins: int, checkpoint: tp.Union[str, Path], model_arch: str,
                  enable_fusion: bool, sample_rate: int, max_audio_length: int, audio_stride: int,
                  normalize: bool, text_p: bool, batch_size: tp.Optional[int] = None,
-                 autocast_dtype: tp.Optional[str] = 'float32', cache_path: tp.Optional[str] = None, **kwargs):
+                 autocast_dtype: tp.Optional[str] = 'float32', cache_path: tp.Optional[str] = None,
+                 cache_max_memory_bytes: int = 2 * 2 ** 30, cache_pin_memory: bool = False,
+                 cache_storage: str = 'files', **kwargs):
         try:
             import laion_clap  # type: ignore
         except ImportError:
@@ -1128,9 +1200,13 @@ class CLAPEmbeddingConditioner(JointEmbeddingConditioner):
         if cache_path is not None:
             self.wav_cache = EmbeddingCache(Path(cache_path) / 'wav', self.device,
                                             compute_embed_fn=self._get_wav_embedding_for_cache,
-                                            extract_embed_fn=self._extract_wav_embedding_chunk)
+                                            extract_embed_fn=self._extract_wav_embedding_chunk,
+                                            max_memory_bytes=cache_max_memory_bytes,
+                                            pin_memory=cache_pin_memory, storage=cache_storage)
             self.text_cache = EmbeddingCache(Path(cache_path) / 'text', self.device,
-                                             compute_embed_fn=self._get_text_embedding_for_cache)
+                                             compute_embed_fn=self._get_text_embedding_for_cache,
+                                             max_memory_bytes=cache_max_memory_bytes,
+                                             pin_memory=cache_pin_memory, storage=cache_storage)
 
     def _tokenizer(self, texts: tp.Union[str, tp.List[str]]) -> dict:
         # we use the default params from CLAP module here as well
@@ -1466,17 +1542,91 @@ class ClassifierFreeGuidanceDropout(DropoutModule):
         return f"ClassifierFreeGuidanceDropout(p={self.p})"
 
 
+class _CachedTextBatch(tp.NamedTuple):
+    """Tokenized text batch when the text cache is enabled, see `ConditioningProvider.enable_text_cache`."""
+    keys: tp.List[tp.Hashable]  # cache key of each item of the batch
+    cached: tp.Dict[tp.Hashable, ConditionType]  # conditions already found in the cache
+    missing: tp.List[tp.Hashable]  # unique keys to compute, in the order of `tokenized`
+    tokenized: tp.Any  # tokenized representation of the missing texts, or None if everything was cached
+
+
 class ConditioningProvider(nn.Module):
     """Prepare and provide conditions given all the supported conditioners.
 
     Args:
         conditioners (dict): Dictionary of conditioners.
         device (torch.device or str, optional): Device for conditioners and output condition types.
+        text_cache_max_bytes (int): If > 0, enable the cache of text conditions at evaluation time
+            with the given memory budget, see `enable_text_cache`.
+        wav_cache_max_bytes (int): If > 0, enable the cache of waveform features at evaluation time
+            with the given memory budget, see `enable_wav_cache`.
     """
-    def __init__(self, conditioners: tp.Dict[str, BaseConditioner], device: tp.Union[torch.device, str] = "cpu"):
+    def __init__(self, conditioners: tp.Dict[str, BaseConditioner], device: tp.Union[torch.device, str] = "cpu",
+                 text_cache_max_bytes: int = 0, wav_cache_max_bytes: int = 0):
         super().__init__()
         self.device = device
         self.conditioners = nn.ModuleDict(conditioners)
+        self.text_cache: tp.Optional[LRUTensorCache] = None
+        if text_cache_max_bytes > 0:
+            self.enable_text_cache(text_cache_max_bytes)
+        if wav_cache_max_bytes > 0:
+            self.enable_wav_cache(wav_cache_max_bytes)
+
+    def enable_text_cache(self, max_bytes: int = 256 * 2 ** 20) -> None:
+        """Cache the `(embeds, mask)` computed by the text conditioners at evaluation time, keyed by conditioner
+        name and normalized text. Only the texts missing from the cache are tokenized and run through the text
+        encoder, which removes the text encoder from the latency of repeated prompts, and of the null condition
+        used for classifier free guidance. The cache is never used in training mode.
+
+        Args:
+            max_bytes (int): Memory budget of the cache, the least recently used conditions are evicted first.
+        """
+        self.text_cache = LRUTensorCache(max_bytes)
+
+    def disable_text_cache(self) -> None:
+        self.text_cache = None
+
+    def text_cache_stats(self) -> tp.Dict[str, int]:
+        """Return the hit and miss counters of the text cache, and its size."""
+        if self.text_cache is None:
+            return {}
+        return self.text_cache.stats()
+
+    def enable_wav_cache(self, max_bytes: int = 256 * 2 ** 20) -> None:
+        """Enable the cache of the features extracted from the reference waveforms for all the waveform
+        conditioners (e.g. stems and chroma for melody, style features, drums codes),
+        see `WaveformConditioner.enable_wav_cache`.
+
+        Args:
+            max_bytes (int): Memory budget of the cache of each waveform conditioner.
+        """
+        for conditioner in self.conditioners.values():
+            if isinstance(conditioner, WaveformConditioner):
+                conditioner.enable_wav_cache(max_bytes)
+
+    def disable_wav_cache(self) -> None:
+        for conditioner in self.conditioners.values():
+            if isinstance(conditioner, WaveformConditioner):
+                conditioner.disable_wav_cache()
+
+    def embedding_cache_stats(self) -> tp.Dict[str, tp.Dict[str, int]]:
+        """Return the statistics of the in-memory tier of the `EmbeddingCache` of each conditioner,
+        keyed by `attribute.cache_name`, e.g. `self_wav.cache`.
+        """
+        stats = {}
+        for attribute, conditioner in self.conditioners.items():
+            for name, value in vars(conditioner).items():
+                if isinstance(value, EmbeddingCache):
+                    stats[f"{attribute}.{name}"] = value.stats()
+        return stats
+
+    def wav_cache_stats(self) -> tp.Dict[str, tp.Dict[str, int]]:
+        """Return the statistics of the wav cache of each waveform conditioner with the cache enabled."""
+        return {
+            attribute: conditioner.wav_cache.stats()
+            for attribute, conditioner in self.conditioners.items()
+            if isinstance(conditioner, WaveformConditioner) and conditioner.wav_cache is not None
+        }
 
     @property
     def joint_embed_conditions(self):
@@ -1523,9 +1673,51 @@ class ConditioningProvider(nn.Module):
         )
 
         for attribute, batch in chain(text.items(), wavs.items(), joint_embeds.items()):
-            output[attribute] = self.conditioners[attribute].tokenize(batch)
+            output[attribute] = self._tokenize_attribute(attribute, batch)
         return output
 
+    def _tokenize_attribute(self, attribute: str, batch: tp.Any) -> tp.Any:
+        conditioner = self.conditioners[attribute]
+        if self.text_cache is None or self.training or not isinstance(conditioner, TextConditioner):
+            return conditioner.tokenize(batch)
+        keys: tp.List[tp.Hashable] = [(attribute, conditioner.get_cache_key(text)) for text in batch]
+        cached: tp.Dict[tp.Hashable, ConditionType] = {}
+        missing: tp.Dict[tp.Hashable, TextCondition] = {}
+        for key, text in zip(keys, batch):
+            if key in cached or key in missing:
+                continue
+            condition = self.text_cache.get(key)
+            if condition is None:
+                missing[key] = text
+            else:
+                cached[key] = condition
+        tokenized = conditioner.tokenize(list(missing.values())) if missing else None
+        return _CachedTextBatch(keys, cached, list(missing.keys()), tokenized)
+
+    def _forward_cached_text(self, attribute: str, inputs: _CachedTextBatch) -> ConditionType:
+        """Compute the missing text conditions, store them in the cache, and pad all the conditions of the batch
+        to the longest one, as the conditioner would do when running on the whole batch.
+        """
+        assert self.text_cache is not None
+        conditions = dict(inputs.cached)
+        if inputs.tokenized is not None:
+            embeds, mask = self.conditioners[attribute](inputs.tokenized)
+            for idx, key in enumerate(inputs.missing):
+                # drop the padding, keeping at least one step as the conditioner does for empty texts.
+                length = max(1, int(mask[idx].sum().item()))
+                condition = (embeds[idx, :length].detach(), mask[idx, :length].detach())
+                self.text_cache.put(key, condition)
+                conditions[key] = condition
+        embed_ref, mask_ref = next(iter(conditions.values()))
+        max_length = max(conditions[key][0].shape[0] for key in inputs.keys)
+        embeds = embed_ref.new_zeros(len(inputs.keys), max_length, embed_ref.shape[-1])
+        mask = mask_ref.new_zeros(len(inputs.keys), max_length)
+        for idx, key in enumerate(inputs.keys):
+            item_embeds, item_mask = conditions[key]
+            embeds[idx, :item_embeds.shape[0]] = item_embeds
+            mask[idx, :item_mask.shape[0]] = item_mask
+        return embeds, mask
+
     def forward(self, tokenized: tp.Dict[str, tp.Any]) -> tp.Dict[str, ConditionType]:
         """Compute pairs of `(embedding, mask)` using the configured conditioners and the tokenized representations.
         The output is for example:
@@ -1540,7 +1732,10 @@ class ConditioningProvider(nn.Module):
         """
         output = {}
         for attribute, inputs in tokenized.items():
-            condition, mask = self.conditioners[attribute](inputs)
+            if isinstance(inputs, _CachedTextBatch):
+                condition, mask = self._forward_cached_text(attribute, inputs)
+            else:
+                condition, mask = self.conditioners[attribute](inputs)
             output[attribute] = (condition, mask)
         return output
 
@@ -1700,6 +1895,10 @@ class ConditionFuser(StreamingModule):
             for condition in conditions:
                 self.cond2fuse[condition] = fuse_method
 
+    def _rewind_streaming(self, steps: int):
+        if 'offsets' in self._streaming_state:
+            self._streaming_state['offsets'] = self._streaming_state['offsets'] - steps
+
     def forward(
         self,
         input: torch.Tensor,
@@ -13,6 +13,8 @@ from torch import nn
 from torch.nn import functional as F
 from torch.nn.utils import spectral_norm, weight_norm
 
+from .streaming import StreamingModule
+
 
 CONV_NORMALIZATIONS = frozenset(['none', 'weight_norm', 'spectral_norm',
                                  'time_group_norm'])
@@ -47,7 +49,12 @@ def get_norm_module(module: nn.Module, causal: bool = False, norm: str = 'none',
 def get_extra_padding_for_conv1d(x: torch.Tensor, kernel_size: int, stride: int,
                                  padding_total: int = 0) -> int:
     """See `pad_for_conv1d`."""
-    length = x.shape[-1]
+    return get_extra_padding_for_length(x.shape[-1], kernel_size, stride, padding_total)
+
+
+def get_extra_padding_for_length(length: int, kernel_size: int, stride: int,
+                                 padding_total: int = 0) -> int:
+    """Same as `get_extra_padding_for_conv1d` for an input of the given length."""
     n_frames = (length - kernel_size + padding_total) / stride + 1
     ideal_length = (math.ceil(n_frames) - 1) * stride + (kernel_size - padding_total)
     return ideal_length - length
@@ -162,9 +169,13 @@ class NormConvTranspose2d(nn.Module):
         return x
 
 
-class StreamableConv1d(nn.Module):
+class StreamableConv1d(StreamingModule):
     """Conv1d with some builtin handling of asymmetric or causal padding
     and normalization.
+
+    In streaming mode, the input can be provided chunk by chunk. The samples that are not yet
+    covered by a full convolution window are kept in the streaming state, and the final padding
+    is only added by `flush`, so that the concatenated outputs match the offline output.
     """
     def __init__(self, in_channels: int, out_channels: int,
                  kernel_size: int, stride: int = 1, dilation: int = 1,
@@ -182,28 +193,105 @@ class StreamableConv1d(nn.Module):
         self.causal = causal
         self.pad_mode = pad_mode
 
-    def forward(self, x):
-        B, C, T = x.shape
+    def _get_paddings(self) -> tp.Tuple[int, int, int, int]:
+        """Return the effective kernel size, the stride, and the fixed left and right paddings."""
         kernel_size = self.conv.conv.kernel_size[0]
         stride = self.conv.conv.stride[0]
         dilation = self.conv.conv.dilation[0]
         kernel_size = (kernel_size - 1) * dilation + 1  # effective kernel size with dilations
         padding_total = kernel_size - stride
-        extra_padding = get_extra_padding_for_conv1d(x, kernel_size, stride, padding_total)
         if self.causal:
             # Left padding for causal
-            x = pad1d(x, (padding_total, extra_padding), mode=self.pad_mode)
+            padding_left, padding_right = padding_total, 0
         else:
             # Asymmetric padding required for odd strides
             padding_right = padding_total // 2
             padding_left = padding_total - padding_right
-            x = pad1d(x, (padding_left, padding_right + extra_padding), mode=self.pad_mode)
+        return kernel_size, stride, padding_left, padding_right
+
+    def forward(self, x):
+        if self._is_streaming:
+            return self._streaming_forward(x)
+        return self._offline_forward(x)
+
+    def _offline_forward(self, x: torch.Tensor) -> torch.Tensor:
+        B, C, T = x.shape
+        kernel_size, stride, padding_left, padding_right = self._get_paddings()
+        padding_total = padding_left + padding_right
+        extra_padding = get_extra_padding_for_conv1d(x, kernel_size, stride, padding_total)
+        x = pad1d(x, (padding_left, padding_right + extra_padding), mode=self.pad_mode)
         return self.conv(x)
 
+    def _get_min_streaming_length(self) -> int:
+        # Before the left padding can be added, we wait for enough samples so that the
+        # reflect padding on both sides never falls back to the zero padding of `pad1d`
+        # for short inputs. The extra padding is at most `stride - 1`.
+        _, stride, padding_left, padding_right = self._get_paddings()
+        return max(padding_left, padding_right + stride - 1)
+
+    def _apply_conv_to_buffer(self, x: torch.Tensor) -> tp.Tuple[torch.Tensor, torch.Tensor]:
+        """Apply the convolution to all the full windows in the padded buffer `x`,
+        returning the output and the samples to keep for the next windows."""
+        kernel_size, stride, _, _ = self._get_paddings()
+        if x.shape[-1] < kernel_size:
+            return x.new_zeros(x.shape[0], self.conv.conv.out_channels, 0), x
+        n_frames = (x.shape[-1] - kernel_size) // stride + 1
+        y = self.conv(x[..., :(n_frames - 1) * stride + kernel_size])
+        return y, x[..., n_frames * stride:]
+
+    def _streaming_forward(self, x: torch.Tensor) -> torch.Tensor:
+        assert self.conv.norm_type != 'time_group_norm', "GroupNorm doesn't support streaming."
+        _, stride, padding_left, padding_right = self._get_paddings()
+        state = self._streaming_state
+        offset = int(state['offset']) if 'offset' in state else 0
+        new_offset = offset + x.shape[-1]
+        # The last input samples are needed to compute the right padding when flushing.
+        tail = torch.cat([state['tail'], x], dim=-1) if 'tail' in state else x
+        state['tail'] = tail[..., max(0, tail.shape[-1] - padding_right - stride):]
+        buffer = torch.cat([state['buffer'], x], dim=-1) if 'buffer' in state else x
+        state['offset'] = torch.tensor(new_offset)
+
+        min_length = self._get_min_streaming_length()
+        if new_offset <= min_length:
+            state['buffer'] = buffer
+            return x.new_zeros(x.shape[0], self.conv.conv.out_channels, 0)
+        if offset <= min_length:
+            buffer = pad1d(buffer, (padding_left, 0), mode=self.pad_mode)
+        y, state['buffer'] = self._apply_conv_to_buffer(buffer)
+        return y
 
-class StreamableConvTranspose1d(nn.Module):
+    def flush(self, x: tp.Optional[torch.Tensor] = None):
+        ys = [] if x is None else [self(x)]
+        state = self._streaming_state
+        if 'offset' in state:
+            kernel_size, stride, padding_left, padding_right = self._get_paddings()
+            length = int(state['offset'])
+            buffer = state['buffer']
+            if length <= self._get_min_streaming_length():
+                # The left padding was never added, the buffer contains the whole input.
+                ys.append(self._offline_forward(buffer))
+            else:
+                extra_padding = get_extra_padding_for_length(
+                    length, kernel_size, stride, padding_left + padding_right)
+                right = padding_right + extra_padding
+                if right > 0:
+                    padding = pad1d(state['tail'], (0, right), mode=self.pad_mode)[..., -right:]
+                    buffer = torch.cat([buffer, padding], dim=-1)
+                y, buffer = self._apply_conv_to_buffer(buffer)
+                ys.append(y)
+            state.clear()
+        if not ys:
+            return None
+        return torch.cat(ys, dim=-1)
+
+
+class StreamableConvTranspose1d(StreamingModule):
     """ConvTranspose1d with some builtin handling of asymmetric or causal padding
     and normalization.
+
+    In streaming mode, the last input frames are kept in the streaming state and are provided
+    again with the next chunk, so that each output sample is computed in a single call once
+    all the input frames overlapping with it are known. The right trimming is done by `flush`.
     """
     def __init__(self, in_channels: int, out_channels: int,
                  kernel_size: int, stride: int = 1, causal: bool = False,
@@ -218,26 +306,76 @@ class StreamableConvTranspose1d(nn.Module):
             "`trim_right_ratio` != 1.0 only makes sense for causal convolutions"
         assert self.trim_right_ratio >= 0. and self.trim_right_ratio <= 1.
 
-    def forward(self, x):
+    def _get_paddings(self) -> tp.Tuple[int, int]:
+        """Return the fixed left and right paddings trimmed from the output."""
         kernel_size = self.convtr.convtr.kernel_size[0]
         stride = self.convtr.convtr.stride[0]
         padding_total = kernel_size - stride
-
-        y = self.convtr(x)
-
-        # We will only trim fixed padding. Extra padding from `pad_for_conv1d` would be
-        # removed at the very end, when keeping only the right length for the output,
-        # as removing it here would require also passing the length at the matching layer
-        # in the encoder.
         if self.causal:
             # Trim the padding on the right according to the specified ratio
             # if trim_right_ratio = 1.0, trim everything from right
             padding_right = math.ceil(padding_total * self.trim_right_ratio)
             padding_left = padding_total - padding_right
-            y = unpad1d(y, (padding_left, padding_right))
         else:
             # Asymmetric padding required for odd strides
             padding_right = padding_total // 2
             padding_left = padding_total - padding_right
-            y = unpad1d(y, (padding_left, padding_right))
+        return padding_left, padding_right
+
+    def forward(self, x):
+        if self._is_streaming:
+            return self._streaming_forward(x)
+
+        y = self.convtr(x)
+
+        # We will only trim fixed padding. Extra padding from `pad_for_conv1d` would be
+        # removed at the very end, when keeping only the right length for the output,
+        # as removing it here would require also passing the length at the matching layer
+        # in the encoder.
+        y = unpad1d(y, self._get_paddings())
         return y
+
+    def _apply_convtr(self, frames: torch.Tensor, first_frame: int, start: int, end: int) -> torch.Tensor:
+        """Apply the transposed convolution to `frames`, the first one being the input frame
+        with index `first_frame`, and return the output between the (untrimmed) positions `start` and `end`.
+        """
+        stride = self.convtr.convtr.stride[0]
+        if frames.shape[-1] == 0 or end <= start:
+            return frames.new_zeros(frames.shape[0], self.convtr.convtr.out_channels, 0)
+        y = self.convtr(frames)
+        first = first_frame * stride
+        return y[..., start - first:end - first]
+
+    def _streaming_forward(self, x: torch.Tensor) -> torch.Tensor:
+        assert self.convtr.norm_type != 'time_group_norm', "GroupNorm doesn't support streaming."
+        kernel_size = self.convtr.convtr.kernel_size[0]
+        stride = self.convtr.convtr.stride[0]
+        padding_left, _ = self._get_paddings()
+        state = self._streaming_state
+        offset = int(state['offset']) if 'offset' in state else 0
+        frames = torch.cat([state['context'], x], dim=-1) if 'context' in state else x
+        first_frame = offset + x.shape[-1] - frames.shape[-1]
+        new_offset = offset + x.shape[-1]
+        # Output positions before `new_offset * stride` no longer depend on future frames.
+        y = self._apply_convtr(frames, first_frame, max(padding_left, offset * stride), new_offset * stride)
+        # Positions from `new_offset * stride` depend on at most that many past frames.
+        context = math.ceil(kernel_size / stride) - 1
+        state['context'] = frames[..., frames.shape[-1] - min(context, frames.shape[-1]):]
+        state['offset'] = torch.tensor(new_offset)
+        return y
+
+    def flush(self, x: tp.Optional[torch.Tensor] = None):
+        ys = [] if x is None else [self(x)]
+        state = self._streaming_state
+        if 'offset' in state:
+            stride = self.convtr.convtr.stride[0]
+            padding_left, _ = self._get_paddings()
+            length = int(state['offset'])
+            frames = state['context']
+            # The offline output, once trimmed, ends at `length * stride + padding_left`.
+            ys.append(self._apply_convtr(frames, length - frames.shape[-1],
+                                         max(padding_left, length * stride), length * stride + padding_left))
+            state.clear()
+        if not ys:
+            return None
+        return torch.cat(ys, dim=-1)
@@ -90,11 +90,14 @@ class DrumsConditioner(WaveformConditioner):
         self.seq_len = int(segment_duration * compression_model_framerate)
         self.cache = None  # If you wish to train with EmbeddingCache, call self.create_embedding_cache(cache_path)
 
-    def create_embedding_cache(self, cache_path):
+    def create_embedding_cache(self, cache_path, max_memory_bytes: int = 2 * 2 ** 30, pin_memory: bool = False,
+                               storage: str = 'files'):
         if cache_path is not None:
             self.cache = EmbeddingCache(Path(cache_path) / 'wav', self.device,
                                         compute_embed_fn=self._calc_coarse_drum_codes_for_cache,
-                                        extract_embed_fn=self._load_drum_codes_chunk)
+                                        extract_embed_fn=self._load_drum_codes_chunk,
+                                        max_memory_bytes=max_memory_bytes, pin_memory=pin_memory,
+                                        storage=storage)
 
     @torch.no_grad()
     def _get_drums_stem(self, wav: torch.Tensor, sample_rate: int) -> torch.Tensor:
@@ -190,7 +193,7 @@ class DrumsConditioner(WaveformConditioner):
             codes = self.cache.get_embed_from_cache(paths, x)
         else:
             assert all(sr == x.sample_rate[0] for sr in x.sample_rate), "All sample rates in batch should be equal."
-            codes = self._extract_coarse_drum_codes(x.wav, x.sample_rate[0])
+            codes = self._get_cached_wav_features(x.wav, x.sample_rate[0], self._extract_coarse_drum_codes)
 
         assert self.compression_model is not None
         # decode back to the continuous representation of compression model
@@ -256,7 +259,7 @@ class JascoConditioningProvider(ConditioningProvider):
         )
 
         for attribute, batch in chain(text.items(), wavs.items(), symbolic.items()):
-            output[attribute] = self.conditioners[attribute].tokenize(batch)
+            output[attribute] = self._tokenize_attribute(attribute, batch)
         return output
 
     def _collate_symbolic(self, samples: tp.List[ConditioningAttributes],
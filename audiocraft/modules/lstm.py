@@ -4,12 +4,20 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import typing as tp
+
+import torch
 from torch import nn
 
+from .streaming import StreamingModule
+
 
-class StreamableLSTM(nn.Module):
+class StreamableLSTM(StreamingModule):
     """LSTM without worrying about the hidden state, nor the layout of the data.
     Expects input as convolutional layout.
+
+    In streaming mode, the hidden and cell states are carried over from one chunk to the next,
+    until they are reset by `flush`.
     """
     def __init__(self, dimension: int, num_layers: int = 2, skip: bool = True):
         super().__init__()
@@ -17,9 +25,26 @@ class StreamableLSTM(nn.Module):
         self.lstm = nn.LSTM(dimension, dimension, num_layers)
 
     def forward(self, x):
+        if self._is_streaming and x.shape[-1] == 0:
+            return x
         x = x.permute(2, 0, 1)
-        y, _ = self.lstm(x)
+        if self._is_streaming:
+            state = self._streaming_state
+            hidden = None
+            if 'hidden' in state:
+                # streaming state is stored batch first, while the LSTM expects [num_layers, B, C].
+                hidden = (state['hidden'].transpose(0, 1).contiguous(), state['cell'].transpose(0, 1).contiguous())
+            y, (h, c) = self.lstm(x, hidden)
+            state['hidden'] = h.transpose(0, 1)
+            state['cell'] = c.transpose(0, 1)
+        else:
+            y, _ = self.lstm(x)
         if self.skip:
             y = y + x
         y = y.permute(1, 2, 0)
         return y
+
+    def flush(self, x: tp.Optional[torch.Tensor] = None):
+        y = None if x is None else self(x)
+        self._streaming_state.clear()
+        return y
@@ -7,13 +7,15 @@
 import typing as tp
 
 import numpy as np
+import torch
 import torch.nn as nn
 
 from .conv import StreamableConv1d, StreamableConvTranspose1d
 from .lstm import StreamableLSTM
+from .streaming import StreamingModule, StreamingSequential
 
 
-class SEANetResnetBlock(nn.Module):
+class SEANetResnetBlock(StreamingModule):
     """Residual block from SEANet model.
 
     Args:
@@ -48,7 +50,7 @@ class SEANetResnetBlock(nn.Module):
                                  norm=norm, norm_kwargs=norm_params,
                                  causal=causal, pad_mode=pad_mode),
             ]
-        self.block = nn.Sequential(*block)
+        self.block = StreamingSequential(*block)
         self.shortcut: nn.Module
         if true_skip:
             self.shortcut = nn.Identity()
@@ -57,10 +59,38 @@ class SEANetResnetBlock(nn.Module):
                                              causal=causal, pad_mode=pad_mode)
 
     def forward(self, x):
+        if self._is_streaming:
+            return self._add_skip(self.shortcut(x), self.block(x))
         return self.shortcut(x) + self.block(x)
 
+    def _add_skip(self, skip: tp.Optional[torch.Tensor], y: tp.Optional[torch.Tensor]) -> tp.Optional[torch.Tensor]:
+        # In streaming mode, the residual branch lags behind the shortcut as its convolutions
+        # wait for their right context, so the shortcut output is buffered until it can be added.
+        state = self._streaming_state
+        if 'skip' in state:
+            skip = state['skip'] if skip is None else torch.cat([state['skip'], skip], dim=-1)
+        if skip is None:
+            assert y is None
+            return None
+        length = 0 if y is None else y.shape[-1]
+        assert skip.shape[-1] >= length, "Shortcut is expected to be ahead of the residual branch."
+        state['skip'] = skip[..., length:]
+        if y is None:
+            return None
+        return skip[..., :length] + y
 
-class SEANetEncoder(nn.Module):
+    def flush(self, x: tp.Optional[torch.Tensor] = None):
+        if isinstance(self.shortcut, StreamingModule):
+            skip = self.shortcut.flush(x)
+        else:
+            skip = None if x is None else self.shortcut(x)
+        y = self._add_skip(skip, self.block.flush(x))
+        assert 'skip' not in self._streaming_state or self._streaming_state['skip'].shape[-1] == 0
+        self._streaming_state.clear()
+        return y
+
+
+class SEANetEncoder(StreamingModule):
     """SEANet encoder.
 
     Args:
@@ -147,13 +177,16 @@ class SEANetEncoder(nn.Module):
                              norm_kwargs=norm_params, causal=causal, pad_mode=pad_mode)
         ]
 
-        self.model = nn.Sequential(*model)
+        self.model = StreamingSequential(*model)
 
     def forward(self, x):
         return self.model(x)
 
+    def flush(self, x: tp.Optional[torch.Tensor] = None):
+        return self.model.flush(x)
+
 
-class SEANetDecoder(nn.Module):
+class SEANetDecoder(StreamingModule):
     """SEANet decoder.
 
     Args:
@@ -251,8 +284,12 @@ class SEANetDecoder(nn.Module):
             model += [
                 final_act(**final_activation_params)
             ]
-        self.model = nn.Sequential(*model)
+        self.model = StreamingSequential(*model)
 
     def forward(self, z):
         y = self.model(z)
         return y
+
+    def flush(self, z: tp.Optional[torch.Tensor] = None):
+        """Return the remaining output once all the latent frames were provided in streaming mode."""
+        return self.model.flush(z)
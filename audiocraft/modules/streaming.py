@@ -72,6 +72,21 @@ class StreamingModule(nn.Module):
 
         self._apply_named_streaming(_reset)
 
+    def rewind_streaming(self, steps: int):
+        """Rewind the streaming state by the given number of time steps, as if the last `steps` steps
+        had never been processed, e.g. to discard speculative steps. This propagates to all streaming children,
+        each implementing `_rewind_streaming`.
+        """
+        def _rewind(name: str, module: StreamingModule):
+            module._rewind_streaming(steps)
+
+        self._apply_named_streaming(_rewind)
+
+    def _rewind_streaming(self, steps: int):
+        """Rewind the own streaming state of the module, see `rewind_streaming`."""
+        if self._streaming_state:
+            raise NotImplementedError(f"{self.__class__.__name__} doesn't support rewinding its streaming state.")
+
     def get_streaming_state(self) -> State:
         """Return the streaming state, including that of sub-modules."""
         state: State = {}
@@ -13,6 +13,7 @@ See `StreamingTransformer` for more information.
 Unlike regular PyTorch Transformer, we make the hard choice that batches are first.
 """
 
+from contextlib import contextmanager
 import typing as tp
 
 from einops import rearrange
@@ -89,6 +90,17 @@ def create_sin_embedding(positions: torch.Tensor, dim: int, max_period: float =
     return torch.cat([torch.cos(phase), torch.sin(phase)], dim=-1)
 
 
+def _expand_attention_bias(bias: torch.Tensor, batch_size: int, num_heads: int) -> torch.Tensor:
+    """Expand an attention bias of shape [Q, K] to [B, H, Q, K] for xformers, whose kernels
+    expect the last dimension to be padded in memory to a multiple of 8.
+    """
+    q_len, k_len = bias.shape
+    padded_len = (k_len + 7) // 8 * 8
+    expanded = bias.new_empty(batch_size, num_heads, q_len, padded_len)[..., :k_len]
+    expanded.copy_(bias)
+    return expanded
+
+
 def expand_repeated_kv(x: torch.Tensor, n_rep: int, memory_efficient: bool) -> torch.Tensor:
     """torch.repeat_interleave(x, dim=2, repeats=n_rep) from xlformers."""
     if n_rep == 1:
@@ -183,6 +195,9 @@ class StreamingMultiheadAttention(StreamingModule):
         self.num_heads = num_heads
         self.dropout = dropout
         self.kv_repeat = kv_repeat
+        # When set, the streaming keys/values are stored in buffers preallocated at the first
+        # streaming step with room for that many additional steps, see `_complete_static_kv`.
+        self.static_kv_cache_steps: tp.Optional[int] = None
         if cross_attention:
             assert not causal, "Causal cannot work with cross attention."
             assert rope is None, "Rope cannot work with cross attention."
@@ -240,12 +255,18 @@ class StreamingMultiheadAttention(StreamingModule):
             if current_steps == 1:
                 # If we only have one step, then we do not need a mask.
                 return None
-            elif 'past_keys' in self._streaming_state:
-                raise RuntimeError("Not supported at the moment")
-            else:
+            elif 'past_keys' not in self._streaming_state and 'cache_keys' not in self._streaming_state:
                 # Then we can safely use a lower triangular mask
                 return LowerTriangularMask()
-        if self._streaming_state:
+            # Otherwise, e.g. when verifying several drafted steps at once, the queries are the last
+            # steps of the keys, and we need an explicit mask aligned on the bottom right, built below.
+        if 'cache_keys' in self._streaming_state:
+            if current_steps == 1:
+                # The static cache only exposes the keys within the receptive field,
+                # so a single query can attend to all of them without any mask.
+                return None
+            past_steps = self._static_kv_start_and_length()[1]
+        elif self._streaming_state:
             past_keys = self._streaming_state['past_keys']
             past_steps = past_keys.shape[time_dim]
         else:
@@ -270,6 +291,8 @@ class StreamingMultiheadAttention(StreamingModule):
             # are already available, and streaming is with respect
             # to the queries only.
             return k, v
+        if self._is_streaming and self.static_kv_cache_steps is not None:
+            return self._complete_static_kv(k, v)
         # Complete the key/value pair using the streaming state.
         if self._streaming_state:
             pk = self._streaming_state['past_keys']
@@ -288,21 +311,97 @@ class StreamingMultiheadAttention(StreamingModule):
         if self.past_context is not None:
             offset = max(0, nk.shape[time_dim] - self.past_context)
         if self._is_streaming:
-            self._streaming_state['past_keys'] = nk[:, offset:]
+            kept = nk.shape[time_dim] - offset
+            self._streaming_state['past_keys'] = nk.narrow(time_dim, offset, kept)
             if v is not k:
-                self._streaming_state['past_values'] = nv[:, offset:]
+                self._streaming_state['past_values'] = nv.narrow(time_dim, offset, kept)
             if 'offset' in self._streaming_state:
                 self._streaming_state['offset'] += offset
             else:
                 self._streaming_state['offset'] = torch.tensor(0)
         return nk, nv
 
+    def _static_kv_start_and_length(self) -> tp.Tuple[int, int]:
+        # Return the first cached step still within the receptive field, and the number of
+        # past steps from there, matching what `_complete_kv` would keep in `past_keys`.
+        length = int(self._streaming_state['cache_length'].item())
+        start = 0
+        if self.past_context is not None:
+            start = max(0, length - self.past_context)
+        return start, length - start
+
+    def _complete_static_kv(self, k, v):
+        """Same as `_complete_kv` but using preallocated buffers that are written in place,
+        instead of concatenating the past keys and values at every step.
+        The buffers are allocated at the first streaming step, with room for the first chunk
+        plus `static_kv_cache_steps` steps. The number of steps written so far is kept in
+        the `cache_length` entry of the streaming state. With a limited `past_context`,
+        `static_kv_cache_steps` only needs to exceed it for the buffers to be reused indefinitely.
+        """
+        time_dim = _get_attention_time_dimension(self.memory_efficient)
+        assert self.static_kv_cache_steps is not None
+        steps = k.shape[time_dim]
+        if 'cache_keys' not in self._streaming_state:
+            shape = list(k.shape)
+            shape[time_dim] = steps + self.static_kv_cache_steps
+            self._streaming_state['cache_keys'] = k.new_empty(shape)
+            if v is not k:
+                self._streaming_state['cache_values'] = v.new_empty(shape)
+            self._streaming_state['cache_length'] = torch.tensor(0)
+        cache_keys = self._streaming_state['cache_keys']
+        cache_values = self._streaming_state.get('cache_values', cache_keys)
+        start, past_steps = self._static_kv_start_and_length()
+        if start > 0 and start + past_steps + steps > cache_keys.shape[time_dim]:
+            # With a limited receptive field, the steps that went out of it are dropped by moving
+            # the remaining ones to the beginning of the buffers, so that they never need to grow.
+            # The number of dropped steps is kept in `cache_offset` for the rotary embeddings.
+            for cache in [cache_keys] if cache_values is cache_keys else [cache_keys, cache_values]:
+                window = cache.narrow(time_dim, start, past_steps).clone()
+                cache.narrow(time_dim, 0, past_steps).copy_(window)
+            self._streaming_state['cache_offset'] = self._streaming_state.get('cache_offset', torch.tensor(0)) + start
+            self._streaming_state['cache_length'] = torch.tensor(past_steps)
+            start = 0
+        length = start + past_steps
+        end = length + steps
+        assert end <= cache_keys.shape[time_dim], \
+            f"Static kv cache is full ({cache_keys.shape[time_dim]} steps), increase static_kv_cache_steps."
+        cache_keys.narrow(time_dim, length, steps).copy_(k)
+        if v is not k:
+            cache_values.narrow(time_dim, length, steps).copy_(v)
+        self._streaming_state['cache_length'] = torch.tensor(end)
+        nk = cache_keys.narrow(time_dim, start, end - start)
+        nv = nk if v is k else cache_values.narrow(time_dim, start, end - start)
+        return nk, nv
+
+    def _rewind_streaming(self, steps: int):
+        if self.cross_attention or not self._streaming_state:
+            return
+        time_dim = _get_attention_time_dimension(self.memory_efficient)
+        if 'cache_length' in self._streaming_state:
+            start, past_steps = self._static_kv_start_and_length()
+            assert start == 0 and 'cache_offset' not in self._streaming_state and steps <= past_steps, \
+                "Cannot rewind steps that went out of the receptive field."
+            self._streaming_state['cache_length'] = torch.tensor(past_steps - steps)
+            return
+        assert int(self._streaming_state.get('offset', torch.tensor(0)).item()) == 0, \
+            "Cannot rewind steps that went out of the receptive field."
+        for name in ['past_keys', 'past_values']:
+            if name in self._streaming_state:
+                past = self._streaming_state[name]
+                assert steps <= past.shape[time_dim], "Cannot rewind more steps than processed."
+                self._streaming_state[name] = past.narrow(time_dim, 0, past.shape[time_dim] - steps)
+
     def _apply_rope(self, query: torch.Tensor, key: torch.Tensor):
         time_dim = _get_attention_time_dimension(self.memory_efficient)
         # Apply rope embeddings to query and key tensors.
         assert self.rope is not None
+        if 'cache_length' in self._streaming_state:
+            streaming_offset = int(self._streaming_state['cache_length'].item())
+            if 'cache_offset' in self._streaming_state:
+                streaming_offset += int(self._streaming_state['cache_offset'].item())
+            return self.rope.rotate_qk(query, key, start=streaming_offset, time_dim=time_dim)
         if 'past_keys' in self._streaming_state:
-            past_keys_offset = self._streaming_state['past_keys'].shape[1]
+            past_keys_offset = self._streaming_state['past_keys'].shape[time_dim]
         else:
             past_keys_offset = 0
         if 'offset' in self._streaming_state:
@@ -352,13 +451,25 @@ class StreamingMultiheadAttention(StreamingModule):
                     bias_k = self.in_proj_bias[dim: 2 * dim]
                     bias_v = self.in_proj_bias[2 * dim:]
                 q = nn.functional.linear(query, self.in_proj_weight[:dim], bias_q)
-                # todo: when streaming, we could actually save k, v and check the shape actually match.
-                k = nn.functional.linear(key, self.in_proj_weight[dim: 2 * dim], bias_k)
-                v = nn.functional.linear(value, self.in_proj_weight[2 * dim:], bias_v)
                 if self.qk_layer_norm is True:
                     q = self.q_layer_norm(q)
-                    k = self.k_layer_norm(k)
-                q, k, v = [rearrange(x, f"b t (h d) -> {layout}", h=self.num_heads) for x in [q, k, v]]
+                q = rearrange(q, f"b t (h d) -> {layout}", h=self.num_heads)
+                if 'cross_keys' in self._streaming_state:
+                    # The keys and values don't change while streaming, they are projected only
+                    # at the first step and then reused from the streaming state.
+                    k = self._streaming_state['cross_keys']
+                    v = self._streaming_state['cross_values']
+                    assert k.shape[0] == key.shape[0] and k.shape[time_dim] == key.shape[1], \
+                        "Cross attention keys changed while streaming."
+                else:
+                    k = nn.functional.linear(key, self.in_proj_weight[dim: 2 * dim], bias_k)
+                    v = nn.functional.linear(value, self.in_proj_weight[2 * dim:], bias_v)
+                    if self.qk_layer_norm is True:
+                        k = self.k_layer_norm(k)
+                    k, v = [rearrange(x, f"b t (h d) -> {layout}", h=self.num_heads) for x in [k, v]]
+                    if self._is_streaming:
+                        self._streaming_state['cross_keys'] = k
+                        self._streaming_state['cross_values'] = v
             else:
                 if not _is_profiled():
                     # profiling breaks that propertysomehow.
@@ -408,10 +519,20 @@ class StreamingMultiheadAttention(StreamingModule):
                     attn_mask = attn_mask.repeat((q.shape[0], 1, 1, 1))
                     attn_mask = attn_mask[..., :seq_len, :seq_len]
 
+                elif isinstance(attn_mask, torch.Tensor):
+                    # Explicit causal mask of several streaming steps, see `_get_mask`.
+                    attn_mask = attn_mask.to(q.dtype)
+                    if _efficient_attention_backend == 'xformers':
+                        attn_mask = _expand_attention_bias(attn_mask, q.shape[0], self.num_heads)
+
                 p = self.dropout if self.training else 0
                 if _efficient_attention_backend == 'torch':
-                    x = torch.nn.functional.scaled_dot_product_attention(
-                        q, k, v, is_causal=attn_mask is not None, dropout_p=p)
+                    if isinstance(attn_mask, torch.Tensor):
+                        x = torch.nn.functional.scaled_dot_product_attention(
+                            q, k, v, attn_mask=attn_mask, dropout_p=p)
+                    else:
+                        x = torch.nn.functional.scaled_dot_product_attention(
+                            q, k, v, is_causal=attn_mask is not None, dropout_p=p)
                 else:
                     x = ops.memory_efficient_attention(q, k, v, attn_mask, p=p)
             else:
@@ -712,6 +833,10 @@ class StreamingTransformer(StreamingModule):
 
         return x
 
+    def _rewind_streaming(self, steps: int):
+        if 'offsets' in self._streaming_state:
+            self._streaming_state['offsets'] = self._streaming_state['offsets'] - steps
+
     def make_optim_group(self):
         group = {"params": list(self.parameters())}
         if self.lr is not None:
@@ -720,6 +845,43 @@ class StreamingTransformer(StreamingModule):
             group["weight_decay"] = self.weight_decay
         return group
 
+    @contextmanager
+    def static_kv_cache(self, steps: tp.Optional[int]):
+        """Context manager to use preallocated key/value caches in the self attention layers
+        when streaming. The caches are allocated at the first streaming step, with room for
+        `steps` additional steps. Nothing changes if `steps` is None.
+        """
+        attentions = [layer.self_attn for layer in self.layers
+                      if isinstance(getattr(layer, 'self_attn', None), StreamingMultiheadAttention)]
+        for attention in attentions:
+            attention.static_kv_cache_steps = steps
+        try:
+            yield
+        finally:
+            for attention in attentions:
+                attention.static_kv_cache_steps = None
+
+    @contextmanager
+    def restrict_past_context(self, steps: tp.Optional[int]):
+        """Context manager to restrict the causal self attention layers to the last `steps` steps,
+        older keys and values being evicted from the streaming state, e.g. to generate sequences
+        longer than the training ones with a bounded cost per step. Nothing changes if `steps` is None.
+        """
+        if steps is None:
+            yield
+            return
+        attentions = [layer.self_attn for layer in self.layers
+                      if isinstance(getattr(layer, 'self_attn', None), StreamingMultiheadAttention)]
+        assert all(attention.causal for attention in attentions), "Past context requires causal attention."
+        past_contexts = [attention.past_context for attention in attentions]
+        for attention in attentions:
+            attention.past_context = steps if attention.past_context is None else min(steps, attention.past_context)
+        try:
+            yield
+        finally:
+            for attention, past_context in zip(attentions, past_contexts):
+                attention.past_context = past_context
+
 
 # special attention related function
 
@@ -351,6 +351,11 @@ def get_audio_datasets(cfg: omegaconf.DictConfig,
         return_info = kwargs.pop('return_info')
         batch_size = kwargs.pop('batch_size', None)
         num_workers = kwargs.pop('num_workers')
+        # folder of tokens exported with `audiocraft.data.token_dataset`, to train on pre-tokenized audio.
+        # only the train and valid splits use it, evaluation and generation need the audio.
+        token_store = kwargs.pop('token_store', None)
+        if split not in ['train', 'valid']:
+            token_store = None
 
         if dataset_type == DatasetType.MUSIC:
             dataset = data.music_dataset.MusicDataset.from_meta(path, **kwargs)
@@ -362,6 +367,10 @@ def get_audio_datasets(cfg: omegaconf.DictConfig,
             dataset = data.jasco_dataset.JascoDataset.from_meta(path, return_info=return_info, **kwargs)
         else:
             raise ValueError(f"Dataset type is unsupported: {dataset_type}")
+        if token_store:
+            logger.info(f"Using pre-tokenized audio for split {split}: {token_store}")
+            dataset = data.token_dataset.TokenDataset(dataset, token_store)
+            return_info = True
 
         loader = get_loader(
             dataset,
@@ -21,10 +21,11 @@ from .. import metrics as eval_metrics
 from .. import models
 from ..data.audio_dataset import AudioDataset
 from ..data.music_dataset import MusicDataset, MusicInfo, AudioInfo
+from ..data.token_dataset import TokenDataset
 from ..data.audio_utils import normalize_audio
 from ..modules.conditioners import JointEmbedCondition, SegmentWithAttributes, WavCondition, \
             StyleConditioner, _drop_description_condition
-from ..utils.cache import CachedBatchWriter, CachedBatchLoader
+from ..utils.cache import CachedBatchWriter, CachedBatchLoader, stack_views
 from ..utils.samples.manager import SampleManager
 from ..utils.utils import get_dataset_from_loader, is_jsonable, warn_once, model_hash
 
@@ -61,6 +62,19 @@ class MusicGenSolver(base.StandardSolver):
                     min_length=self.cfg.optim.updates_per_epoch or 1)
                 self.dataloaders['original_train'] = self.dataloaders['train']
                 self.dataloaders['train'] = self._cached_batch_loader  # type: ignore
+        for split, loader in self.dataloaders.items():
+            dataset = get_dataset_from_loader(loader)
+            if isinstance(dataset, TokenDataset):
+                assert dataset.frame_rate == self.compression_model.frame_rate, (
+                    f"Token store of split {split} has a frame rate of {dataset.frame_rate} but "
+                    f"compression model has a frame rate of {self.compression_model.frame_rate}.")
+                assert dataset.num_codebooks >= self.compression_model.num_codebooks, (
+                    f"Token store of split {split} has {dataset.num_codebooks} codebooks but "
+                    f"compression model has {self.compression_model.num_codebooks} codebooks.")
+                # short segments are padded with code 0 rather than with the tokens of silence.
+                assert self.cfg.tokens.padding_with_special_token, (
+                    f"Token store of split {split} requires tokens.padding_with_special_token "
+                    "so that the padding of short segments is masked.")
 
     @staticmethod
     def get_eval_solver_from_sig(sig: str, dtype: tp.Optional[str] = None,
@@ -264,7 +278,8 @@ class MusicGenSolver(base.StandardSolver):
 
         Args:
             batch (tuple[torch.Tensor, list[SegmentWithAttributes]]): Input batch with audio tensor of shape [B, C, T]
-                and corresponding metadata as SegmentWithAttributes (with B items).
+                and corresponding metadata as SegmentWithAttributes (with B items). For pre-tokenized datasets,
+                the batch holds the integer audio tokens of shape [B, K, T_s] instead of the audio.
             check_synchronization_points (bool): Whether to check for synchronization points slowing down training.
         Returns:
             Condition tensors (dict[str, any]): Preprocessed condition attributes.
@@ -286,13 +301,27 @@ class MusicGenSolver(base.StandardSolver):
                 f"Mismatch between number of items in audio batch ({audio.size(0)})",
                 f" and in metadata ({len(infos)})"
             )
+            if not audio.is_floating_point():
+                # Batch of tokens from a pre-tokenized dataset, see `audiocraft.data.token_dataset`.
+                audio_tokens = audio[:, :self.compression_model.num_codebooks].long()
+                audio = None
+                for info in infos:
+                    if isinstance(info, MusicInfo):
+                        # As with the cached batches, wav conditioning requires the embeddings cache.
+                        info.self_wav = WavCondition(
+                            torch.full([1, info.channels, info.total_frames], float('NaN')),
+                            length=torch.tensor([info.n_frames]),
+                            sample_rate=[info.sample_rate],
+                            path=[info.meta.path],
+                            seek_time=[info.seek_time])
         else:
             audio = None
             # In that case the batch will be a tuple coming from the _cached_batch_writer bit below.
             infos, = batch  # type: ignore
             assert all([isinstance(info, AudioInfo) for info in infos])
             assert all([info.audio_tokens is not None for info in infos])  # type: ignore
-            audio_tokens = torch.stack([info.audio_tokens for info in infos]).to(self.device)  # type: ignore
+            # the tokens of a packed shard are views of a single block, transferred as is.
+            audio_tokens = stack_views([info.audio_tokens for info in infos]).to(self.device)  # type: ignore
             audio_tokens = audio_tokens.long()
             for info in infos:
                 if isinstance(info, MusicInfo):
@@ -322,6 +351,7 @@ class MusicGenSolver(base.StandardSolver):
             torch.cuda.set_sync_debug_mode("warn")
 
         if audio_tokens is None:
+            assert audio is not None
             audio_tokens = self._get_audio_tokens(audio)
 
         with self.autocast:
@@ -438,6 +468,12 @@ class MusicGenSolver(base.StandardSolver):
         for k, ce_q in enumerate(ce_per_codebook):
             metrics[f'ce_q{k + 1}'] = ce_q
             metrics[f'ppl_q{k + 1}'] = torch.exp(ce_q)
+        # in-memory embedding cache usage, e.g. for the chroma or CLAP conditioners
+        for name, cache_stats in self.model.condition_provider.embedding_cache_stats().items():
+            lookups = cache_stats['hits'] + cache_stats['misses']
+            metrics[f'cache_{name}_hit_rate'] = cache_stats['hits'] / lookups if lookups else 0.
+            metrics[f'cache_{name}_resident_mb'] = cache_stats['resident_bytes'] / 2 ** 20
+            metrics[f'cache_{name}_evictions'] = cache_stats['evictions']
 
         return metrics
 
@@ -627,7 +663,7 @@ class MusicGenSolver(base.StandardSolver):
             self._cached_batch_writer.start_epoch(self.epoch)
         if self._cached_batch_loader is None:
             dataset = get_dataset_from_loader(self.dataloaders['train'])
-            assert isinstance(dataset, AudioDataset)
+            assert isinstance(dataset, (AudioDataset, TokenDataset))
             dataset.current_epoch = self.epoch
         else:
             self._cached_batch_loader.start_epoch(self.epoch)
@@ -0,0 +1,89 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Admission of generation requests in the serving applications: fair ordering of the waiting requests
+and estimation of the waiting times, shared by the FastAPI batching scheduler and the Flask admission queue.
+"""
+from collections import defaultdict
+import math
+import time
+import typing as tp
+
+
+class QueueFullError(Exception):
+    """The queue of waiting generation requests is full.
+
+    Args:
+        retry_after (int): Suggested delay before retrying, in seconds.
+    """
+    def __init__(self, retry_after: int):
+        super().__init__(f"Generation queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class QueuedRequest(tp.Protocol):
+    """A waiting request, with its arrival order, the client that sent it and its priority."""
+    seq: int
+    client_id: str
+    priority: int
+
+
+QueuedRequestT = tp.TypeVar('QueuedRequestT', bound=QueuedRequest)
+
+
+def fair_order(requests: tp.Iterable[QueuedRequestT]) -> tp.List[QueuedRequestT]:
+    """Order waiting requests by priority, lower values first. Within a priority, the clients take turns,
+    the requests of each client being kept in arrival order, so that a single client cannot fill the queue.
+    """
+    client_ranks: tp.Dict[tp.Tuple[int, str], int] = defaultdict(int)
+    ordered: tp.List[tp.Tuple[tp.Tuple[int, int, int], QueuedRequestT]] = []
+    for request in sorted(requests, key=lambda request: request.seq):
+        rank = client_ranks[(request.priority, request.client_id)]
+        client_ranks[(request.priority, request.client_id)] += 1
+        ordered.append(((request.priority, rank, request.seq), request))
+    ordered.sort(key=lambda item: item[0])
+    return [request for _, request in ordered]
+
+
+class GenerationTimeEstimator:
+    """Estimate the waiting times of queued requests from an exponential moving average
+    of the duration of a generation, or of a batch of generations. Not thread safe,
+    it should be used under the lock of the queue.
+
+    Args:
+        default_time (float): Duration of a generation used before any was measured, in seconds.
+        smoothing (float): Weight of the last measured duration in the moving average.
+    """
+    def __init__(self, default_time: float = 30., smoothing: float = 0.3):
+        self.generation_time = default_time
+        self.smoothing = smoothing
+        self.started_at: tp.Optional[float] = None
+
+    def start(self):
+        """Mark the start of a generation."""
+        self.started_at = time.monotonic()
+
+    def finish(self):
+        """Mark the end of the current generation, updating the average duration."""
+        assert self.started_at is not None
+        elapsed = time.monotonic() - self.started_at
+        self.generation_time += self.smoothing * (elapsed - self.generation_time)
+        self.started_at = None
+
+    def current_remaining(self) -> float:
+        """Estimated remaining time of the current generation, 0 if none is running."""
+        if self.started_at is None:
+            return 0.
+        return max(0., self.generation_time - (time.monotonic() - self.started_at))
+
+    def estimate_wait(self, generations_ahead: int) -> float:
+        """Estimated waiting time before starting, with the given number of generations
+        still to run once the current one ends.
+        """
+        return self.current_remaining() + generations_ahead * self.generation_time
+
+    def estimate_retry_after(self) -> int:
+        """Estimated time for a full queue to free a place, when the next generation starts, in seconds."""
+        return max(1, math.ceil(self.current_remaining() or self.generation_time))
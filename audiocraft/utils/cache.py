@@ -5,13 +5,22 @@
 # LICENSE file in the root directory of this source tree.
 
 from concurrent.futures import ThreadPoolExecutor
-from collections import deque
+from collections import deque, OrderedDict
+import dataclasses
 from functools import partial
 from hashlib import sha1
+import json
 import logging
+import mmap
+import os
 from pathlib import Path
+import pickle
+import socket
 import sys
+import threading
+import time
 import typing as tp
+import uuid
 import zipfile
 
 import flashy
@@ -36,6 +45,226 @@ def get_full_embed(full_embed: torch.Tensor, x: tp.Any, idx: int, device: tp.Uni
     return full_embed.to(device)
 
 
+def get_nbytes(value: tp.Any) -> int:
+    """Return the number of bytes held by the tensors in a tensor or nested tuple, list or dict of tensors."""
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, (tuple, list)):
+        return sum(get_nbytes(item) for item in value)
+    if isinstance(value, dict):
+        return sum(get_nbytes(item) for item in value.values())
+    return 0
+
+
+def hash_tensor(x: torch.Tensor) -> str:
+    """Return a hash of the content, shape and dtype of a tensor, e.g. to cache features computed from a waveform."""
+    hasher = sha1(f"{x.dtype}:{tuple(x.shape)}".encode())
+    hasher.update(x.detach().contiguous().reshape(-1).view(torch.uint8).cpu().numpy().tobytes())
+    return hasher.hexdigest()
+
+
+class LRUTensorCache:
+    """In-memory cache of tensors, or nested tuples of tensors, with least recently used eviction
+    once the total size of the cached tensors exceeds a byte budget. Entries larger than the budget
+    are never cached. The cache is safe to use from multiple threads.
+
+    Args:
+        max_bytes (int): Maximum total size in bytes of the cached tensors.
+    """
+    def __init__(self, max_bytes: int):
+        assert max_bytes >= 0
+        self.max_bytes = max_bytes
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: tp.OrderedDict[tp.Hashable, tp.Tuple[tp.Any, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: tp.Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: tp.Hashable) -> tp.Optional[tp.Any]:
+        """Return the cached value for the given key, or None if it is not cached."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: tp.Hashable, value: tp.Any) -> None:
+        """Cache a value, evicting the least recently used entries to stay within the byte budget."""
+        nbytes = get_nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                self.resident_bytes -= self._entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = (value, nbytes)
+            self.resident_bytes += nbytes
+            while self.resident_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.resident_bytes -= evicted_bytes
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """Remove all the cached entries, keeping the statistics."""
+        with self._lock:
+            self._entries.clear()
+            self.resident_bytes = 0
+
+    def stats(self) -> tp.Dict[str, int]:
+        """Return the cache statistics: hits, misses, evictions, number of entries and resident bytes."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'resident_bytes': self.resident_bytes,
+            }
+
+
+class PackedEmbeddingStore:
+    """Packed on-disk storage for the `EmbeddingCache`, as an alternative to one `torch.save` file per embedding.
+    Embeddings are appended as raw bytes to shard files and an index maps each key to its shard, offset,
+    shape and dtype. Shards are memory-mapped and embeddings are read with `torch.frombuffer`,
+    without any copy nor unpickling.
+
+    Each writing process appends to its own shards, `{writer}-{shard:05d}.bin`, and its own index, `{writer}.index`,
+    so that the workers of a distributed job never write to the same file. An index entry is written only once
+    the embedding bytes are flushed to the shard, so that readers never see partially written embeddings.
+    Entries written by other processes are picked up when calling `refresh`.
+
+    Args:
+        root (Path): Folder containing the shards and index files.
+        max_shard_bytes (int): Size after which a writer starts a new shard.
+    """
+    ALIGNMENT = 64
+
+    def __init__(self, root: tp.Union[str, Path], max_shard_bytes: int = 2 ** 30):
+        self.root = Path(root)
+        self.root.mkdir(exist_ok=True, parents=True)
+        self.max_shard_bytes = max_shard_bytes
+        self.writer = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        # key -> (shard name, offset, shape, dtype)
+        self._index: tp.Dict[str, tp.Tuple[str, int, tp.Tuple[int, ...], torch.dtype]] = {}
+        self._index_offsets: tp.Dict[Path, int] = {}
+        self._maps: tp.Dict[str, mmap.mmap] = {}
+        self._shard_file: tp.Optional[tp.BinaryIO] = None
+        self._shard_name: tp.Optional[str] = None
+        self._shard_count = 0
+        self._index_file: tp.Optional[tp.TextIO] = None
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    def keys(self) -> tp.List[str]:
+        return list(self._index)
+
+    def refresh(self) -> None:
+        """Read the index entries appended since the last call, including the ones from other writers."""
+        with self._lock:
+            for index_path in sorted(self.root.glob('*.index')):
+                offset = self._index_offsets.get(index_path, 0)
+                if index_path.stat().st_size <= offset:
+                    continue
+                with open(index_path, 'rb') as f:
+                    f.seek(offset)
+                    data = f.read()
+                # only consider complete lines, the last one might still be in the process of being written
+                end = data.rfind(b'\n') + 1
+                for line in data[:end].splitlines():
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._index[entry['key']] = (entry['shard'], entry['offset'], tuple(entry['shape']),
+                                                     getattr(torch, entry['dtype']))
+                self._index_offsets[index_path] = offset + end
+
+    def get(self, key: str) -> tp.Optional[torch.Tensor]:
+        """Return the embedding stored for the given key, as a read-only view of the memory-mapped shard,
+        or None if there is no such embedding.
+        """
+        entry = self._index.get(key)
+        if entry is None:
+            return None
+        shard, offset, shape, dtype = entry
+        count = 1
+        for dim in shape:
+            count *= dim
+        if count == 0:
+            return torch.empty(shape, dtype=dtype)
+        element_size = torch.empty((), dtype=dtype).element_size()
+        buffer = self._get_map(shard, offset + count * element_size)
+        return torch.frombuffer(buffer, dtype=dtype, count=count, offset=offset).view(shape)
+
+    def put(self, key: str, embed: torch.Tensor) -> None:
+        """Append an embedding to the current shard of this writer. Existing keys are not overwritten."""
+        embed = embed.detach().cpu().contiguous()
+        data = embed.reshape(-1).view(torch.uint8).numpy().tobytes()
+        with self._lock:
+            if key in self._index:
+                return
+            if self._shard_file is None or self._shard_file.tell() >= self.max_shard_bytes:
+                self._open_shard()
+            assert self._shard_file is not None and self._index_file is not None
+            offset = self._shard_file.tell()
+            padding = -offset % self.ALIGNMENT
+            self._shard_file.write(bytes(padding))
+            offset += padding
+            self._shard_file.write(data)
+            self._shard_file.flush()
+            entry = {'key': key, 'shard': self._shard_name, 'offset': offset,
+                     'shape': list(embed.shape), 'dtype': str(embed.dtype).split('.')[-1]}
+            self._index_file.write(json.dumps(entry) + '\n')
+            self._index_file.flush()
+            assert self._shard_name is not None
+            self._index[key] = (self._shard_name, offset, tuple(embed.shape), embed.dtype)
+
+    def close(self) -> None:
+        """Close the files of this writer. Memory maps are released once no embedding refers to them anymore."""
+        with self._lock:
+            for f in [self._shard_file, self._index_file]:
+                if f is not None:
+                    f.close()
+            self._shard_file = None
+            self._index_file = None
+            self._maps.clear()
+
+    def _open_shard(self) -> None:
+        """Start a new shard for this writer, called with the lock held."""
+        if self._shard_file is not None:
+            self._shard_file.close()
+        if self._index_file is None:
+            self._index_file = open(self.root / f"{self.writer}.index", 'a')
+        self._shard_name = f"{self.writer}-{self._shard_count:05d}.bin"
+        self._shard_count += 1
+        self._shard_file = open(self.root / self._shard_name, 'ab')
+
+    def _get_map(self, shard: str, end: int) -> mmap.mmap:
+        """Return a memory map of the shard covering at least `end` bytes, remapping it if the shard grew."""
+        with self._lock:
+            buffer = self._maps.get(shard)
+            if buffer is None or len(buffer) < end:
+                with open(self.root / shard, 'rb') as f:
+                    # copy-on-write mapping, as `torch.frombuffer` expects a writable buffer,
+                    # the previous mapping is kept alive by the tensors still referring to it.
+                    buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+                self._maps[shard] = buffer
+            return buffer
+
+
 class EmbeddingCache:
     """Cache around embeddings computation for faster execution.
     The EmbeddingCache is storing pre-computed embeddings on disk and provides a simple API
@@ -43,7 +272,12 @@ class EmbeddingCache:
     using a user-provided function. When the cache is warm (all embeddings are pre-computed),
     the EmbeddingCache allows for faster training as it removes the need of computing the embeddings.
     Additionally, it provides in-memory cache around the loaded embeddings to limit IO footprint
-    and synchronization points in the forward calls.
+    and synchronization points in the forward calls. The in-memory cache is bounded by a byte budget,
+    evicting the least recently used embeddings first, so that long runs keep a predictable memory usage.
+
+    Embeddings are stored either as one file per input (`storage='files'`), or packed in memory-mapped
+    shards with a `PackedEmbeddingStore` (`storage='packed'`), which scales better to millions of inputs.
+    Existing per-file caches can be converted with `scripts/compact_embedding_cache.py`.
 
     Args:
         cache_path (Path): Path to folder where all pre-computed embeddings are saved on disk.
@@ -56,12 +290,22 @@ class EmbeddingCache:
             the desired embedding chunk from the full embedding loaded from the cache. The last parameter
             specify the index corresponding to the current embedding in the object that can represent batch metadata.
             If not specified, will return the full embedding unmodified.
+        max_memory_bytes (int): Memory budget of the in-memory cache of full embeddings loaded from disk.
+        pin_memory (bool): Whether to keep the embeddings of the in-memory cache in pinned memory,
+            for faster host to device copies. Only used when CUDA is available.
+        storage (str): On-disk storage of the embeddings, either 'files' or 'packed'.
     """
+    # minimum delay in seconds between two refreshes of the packed storage, to pick up new embeddings.
+    REFRESH_INTERVAL = 30.
+
     def __init__(self, cache_path: tp.Union[str, Path], device: tp.Union[str, torch.device],
                  compute_embed_fn: tp.Callable[[Path, tp.Any, int], torch.Tensor],
-                 extract_embed_fn: tp.Optional[tp.Callable[[torch.Tensor, tp.Any, int], torch.Tensor]] = None):
+                 extract_embed_fn: tp.Optional[tp.Callable[[torch.Tensor, tp.Any, int], torch.Tensor]] = None,
+                 max_memory_bytes: int = 2 * 2 ** 30, pin_memory: bool = False, storage: str = 'files'):
+        assert storage in ['files', 'packed'], f"Unsupported embedding cache storage: {storage}"
         self.cache_path = Path(cache_path)
         self.device = device
+        self.pin_memory = pin_memory and torch.cuda.is_available()
         self._compute_embed_fn = compute_embed_fn
         self._extract_embed_fn: tp.Callable[[torch.Tensor, tp.Any, int], torch.Tensor]
         if extract_embed_fn is not None:
@@ -73,8 +317,18 @@ class EmbeddingCache:
             logger.info(f"Cache instantiated at: {self.cache_path}")
             self.pool = ThreadPoolExecutor(8)
             self.pool.__enter__()
+        self._store: tp.Optional[PackedEmbeddingStore] = None
+        if storage == 'packed':
+            self._store = PackedEmbeddingStore(self.cache_path)
         self._current_batch_cache: dict = {}
-        self._memory_cache: dict = {}
+        self._memory_cache = LRUTensorCache(max_memory_bytes)
+        # packed embeddings are memory-mapped and already cached by the OS,
+        # they are only kept in memory when they are copied to pinned memory.
+        self._use_memory_cache = self._store is None or self.pin_memory
+        self._last_refresh = time.time()
+        # lookups of full embeddings, either in memory or on disk.
+        self.hits = 0
+        self.misses = 0
 
     def _get_cache_path(self, path: tp.Union[Path, str]):
         """Get cache path for the given file path."""
@@ -91,6 +345,31 @@ class EmbeddingCache:
             embed = None
         return embed
 
+    def _has_full_embed(self, cache: Path) -> bool:
+        if self._store is not None:
+            return cache.name in self._store
+        return cache.exists()
+
+    def _load_full_embed(self, cache: Path) -> tp.Optional[torch.Tensor]:
+        if self._store is not None:
+            return self._store.get(cache.name)
+        return EmbeddingCache._get_full_embed_from_cache(cache)
+
+    def _save_full_embed(self, cache: Path, full_embed: torch.Tensor) -> None:
+        if self._store is not None:
+            self._store.put(cache.name, full_embed)
+        else:
+            with flashy.utils.write_and_rename(cache, pid=True) as f:
+                torch.save(full_embed.cpu(), f)
+
+    def stats(self) -> tp.Dict[str, int]:
+        """Return the cache statistics: hits and misses of the full embeddings, in memory or on disk,
+        along with the evictions, entries and resident bytes of the in-memory cache."""
+        stats = self._memory_cache.stats()
+        stats['hits'] = self.hits
+        stats['misses'] = self.misses
+        return stats
+
     def get_embed_from_cache(self, paths: tp.List[Path], x: tp.Any) -> torch.Tensor:
         """Get embedding from cache, computing and storing it to cache if not already cached.
         The EmbeddingCache first tries to load the embedding from the in-memory cache
@@ -110,8 +389,7 @@ class EmbeddingCache:
             else:
                 full_embed = self._compute_embed_fn(path, x, idx)
                 try:
-                    with flashy.utils.write_and_rename(cache, pid=True) as f:
-                        torch.save(full_embed.cpu(), f)
+                    self._save_full_embed(cache, full_embed)
                 except Exception as exc:
                     logger.error('Error saving embed %s (%s): %r', cache, full_embed.shape, exc)
                 else:
@@ -133,31 +411,78 @@ class EmbeddingCache:
         """
         self._current_batch_cache.clear()
         if self.cache_path is not None:
-            futures: list = []
+            caches = []
             for path in paths:
                 assert path is not None, "Path is required for computation from cache"
-                cache = self._get_cache_path(path)
-                if cache in self._memory_cache or not cache.exists():
+                caches.append(self._get_cache_path(path))
+            if self._store is not None and time.time() - self._last_refresh >= self.REFRESH_INTERVAL:
+                if not all(self._has_full_embed(cache) for cache in caches):
+                    # pick up the embeddings written by the other workers since the last refresh
+                    self._store.refresh()
+                    self._last_refresh = time.time()
+            futures: list = []
+            memory_embeds: list = []
+            for cache in caches:
+                memory_embed = self._memory_cache.get(cache) if self._use_memory_cache else None
+                memory_embeds.append(memory_embed)
+                if memory_embed is not None:
+                    self.hits += 1
+                    futures.append(None)
+                elif not self._has_full_embed(cache):
+                    self.misses += 1
                     futures.append(None)
                 else:
-                    futures.append(self.pool.submit(EmbeddingCache._get_full_embed_from_cache, cache))
-            for idx, (path, future) in enumerate(zip(paths, futures)):
-                assert path is not None
-                cache = self._get_cache_path(path)
+                    self.hits += 1
+                    futures.append(self.pool.submit(self._load_full_embed, cache))
+            for idx, (cache, future, memory_embed) in enumerate(zip(caches, futures, memory_embeds)):
                 full_embed = None
                 if future is None:
-                    if cache in self._memory_cache:
-                        full_embed = self._memory_cache[cache]
+                    full_embed = memory_embed
                 else:
                     full_embed = future.result()
-                    if full_embed is not None:
-                        self._memory_cache[cache] = full_embed
-                        full_embed = full_embed.to(self.device)
+                    if full_embed is not None and self._use_memory_cache:
+                        if self.pin_memory:
+                            full_embed = full_embed.pin_memory()
+                        self._memory_cache.put(cache, full_embed)
                 if full_embed is not None:
+                    full_embed = full_embed.to(self.device, non_blocking=self.pin_memory)
                     embed = self._extract_embed_fn(full_embed, x, idx)
                     self._current_batch_cache[cache] = embed
 
 
+def _dtype_from_name(name: str) -> torch.dtype:
+    dtype = getattr(torch, name)
+    assert isinstance(dtype, torch.dtype), name
+    return dtype
+
+
+def stack_views(tensors: tp.Sequence[torch.Tensor]) -> torch.Tensor:
+    """Stack tensors of the same shape along a new first dimension. When the tensors are consecutive slices
+    of a single contiguous block, e.g. the `audio_tokens` of the items of a batch read by `CachedBatchLoader`
+    from a packed shard, the block is returned as a view, without any copy.
+    """
+    first = tensors[0]
+    numel = first.numel()
+    is_block = numel > 0 and all(
+        tensor.shape == first.shape and tensor.dtype == first.dtype and tensor.is_contiguous()
+        and tensor.untyped_storage().data_ptr() == first.untyped_storage().data_ptr()
+        and tensor.storage_offset() == first.storage_offset() + idx * numel
+        for idx, tensor in enumerate(tensors))
+    if not is_block:
+        return torch.stack(list(tensors))
+    return first.as_strided((len(tensors),) + tuple(first.shape), (numel,) + tuple(first.stride()))
+
+
+def _get_tensor_fields(item: tp.Any) -> tp.Dict[str, torch.Tensor]:
+    """Return the tensors held by the fields of a cached batch item, e.g. the `audio_tokens` of an `AudioInfo`."""
+    if not dataclasses.is_dataclass(item):
+        return {}
+    return {
+        field.name: getattr(item, field.name) for field in dataclasses.fields(item)
+        if isinstance(getattr(item, field.name), torch.Tensor)
+    }
+
+
 class CachedBatchWriter:
     """Write pre computed caches for mini batches. This can
     make loading a lot more efficient depending on your filesystem.
@@ -167,8 +492,12 @@ class CachedBatchWriter:
             will be stored.
 
     Inside cache folder, the structure is the following:
-    `epoch_number / update_number.zip`
-    And the zip file contains one entry per batch item.
+    `epoch_number / update_number.shard`
+    Each shard starts with a small header describing its content, followed by the raw storage
+    of the tensors and the remaining metadata of each batch item. The tensors of a given kind
+    (e.g. the `audio_tokens` of all the items) are stacked in a single contiguous block, so that
+    each rank can memory-map the shard and view its slice of the batch without any copy.
+    Tensors that cannot be stacked, e.g. with varying shapes, are stored with the metadata.
 
     It is possible to use the cache with a batch size smaller than
     created with but obviously not larger. Make sure to call the
@@ -177,6 +506,9 @@ class CachedBatchWriter:
     See the grid `audiocraft/grids/musicgen/musicgen_warmup_cache.py`
     for an example of how to warmup the cache.
     """
+    MAGIC = b'ACBSHARD'
+    ALIGNMENT = 64
+
     def __init__(self, cache_folder: Path):
         self.cache_folder = cache_folder
         self._current_epoch: tp.Optional[int] = None
@@ -187,16 +519,95 @@ class CachedBatchWriter:
         """
         self._current_epoch = epoch
         self._current_index = 0
-        self._zip_path.parent.mkdir(exist_ok=True, parents=True)
+        self._shard_path.parent.mkdir(exist_ok=True, parents=True)
 
     @staticmethod
     def _get_zip_path(cache_folder: Path, epoch: int, index: int):
+        """Path of the cached mini batches written in the legacy zip format."""
         return cache_folder / f"{epoch:05d}" / f"{index:06d}.zip"
 
+    @staticmethod
+    def _get_shard_path(cache_folder: Path, epoch: int, index: int):
+        return cache_folder / f"{epoch:05d}" / f"{index:06d}.shard"
+
     @property
-    def _zip_path(self):
+    def _shard_path(self):
         assert self._current_epoch is not None
-        return CachedBatchWriter._get_zip_path(self.cache_folder, self._current_epoch, self._current_index)
+        return CachedBatchWriter._get_shard_path(self.cache_folder, self._current_epoch, self._current_index)
+
+    @staticmethod
+    def _write_shard(f: tp.BinaryIO, items: tp.List[tuple]) -> None:
+        """Write the given batch items, each being a tuple of values, to a shard."""
+        # Tensors sharing shape and dtype across all the items are stacked into contiguous blocks,
+        # either values of the items, or fields of dataclass values. The field is None for values.
+        blocks: tp.List[tp.Tuple[int, tp.Optional[str], torch.Tensor]] = []
+        for slot, value in enumerate(items[0]):
+            candidates: tp.Dict[tp.Optional[str], torch.Tensor] = {}
+            if isinstance(value, torch.Tensor):
+                candidates[None] = value
+            else:
+                candidates.update(_get_tensor_fields(value))
+            for name, tensor in candidates.items():
+                tensors = []
+                for item in items:
+                    other = item[slot] if name is None else getattr(item[slot], name, None)
+                    if not isinstance(other, torch.Tensor) or other.shape != tensor.shape or \
+                            other.dtype != tensor.dtype:
+                        break
+                    tensors.append(other.detach().cpu())
+                else:
+                    blocks.append((slot, name, torch.stack(tensors)))
+        stacked = set((slot, name) for slot, name, _ in blocks)
+
+        metadata = []
+        for item in items:
+            values = []
+            for slot, value in enumerate(item):
+                if (slot, None) in stacked:
+                    value = None
+                elif any((slot, name) in stacked for name in _get_tensor_fields(value)):
+                    value = dataclasses.replace(
+                        value, **{name: None for name in _get_tensor_fields(value) if (slot, name) in stacked})
+                values.append(value)
+            metadata.append(pickle.dumps(tuple(values), protocol=pickle.HIGHEST_PROTOCOL))
+
+        def _align(offset: int) -> int:
+            return offset + (-offset % CachedBatchWriter.ALIGNMENT)
+
+        def _get_header(header_size: int) -> dict:
+            tensor_entries = []
+            offset = header_size
+            for slot, name, block in blocks:
+                offset = _align(offset)
+                tensor_entries.append({'slot': slot, 'field': name, 'dtype': str(block.dtype).split('.')[-1],
+                                       'shape': list(block.shape), 'offset': offset})
+                offset += block.numel() * block.element_size()
+            meta_entries = []
+            for blob in metadata:
+                meta_entries.append([offset, len(blob)])
+                offset += len(blob)
+            return {'num_items': len(items), 'num_slots': len(items[0]),
+                    'tensors': tensor_entries, 'metadata': meta_entries}
+
+        # The header holds the offsets of the data following it, hence its size
+        # is increased until it is large enough to hold the offsets it describes.
+        header_size = 0
+        while True:
+            header = _get_header(header_size)
+            header_bytes = json.dumps(header).encode()
+            prefix = CachedBatchWriter.MAGIC + len(header_bytes).to_bytes(8, 'little') + header_bytes
+            if len(prefix) <= header_size:
+                break
+            header_size = _align(len(prefix))
+        f.write(prefix + bytes(header_size - len(prefix)))
+        tensor_entries = header['tensors']
+        position = header_size
+        for (_, _, block), entry in zip(blocks, tensor_entries):
+            f.write(bytes(entry['offset'] - position))
+            f.write(block.contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+            position = entry['offset'] + block.numel() * block.element_size()
+        for blob in metadata:
+            f.write(blob)
 
     def save(self, *content):
         """Save one mini batch. This function is distributed-aware
@@ -209,20 +620,17 @@ class CachedBatchWriter:
             all_contents.append(their_content)
 
         if flashy.distrib.is_rank_zero():
-            idx = 0
-            with flashy.utils.write_and_rename(self._zip_path) as tmp:
-                with zipfile.ZipFile(tmp, 'w') as zf:
-                    for content in all_contents:
-                        for vals in zip(*content):
-                            with zf.open(f'{idx}', 'w') as f:  # type: ignore
-                                torch.save(vals, f)
-                            idx += 1
+            items = [vals for content in all_contents for vals in zip(*content)]
+            with flashy.utils.write_and_rename(self._shard_path) as tmp:
+                CachedBatchWriter._write_shard(tmp, items)
         flashy.distrib.barrier()
         self._current_index += 1
 
 
 class CachedBatchLoader:
     """Loader for cached mini-batches dumped with `CachedBatchWriter`.
+    Each rank memory-maps the shards and only reads its own slice of every mini-batch.
+    Caches written in the legacy zip format are still supported.
 
     Args:
         cache_folder (Path): folder in which the cached minibatches are stored.
@@ -244,8 +652,8 @@ class CachedBatchLoader:
         self.sampler = None  # for compatibility with the regular DataLoader
 
     def __len__(self):
-        path = CachedBatchWriter._get_zip_path(self.cache_folder, self._current_epoch or 0, 0).parent
-        return len([p for p in path.iterdir() if p.suffix == ".zip"])
+        path = CachedBatchWriter._get_shard_path(self.cache_folder, self._current_epoch or 0, 0).parent
+        return len([p for p in path.iterdir() if p.suffix in [".shard", ".zip"]])
 
     def start_epoch(self, epoch: int):
         """Call at the beginning of each epoch.
@@ -256,26 +664,78 @@ class CachedBatchLoader:
         assert self._current_epoch is not None
         return CachedBatchWriter._get_zip_path(self.cache_folder, self._current_epoch, index)
 
+    def _shard_path(self, index: int):
+        assert self._current_epoch is not None
+        return CachedBatchWriter._get_shard_path(self.cache_folder, self._current_epoch, index)
+
     def _load_one(self, index: int):
+        shard_path = self._shard_path(index)
+        if shard_path.exists():
+            return self._load_shard(shard_path)
         zip_path = self._zip_path(index)
         if not zip_path.exists():
             if index < self.min_length:
                 raise RuntimeError(f"Cache should have at least {self.min_length} batches, but {index} doesn't exist")
 
             return None
+        return self._load_zip(zip_path)
+
+    def _check_total_batch_size(self, num_items: int) -> int:
+        """Check the cached mini-batch is large enough and return the index of the first item of this rank."""
+        total_batch_size = self.batch_size * flashy.distrib.world_size()
+        if num_items < total_batch_size:
+            raise RuntimeError(
+                f"The cache can handle a max batch size of {num_items}, "
+                f"but {total_batch_size} is needed.")
+        return flashy.distrib.rank() * self.batch_size
+
+    def _load_shard(self, shard_path: Path):
+        try:
+            with open(shard_path, 'rb') as f:
+                magic = f.read(len(CachedBatchWriter.MAGIC))
+                assert magic == CachedBatchWriter.MAGIC, f"Not a cached batch shard: {shard_path}"
+                header_length = int.from_bytes(f.read(8), 'little')
+                header = json.loads(f.read(header_length))
+                # copy-on-write mapping, as `torch.frombuffer` expects a writable buffer.
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            start = self._check_total_batch_size(header['num_items'])
+            items = []
+            for offset, length in header['metadata'][start: start + self.batch_size]:
+                items.append(list(pickle.loads(buffer[offset: offset + length])))
+            out: tp.List[tp.Any] = [None] * header['num_slots']
+            for entry in header['tensors']:
+                shape = entry['shape'][1:]
+                dtype = _dtype_from_name(entry['dtype'])
+                item_numel = 1
+                for dim in shape:
+                    item_numel *= dim
+                item_size = item_numel * torch.empty((), dtype=dtype).element_size()
+                if item_numel == 0:
+                    block = torch.empty([self.batch_size] + shape, dtype=dtype)
+                else:
+                    block = torch.frombuffer(buffer, dtype=dtype, count=self.batch_size * item_numel,
+                                             offset=entry['offset'] + start * item_size)
+                    block = block.view([self.batch_size] + shape)
+                if entry['field'] is None:
+                    out[entry['slot']] = block
+                else:
+                    for item, tensor in zip(items, block):
+                        setattr(item[entry['slot']], entry['field'], tensor)
+            for slot in range(header['num_slots']):
+                if out[slot] is None:
+                    out[slot] = [item[slot] for item in items]
+            return out
+        except Exception:
+            logger.error("Error when reading shard path %s", shard_path)
+            raise
+
+    def _load_zip(self, zip_path: Path):
         mode = "rb" if sys.version_info >= (3, 9) else "r"
         try:
             with zipfile.ZipFile(zip_path, 'r') as zf:
-                rank = flashy.distrib.rank()
-                world_size = flashy.distrib.world_size()
                 root = zipfile.Path(zf)
                 items = list(root.iterdir())
-                total_batch_size = self.batch_size * world_size
-                if len(items) < total_batch_size:
-                    raise RuntimeError(
-                        f"The cache can handle a max batch size of {len(items)}, "
-                        f"but {total_batch_size} is needed.")
-                start = rank * self.batch_size
+                start = self._check_total_batch_size(len(items))
                 items = items[start: start + self.batch_size]
                 assert len(items) == self.batch_size
                 entries = []
@@ -287,8 +747,7 @@ class CachedBatchLoader:
                     if isinstance(part[0], torch.Tensor):
                         out.append(torch.stack(part))
                     else:
-                        assert isinstance(part, torch.Tensor)
-                        out.append(part)
+                        out.append(list(part))
                 return out
         except Exception:
             logger.error("Error when reading zip path %s", zip_path)
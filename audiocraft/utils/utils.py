@@ -21,6 +21,9 @@ from torch.nn.utils.rnn import pad_sequence
 
 logger = logging.getLogger(__name__)
 
+# A single pseudorandom number generator, or one per row of the batch (None falling back to the global one).
+Generators = tp.Union[torch.Generator, tp.Sequence[tp.Optional[torch.Generator]]]
+
 
 def model_hash(model: torch.nn.Module) -> str:
     """Return a model hash. This should allow us to track regressions in model init
@@ -85,7 +88,8 @@ def get_dataset_from_loader(dataloader):
         return dataset
 
 
-def multinomial(input: torch.Tensor, num_samples: int, replacement=False, *, generator=None):
+def multinomial(input: torch.Tensor, num_samples: int, replacement=False, *,
+                generator: tp.Optional[Generators] = None):
     """torch.multinomial with arbitrary number of dimensions, and number of candidates on the last dimension.
 
     Args:
@@ -93,50 +97,140 @@ def multinomial(input: torch.Tensor, num_samples: int, replacement=False, *, gen
         num_samples (int): Number of samples to draw.
         replacement (bool): Whether to draw with replacement or not.
     Keywords args:
-        generator (torch.Generator): A pseudorandom number generator for sampling.
+        generator (torch.Generator or list of torch.Generator, optional): A pseudorandom number generator
+            for sampling, or one generator per row (first dimension of input), so that the samples
+            of a row only depend on its own generator and not on the rest of the batch.
     Returns:
         torch.Tensor: Last dimension contains num_samples indices
             sampled from the multinomial probability distribution
             located in the last dimension of tensor input.
     """
+    if generator is not None and not isinstance(generator, torch.Generator):
+        assert len(generator) == input.shape[0], \
+            f"Expected one generator per row ({input.shape[0]}), got {len(generator)}"
+        return torch.stack([
+            multinomial(row, num_samples, replacement, generator=row_generator)
+            for row, row_generator in zip(input, generator)])
     input_ = input.reshape(-1, input.shape[-1])
     output_ = torch.multinomial(input_, num_samples=num_samples, replacement=replacement, generator=generator)
     output = output_.reshape(*list(input.shape[:-1]), -1)
     return output
 
 
-def sample_top_k(probs: torch.Tensor, k: int) -> torch.Tensor:
+def _expand_per_row(value: tp.Union[int, float, torch.Tensor], probs: torch.Tensor) -> tp.Union[int, float, torch.Tensor]:
+    """Reshape a per-row sampling parameter of shape [B] so that it broadcasts
+    against ``probs[..., :1]``. Scalars are returned untouched.
+    """
+    if not isinstance(value, torch.Tensor):
+        return value
+    assert value.dim() == 1 and value.shape[0] == probs.shape[0], \
+        f"Per-row parameter should have shape [{probs.shape[0]}], got {list(value.shape)}"
+    return value.to(probs.device).view(-1, *([1] * (probs.dim() - 1)))
+
+
+def sample_top_k(probs: torch.Tensor, k: tp.Union[int, torch.Tensor],
+                 generator: tp.Optional[Generators] = None) -> torch.Tensor:
     """Sample next token from top K values along the last dimension of the input probs tensor.
 
     Args:
         probs (torch.Tensor): Input probabilities with token candidates on the last dimension.
-        k (int): The k in “top-k”.
+        k (int or torch.Tensor): The k in “top-k”, either shared by the whole batch
+            or given per row as a LongTensor of shape [B] (first dimension of probs).
+        generator (torch.Generator or list of torch.Generator, optional): Generator(s) used for sampling,
+            see `multinomial`.
     Returns:
         torch.Tensor: Sampled tokens.
     """
-    top_k_value, _ = torch.topk(probs, k, dim=-1)
-    min_value_top_k = top_k_value[..., [-1]]
+    if isinstance(k, torch.Tensor):
+        k = _expand_per_row(k.clamp(1, probs.shape[-1]), probs)
+        assert isinstance(k, torch.Tensor)
+        top_k_value, _ = torch.topk(probs, int(k.max().item()), dim=-1)
+        # the k-th largest value of each row is the threshold for that row.
+        min_value_top_k = top_k_value.gather(-1, (k - 1).expand(*probs.shape[:-1], 1))
+    else:
+        top_k_value, _ = torch.topk(probs, k, dim=-1)
+        min_value_top_k = top_k_value[..., [-1]]
     probs *= (probs >= min_value_top_k).float()
     probs.div_(probs.sum(dim=-1, keepdim=True))
-    next_token = multinomial(probs, num_samples=1)
+    next_token = multinomial(probs, num_samples=1, generator=generator)
     return next_token
 
 
-def sample_top_p(probs: torch.Tensor, p: float) -> torch.Tensor:
+def sample_top_p(probs: torch.Tensor, p: tp.Union[float, torch.Tensor],
+                 generator: tp.Optional[Generators] = None) -> torch.Tensor:
     """Sample next token from top P probabilities along the last dimension of the input probs tensor.
 
     Args:
         probs (torch.Tensor): Input probabilities with token candidates on the last dimension.
-        p (int): The p in “top-p”.
+        p (float or torch.Tensor): The p in “top-p”, either shared by the whole batch
+            or given per row as a tensor of shape [B] (first dimension of probs).
+        generator (torch.Generator or list of torch.Generator, optional): Generator(s) used for sampling,
+            see `multinomial`.
     Returns:
         torch.Tensor: Sampled tokens.
     """
+    p = _expand_per_row(p, probs)
     probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)
     probs_sum = torch.cumsum(probs_sort, dim=-1)
     mask = probs_sum - probs_sort > p
     probs_sort *= (~mask).float()
     probs_sort.div_(probs_sort.sum(dim=-1, keepdim=True))
-    next_token = multinomial(probs_sort, num_samples=1)
+    next_token = multinomial(probs_sort, num_samples=1, generator=generator)
+    next_token = torch.gather(probs_idx, -1, next_token)
+    return next_token
+
+
+def filter_top_k_top_p(probs: torch.Tensor, k: int, p: float) -> torch.Tensor:
+    """Return the distribution actually sampled from with top-p sampling if p > 0, top-k sampling if k > 0,
+    or the input distribution otherwise, following the conventions of `LMModel.generate`,
+    see `sample_top_p` and `sample_top_k`.
+
+    Args:
+        probs (torch.Tensor): Input probabilities with token candidates on the last dimension.
+        k (int): The k in “top-k”.
+        p (float): The p in “top-p”.
+    Returns:
+        torch.Tensor: Normalized probabilities, with the same shape and order of the candidates as the input.
+    """
+    if p > 0.0:
+        probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)
+        probs_sum = torch.cumsum(probs_sort, dim=-1)
+        probs_sort = probs_sort * (probs_sum - probs_sort <= p).float()
+        probs = torch.zeros_like(probs).scatter(-1, probs_idx, probs_sort)
+    elif k > 0:
+        top_k_value, _ = torch.topk(probs, k, dim=-1)
+        probs = probs * (probs >= top_k_value[..., [-1]]).float()
+    return probs / probs.sum(dim=-1, keepdim=True)
+
+
+def sample_top_k_top_p(probs: torch.Tensor, k: torch.Tensor, p: torch.Tensor,
+                       generator: tp.Optional[Generators] = None) -> torch.Tensor:
+    """Sample next token with a per-row choice of strategy, in a single pass over the batch.
+    Following the convention of `LMModel.generate`, rows with p > 0 use top-p sampling,
+    other rows with k > 0 use top-k sampling, and remaining rows sample from the full distribution.
+
+    Args:
+        probs (torch.Tensor): Input probabilities with token candidates on the last dimension.
+        k (torch.Tensor): Per row k for “top-k”, of shape [B] (first dimension of probs).
+        p (torch.Tensor): Per row p for “top-p”, of shape [B] (first dimension of probs).
+        generator (torch.Generator or list of torch.Generator, optional): Generator(s) used for sampling,
+            see `multinomial`.
+    Returns:
+        torch.Tensor: Sampled tokens.
+    """
+    card = probs.shape[-1]
+    use_top_p = p > 0
+    # rows not using top-k keep all candidates, rows not using top-p never reach the threshold.
+    k = torch.where(use_top_p | (k <= 0), torch.full_like(k, card), k.clamp(max=card))
+    p = torch.where(use_top_p, p, torch.full_like(p, float('inf')))
+    k, p = _expand_per_row(k, probs), _expand_per_row(p, probs)
+    probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)
+    probs_sum = torch.cumsum(probs_sort, dim=-1)
+    ranks = torch.arange(card, device=probs.device)
+    mask = (probs_sum - probs_sort > p) | (ranks >= k)
+    probs_sort *= (~mask).float()
+    probs_sort.div_(probs_sort.sum(dim=-1, keepdim=True))
+    next_token = multinomial(probs_sort, num_samples=1, generator=generator)
     next_token = torch.gather(probs_idx, -1, next_token)
     return next_token
 
@@ -0,0 +1,107 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Benchmark the construction of the scatter indexes used to build and revert interleaved sequences
+with the codebooks patterns, comparing the vectorized construction of `Pattern` with the reference
+loop over the pattern layout, and reporting the time of the memoized lookups done at every step.
+
+Example:
+
+    python -m scripts.bench_codebooks_patterns --durations 30 60 120 --frame_rate 50
+"""
+
+import argparse
+import time
+import typing as tp
+
+import torch
+
+from audiocraft.modules.codebooks_patterns import (
+    CodebooksPatternProvider, DelayedPatternProvider, Pattern, UnrolledPatternProvider)
+
+
+def reference_pattern_indexes(pattern: Pattern, timesteps: int) -> tp.Tuple[torch.Tensor, torch.Tensor]:
+    indexes = torch.full((pattern.n_q, len(pattern.layout)), pattern.n_q * timesteps, dtype=torch.long).numpy()
+    mask = torch.zeros(pattern.n_q, len(pattern.layout), dtype=torch.bool).numpy()
+    for s, sequence_coords in enumerate(pattern.layout):
+        for coords in sequence_coords:
+            if coords.t < timesteps:
+                indexes[coords.q, s] = coords.t + coords.q * timesteps
+                mask[coords.q, s] = 1
+    return torch.from_numpy(indexes), torch.from_numpy(mask)
+
+
+def reference_reverted_indexes(pattern: Pattern, sequence_steps: int) -> tp.Tuple[torch.Tensor, torch.Tensor]:
+    ref_layout = pattern.layout[1:] if pattern.starts_with_special_token() else pattern.layout
+    indexes = torch.full((pattern.n_q, pattern.timesteps), pattern.n_q * sequence_steps, dtype=torch.long).numpy()
+    mask = torch.zeros(pattern.n_q, pattern.timesteps, dtype=torch.bool).numpy()
+    for s, sequence_codes in enumerate(ref_layout[:sequence_steps]):
+        for code in sequence_codes:
+            if code.t < pattern.timesteps:
+                indexes[code.q, code.t] = s + code.q * sequence_steps
+                mask[code.q, code.t] = 1
+    return torch.from_numpy(indexes), torch.from_numpy(mask)
+
+
+def timeit(fn: tp.Callable[[], tp.Any], repeat: int) -> float:
+    """Return the average time of a call in milliseconds."""
+    begin = time.time()
+    for _ in range(repeat):
+        fn()
+    return 1000 * (time.time() - begin) / repeat
+
+
+def bench(provider: CodebooksPatternProvider, timesteps: int, repeat: int) -> tp.Dict[str, float]:
+    # uncached provider call, as done once per sequence length
+    pattern = type(provider).get_pattern(provider, timesteps)
+    sequence_steps = len(pattern.layout)
+    timings = {
+        'loop': timeit(lambda: (reference_pattern_indexes(pattern, timesteps),
+                                reference_reverted_indexes(pattern, sequence_steps)), repeat),
+        'vectorized': timeit(lambda: (
+            pattern._build_pattern_sequence_scatter_indexes.__wrapped__(timesteps, pattern.n_q, False),
+            pattern._build_reverted_sequence_scatter_indexes.__wrapped__(
+                sequence_steps, pattern.n_q, is_model_output=True)), repeat),
+        'memoized': timeit(lambda: (
+            pattern._build_pattern_sequence_scatter_indexes(timesteps, pattern.n_q, False),
+            pattern._build_reverted_sequence_scatter_indexes(
+                sequence_steps, pattern.n_q, is_model_output=True)), repeat),
+    }
+    for reference, (indexes, mask) in [
+        (reference_pattern_indexes(pattern, timesteps),
+         pattern._build_pattern_sequence_scatter_indexes(timesteps, pattern.n_q, False)),
+        (reference_reverted_indexes(pattern, sequence_steps),
+         pattern._build_reverted_sequence_scatter_indexes(sequence_steps, pattern.n_q, is_model_output=True)),
+    ]:
+        assert torch.equal(reference[0], indexes) and torch.equal(reference[1], mask), \
+            "Vectorized scatter indexes differ from the reference."
+    return timings
+
+
+def main(argv: tp.Optional[tp.List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--durations', type=float, nargs='+', default=[30., 60., 90., 120.])
+    parser.add_argument('--frame_rate', type=float, default=50.)
+    parser.add_argument('--n_q', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    providers = {
+        'delayed': DelayedPatternProvider(n_q=args.n_q),
+        'unrolled': UnrolledPatternProvider(n_q=args.n_q),
+    }
+    for name, provider in providers.items():
+        for duration in args.durations:
+            timesteps = int(duration * args.frame_rate)
+            timings = bench(provider, timesteps, args.repeat)
+            print(f"{name:>9} {duration:6.0f}s: loop {timings['loop']:8.2f}ms, "
+                  f"vectorized {timings['vectorized']:7.2f}ms ({timings['loop'] / timings['vectorized']:6.1f}x), "
+                  f"memoized {timings['memoized']:7.3f}ms")
+
+
+if __name__ == '__main__':
+    main()
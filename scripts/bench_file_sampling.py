@@ -0,0 +1,67 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Benchmark the weighted sampling of files in `AudioDataset.sample_file`, comparing the alias table
+with `torch.multinomial` over the sampling probabilities, for increasing manifest sizes.
+
+Example:
+
+    python -m scripts.bench_file_sampling --sizes 1000 100000 1000000
+"""
+
+import argparse
+import random
+import time
+import typing as tp
+
+import torch
+
+from audiocraft.data.audio_dataset import AudioDataset, AudioMeta, AudioMetaIndex
+
+
+def get_dataset(num_files: int) -> AudioDataset:
+    rand = random.Random(1234)
+    meta = AudioMetaIndex.from_meta(
+        AudioMeta(f'/data/{idx:08d}.wav', duration=rand.uniform(5., 300.), sample_rate=32000,
+                  weight=rand.uniform(0.5, 2.))
+        for idx in range(num_files))
+    return AudioDataset(meta, segment_duration=10., sample_on_duration=True, sample_on_weight=True)
+
+
+def items_per_second(fn: tp.Callable[[int, torch.Generator], tp.Any], num_draws: int) -> float:
+    rng = torch.Generator()
+    rng.manual_seed(0)
+    begin = time.time()
+    for index in range(num_draws):
+        fn(index, rng)
+    return num_draws / (time.time() - begin)
+
+
+def main(argv: tp.Optional[tp.List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000, 1_000_000])
+    parser.add_argument('--draws', type=int, default=2_000)
+    args = parser.parse_args(argv)
+
+    for num_files in args.sizes:
+        begin = time.time()
+        dataset = get_dataset(num_files)
+        build_time = time.time() - begin
+
+        def multinomial(index: int, rng: torch.Generator):
+            file_index = int(torch.multinomial(dataset.sampling_probabilities, 1, generator=rng).item())
+            return dataset.meta[file_index]
+
+        alias = items_per_second(dataset.sample_file, args.draws)
+        reference = items_per_second(multinomial, args.draws)
+        print(f"{num_files:>10} files: alias table {alias:10.0f} items/s, "
+              f"multinomial {reference:10.0f} items/s ({alias / reference:6.1f}x), "
+              f"dataset built in {build_time:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Benchmark the autoregressive decoding speed of `LMModel.generate` with a randomly initialized
+model, and report the decode time per token for the different key/value cache modes.
+
+Example, with dimensions close to MusicGen-large:
+
+    python -m scripts.bench_lm_decode --dim 2048 --num_heads 32 --num_layers 48 --duration 30
+"""
+
+import argparse
+import time
+import typing as tp
+
+import torch
+
+from audiocraft.models.lm import LMModel
+from audiocraft.modules.codebooks_patterns import DelayedPatternProvider
+from audiocraft.modules.conditioners import (
+    ConditionFuser, ConditioningAttributes, ConditioningProvider, LUTConditioner)
+
+
+def get_lm(args: argparse.Namespace) -> LMModel:
+    conditioners = {
+        'description': LUTConditioner(n_bins=128, dim=args.dim, output_dim=args.dim, tokenizer='whitespace'),
+    }
+    fuser = ConditionFuser({'cross': ['description'], 'prepend': [], 'sum': [], 'input_interpolate': []})
+    lm = LMModel(
+        DelayedPatternProvider(n_q=args.n_q), ConditioningProvider(conditioners), fuser,
+        n_q=args.n_q, card=args.card, dim=args.dim, num_heads=args.num_heads, num_layers=args.num_layers,
+        custom=True, cross_attention=True, causal=True, cfg_coef=3.0)
+    dtype = torch.float16 if args.device == 'cuda' else torch.float32
+    return lm.to(device=args.device, dtype=dtype).eval()
+
+
+def time_generate(lm: LMModel, args: argparse.Namespace, **kwargs) -> float:
+    """Return the average decode time per token (sequence step) in seconds."""
+    conditions = [ConditioningAttributes(text={'description': 'a b c'}) for _ in range(args.batch_size)]
+    max_gen_len = int(args.duration * args.frame_rate)
+    timings = []
+    for _ in range(args.warmup + args.repeat):
+        if args.device == 'cuda':
+            torch.cuda.synchronize()
+        begin = time.time()
+        lm.generate(None, conditions, max_gen_len=max_gen_len, **kwargs)
+        if args.device == 'cuda':
+            torch.cuda.synchronize()
+        timings.append(time.time() - begin)
+    num_steps = lm.pattern_provider.get_pattern(max_gen_len).num_sequence_steps
+    return sum(timings[args.warmup:]) / args.repeat / num_steps
+
+
+def main(argv: tp.Optional[tp.List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--dim', type=int, default=1024)
+    parser.add_argument('--num_heads', type=int, default=16)
+    parser.add_argument('--num_layers', type=int, default=24)
+    parser.add_argument('--n_q', type=int, default=4)
+    parser.add_argument('--card', type=int, default=2048)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--duration', type=float, default=10.)
+    parser.add_argument('--frame_rate', type=float, default=50.)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    torch.manual_seed(1234)
+    lm = get_lm(args)
+    modes = {
+        'dynamic kv cache': {},
+        'static kv cache': {'static_kv_cache': True},
+    }
+    timings = {name: time_generate(lm, args, **kwargs) for name, kwargs in modes.items()}
+    reference = timings['dynamic kv cache']
+    for name, per_token in timings.items():
+        saved = reference - per_token
+        print(f"{name:>20}: {1000 * per_token:8.3f} ms/token, "
+              f"saves {1000 * saved:8.3f} ms/token ({100 * saved / reference:5.1f}%)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Benchmark speculative decoding of MusicGen with a smaller draft model sharing the same compression model,
+comparing the generation time with the regular decoding, and reporting the rate of drafted steps accepted
+and the number of sequence steps generated per forward of the large model, for several numbers of drafted steps.
+
+Example:
+
+    python -m scripts.bench_speculative_decoding --model facebook/musicgen-large \\
+        --draft_model facebook/musicgen-small --draft_steps 2 4 8 --duration 10
+"""
+
+import argparse
+import time
+import typing as tp
+
+import torch
+
+from audiocraft.models import MusicGen
+
+
+DESCRIPTIONS = [
+    'lofi hip hop beat with a mellow piano',
+    'energetic rock song with electric guitars and drums',
+]
+
+
+def timed_generate(model: MusicGen, descriptions: tp.List[str], seed: int, **params) -> float:
+    """Return the time to generate the tokens for the descriptions, without decoding them, in seconds."""
+    generator = torch.Generator(model.device)
+    generator.manual_seed(seed)
+    model.set_generation_params(generator=generator, **params)
+    if model.device.type == 'cuda':
+        torch.cuda.synchronize()
+    attributes, _ = model._prepare_tokens_and_attributes(descriptions, None)
+    begin = time.time()
+    model._generate_tokens(attributes, None)
+    if model.device.type == 'cuda':
+        torch.cuda.synchronize()
+    return time.time() - begin
+
+
+def main(argv: tp.Optional[tp.List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--model', default='facebook/musicgen-large')
+    parser.add_argument('--draft_model', default='facebook/musicgen-small')
+    parser.add_argument('--draft_steps', type=int, nargs='+', default=[2, 4, 6, 8])
+    parser.add_argument('--duration', type=float, default=10.)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--top_k', type=int, default=250)
+    parser.add_argument('--temperature', type=float, default=1.)
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args(argv)
+
+    model = MusicGen.get_pretrained(args.model, device=args.device)
+    draft_model = MusicGen.get_pretrained(args.draft_model, device=args.device)
+    descriptions = [DESCRIPTIONS[idx % len(DESCRIPTIONS)] for idx in range(args.batch_size)]
+    params = dict(duration=args.duration, top_k=args.top_k, temperature=args.temperature)
+
+    timed_generate(model, descriptions[:1], args.seed, **params)  # warmup
+    reference = timed_generate(model, descriptions, args.seed, **params)
+    print(f"{args.model}: {reference:.2f}s for {args.batch_size} x {args.duration:.0f}s")
+    for draft_steps in args.draft_steps:
+        elapsed = timed_generate(model, descriptions, args.seed,
+                                 draft_model=draft_model, draft_steps=draft_steps, **params)
+        stats = model.lm.speculative_stats
+        print(f"draft {draft_steps:2d} steps: {elapsed:7.2f}s ({reference / elapsed:4.2f}x), "
+              f"acceptance rate {100 * stats['acceptance_rate']:5.1f}%, "
+              f"{stats['steps_per_forward']:4.2f} steps per forward of the large model")
+
+
+if __name__ == '__main__':
+    main()
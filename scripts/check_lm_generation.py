@@ -0,0 +1,90 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Check the streaming generation of `LMModel` with the memory efficient attention, as used by the MusicGen models,
+on small random models, comparing it under greedy sampling with the reference attention implementation.
+Generation with a rolling past context runs well beyond the receptive field so that keys and values get evicted,
+and speculative decoding with a smaller draft model attends to the cached steps with several queries at once.
+Requires xformers to be installed.
+
+Example:
+
+    python -m scripts.check_lm_generation --backend torch
+"""
+
+import argparse
+import typing as tp
+
+import torch
+
+from audiocraft.models.lm import LMModel
+from audiocraft.modules.codebooks_patterns import DelayedPatternProvider
+from audiocraft.modules.conditioners import ConditionFuser, ConditioningProvider
+from audiocraft.modules.transformer import set_efficient_attention_backend
+
+
+N_Q = 4
+CARD = 32
+
+
+def get_lm(memory_efficient: bool, positional_embedding: str, num_layers: int = 2) -> LMModel:
+    lm = LMModel(DelayedPatternProvider(n_q=N_Q), ConditioningProvider({}), ConditionFuser({}),
+                 n_q=N_Q, card=CARD, dim=64, num_heads=4, num_layers=num_layers, causal=True, custom=True,
+                 memory_efficient=memory_efficient, positional_embedding=positional_embedding)
+    return lm.eval()
+
+
+def get_lm_pair(positional_embedding: str, num_layers: int = 2) -> tp.Tuple[LMModel, LMModel]:
+    """Return a model with memory efficient attention and the same model with the reference attention."""
+    lm = get_lm(True, positional_embedding, num_layers)
+    reference = get_lm(False, positional_embedding, num_layers)
+    reference.load_state_dict(lm.state_dict())
+    return lm, reference
+
+
+def check_rolling_context(positional_embedding: str, past_context: int = 16):
+    lm, reference = get_lm_pair(positional_embedding)
+    prompt = torch.randint(CARD, (2, N_Q, 8))
+    params: tp.Dict[str, tp.Any] = dict(max_gen_len=4 * past_context, use_sampling=False, past_context=past_context)
+    expected = reference.generate(prompt, [], **params)
+    for static_kv_cache in [False, True]:
+        codes = lm.generate(prompt, [], static_kv_cache=static_kv_cache, **params)
+        assert torch.equal(codes, expected), \
+            f"Rolling context generation differs from the reference (static_kv_cache={static_kv_cache})."
+
+
+def check_speculative_decoding(positional_embedding: str, draft_steps: int = 4) -> float:
+    """Check that speculative decoding matches the regular decoding, and return the acceptance rate."""
+    lm, reference = get_lm_pair(positional_embedding)
+    draft_lm = get_lm(True, positional_embedding, num_layers=1)
+    prompt = torch.randint(CARD, (2, N_Q, 8))
+    params: tp.Dict[str, tp.Any] = dict(max_gen_len=48, use_sampling=False)
+    expected = reference.generate(prompt, [], **params)
+    codes = lm.generate(prompt, [], **params)
+    assert torch.equal(codes, expected), "Generation differs from the reference."
+    codes = lm.generate(prompt, [], draft_lm=draft_lm, draft_steps=draft_steps, **params)
+    assert torch.equal(codes, expected), "Speculative decoding differs from the regular decoding."
+    return lm.speculative_stats['acceptance_rate']
+
+
+def main(argv: tp.Optional[tp.List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--backend', choices=['torch', 'xformers'], default='torch')
+    parser.add_argument('--seed', type=int, default=1234)
+    args = parser.parse_args(argv)
+
+    set_efficient_attention_backend(args.backend)
+    torch.manual_seed(args.seed)
+    for positional_embedding in ['sin', 'rope']:
+        check_rolling_context(positional_embedding)
+        print(f"{positional_embedding:>4}: rolling context OK")
+        acceptance_rate = check_speculative_decoding(positional_embedding)
+        print(f"{positional_embedding:>4}: speculative decoding OK, acceptance rate {100 * acceptance_rate:.1f}%")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Convert an `EmbeddingCache` stored as one `torch.save` file per embedding into the packed storage,
+i.e. memory-mapped shards of raw tensors with an index, see `audiocraft.utils.cache.PackedEmbeddingStore`.
+The packed storage is written in the same folder by default, so that the cache can then be used
+with `storage='packed'` (e.g. `cache_storage=packed` for the chroma conditioner) without moving it.
+Embeddings already present in the packed storage are skipped, hence the conversion can be resumed.
+
+Example:
+
+    python -m scripts.compact_embedding_cache /path/to/cache/wav --delete
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from pathlib import Path
+import re
+import sys
+import time
+import typing as tp
+
+from audiocraft.utils.cache import EmbeddingCache, PackedEmbeddingStore
+
+
+logger = logging.getLogger(__name__)
+
+# per-file caches are named after the sha1 of the path of the embedded file
+_SIG_PATTERN = re.compile(r'^[0-9a-f]{40}$')
+
+
+def find_cache_files(cache_path: Path) -> tp.List[Path]:
+    return sorted(path for path in cache_path.iterdir() if path.is_file() and _SIG_PATTERN.match(path.name))
+
+
+def compact(cache_path: Path, output: Path, delete: bool = False, workers: int = 8,
+            max_shard_bytes: int = 2 ** 30) -> None:
+    files = find_cache_files(cache_path)
+    store = PackedEmbeddingStore(output, max_shard_bytes=max_shard_bytes)
+    todo = [path for path in files if path.name not in store]
+    logger.info("Found %d cached embeddings in %s, %d to convert", len(files), cache_path, len(todo))
+    begin = time.time()
+    converted = 0
+    failed = 0
+    with ThreadPoolExecutor(workers) as pool:
+        for path, embed in zip(todo, pool.map(EmbeddingCache._get_full_embed_from_cache, todo)):
+            if embed is None:
+                failed += 1
+                continue
+            store.put(path.name, embed)
+            converted += 1
+            if converted % 1000 == 0:
+                logger.info("Converted %d/%d embeddings in %.1fs", converted, len(todo), time.time() - begin)
+    store.close()
+    logger.info("Converted %d embeddings in %.1fs, %d failed to load, %d embeddings in %s",
+                converted, time.time() - begin, failed, len(PackedEmbeddingStore(output)), output)
+    if delete:
+        packed = PackedEmbeddingStore(output)
+        removed = 0
+        for path in files:
+            if path.name in packed:
+                path.unlink()
+                removed += 1
+        logger.info("Removed %d per-file cached embeddings", removed)
+
+
+def main():
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        prog='compact_embedding_cache',
+        description='Convert a per-file embedding cache into the packed storage.')
+    parser.add_argument('cache_path', type=Path, help='Folder of the per-file embedding cache.')
+    parser.add_argument('--output', type=Path,
+                        help='Folder of the packed storage, defaults to the folder of the per-file cache.')
+    parser.add_argument('--delete', action='store_true',
+                        help='Remove the per-file cached embeddings once converted.')
+    parser.add_argument('--workers', type=int, default=8, help='Number of threads loading the embeddings.')
+    parser.add_argument('--max_shard_mb', type=int, default=1024, help='Size of the shards, in MB.')
+    args = parser.parse_args()
+    compact(args.cache_path, args.output or args.cache_path, delete=args.delete, workers=args.workers,
+            max_shard_bytes=args.max_shard_mb * 2 ** 20)
+
+
+if __name__ == '__main__':
+    main()